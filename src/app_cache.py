@@ -0,0 +1,194 @@
+# Qt GUI (Resource Cache)
+# Name: Matthew Jakeman
+# UPI: mjak923
+
+import os
+import time
+from collections import OrderedDict
+from threading import Lock
+
+from config import PARTIAL_DOWNLOAD_SUFFIX, PARTIAL_DOWNLOAD_EXPIRY
+from message import RESOURCE_ORIGINAL
+
+# Resource Disk Cache:
+#
+# Downloaded resources are kept on disk, one file per variant of a resource
+# named after its id and variant ({resource_id}.{variant}), so reopening a
+# room (or restarting the app) shows its images without downloading them
+# again. Resource ids are only unique to a server, so each server gets its
+# own directory.
+#
+# The cache is limited by the total size of its files, and the least
+# recently used are deleted first. Recency survives restarts through each
+# file's modification time, which is updated whenever the file is read.
+#
+# Files are written under a temporary name and then renamed, so a crash
+# never leaves a partial resource behind. Downloads are written to a
+# partial file ({resource_id}.{variant}.partial) as their chunks arrive,
+# which is kept if the download is interrupted so it can be resumed, and
+# moved into the cache once complete. Partial files are not counted
+# towards the budget.
+
+TEMP_SUFFIX = ".tmp"
+
+
+def server_cache_location(location, address, port):
+    return os.path.join(location, f"{address}_{port}")
+
+
+class ResourceDiskCache:
+    location = None
+    budget = None
+    size = 0
+
+    hits = 0
+    misses = 0
+
+    entries = None  # (resource_id, variant) -> file size, least recently used first
+    lock = None
+
+    def __init__(self, location, budget):
+        self.location = location
+        self.budget = budget
+
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+        os.makedirs(location, exist_ok=True)
+        self.load()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def path(self, key):
+        (resource_id, variant) = key
+        return os.path.join(self.location, f"{resource_id}.{variant}")
+
+    def partial_path(self, key):
+        return self.path(key) + PARTIAL_DOWNLOAD_SUFFIX
+
+    def load(self):
+        files = []
+
+        for name in os.listdir(self.location):
+            path = os.path.join(self.location, name)
+
+            # Left over from a write which never finished
+            if name.endswith(TEMP_SUFFIX):
+                os.remove(path)
+                continue
+
+            # Kept for resuming, unless abandoned
+            if name.endswith(PARTIAL_DOWNLOAD_SUFFIX):
+                if time.time() - os.stat(path).st_mtime > PARTIAL_DOWNLOAD_EXPIRY:
+                    os.remove(path)
+                continue
+
+            try:
+                (resource_id, variant) = name.split(".")
+                key = (int(resource_id), int(variant))
+            except ValueError:
+                continue
+
+            stat = os.stat(path)
+            files.append((stat.st_mtime, key, stat.st_size))
+
+        for (_, key, size) in sorted(files):
+            self.entries[key] = size
+            self.size += size
+
+        # The budget may have shrunk since the files were written
+        self.evict()
+
+    def get(self, resource_id, variant=RESOURCE_ORIGINAL):
+        key = (resource_id, variant)
+
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+
+            try:
+                with open(self.path(key), "rb") as file:
+                    data = file.read()
+
+                os.utime(self.path(key))
+            except FileNotFoundError:
+                # Deleted from outside the app
+                self.size -= self.entries.pop(key)
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return data
+
+    def put(self, resource_id, data, variant=RESOURCE_ORIGINAL):
+        if len(data) > self.budget:
+            return
+
+        key = (resource_id, variant)
+
+        with self.lock:
+            temp_path = self.path(key) + TEMP_SUFFIX
+            try:
+                with open(temp_path, "wb") as file:
+                    file.write(data)
+
+                os.replace(temp_path, self.path(key))
+            except OSError as e:
+                # A full disk shouldn't stop the image being shown
+                print(f"WARN: Could not cache resource {resource_id}: {e}")
+                return
+
+            self.add_entry(key, len(data))
+
+    def open_partial(self, resource_id, variant=RESOURCE_ORIGINAL):
+        # Opened for appending, so the download resumes from the file's size
+        return open(self.partial_path((resource_id, variant)), "ab")
+
+    def discard_partial(self, resource_id, variant=RESOURCE_ORIGINAL):
+        try:
+            os.remove(self.partial_path((resource_id, variant)))
+        except FileNotFoundError:
+            pass
+
+    def finish_partial(self, resource_id, variant=RESOURCE_ORIGINAL):
+        # Moves a complete download into the cache and returns its contents
+        key = (resource_id, variant)
+        partial_path = self.partial_path(key)
+
+        with open(partial_path, "rb") as file:
+            data = file.read()
+
+        if len(data) > self.budget:
+            os.remove(partial_path)
+            return data
+
+        with self.lock:
+            os.replace(partial_path, self.path(key))
+
+            self.add_entry(key, len(data))
+
+        return data
+
+    def add_entry(self, key, size):
+        old_size = self.entries.pop(key, None)
+        if old_size is not None:
+            self.size -= old_size
+
+        self.entries[key] = size
+        self.size += size
+
+        self.evict()
+
+    def evict(self):
+        # Delete least recently used files until back under budget
+        while self.size > self.budget:
+            (key, size) = self.entries.popitem(last=False)
+            self.size -= size
+
+            try:
+                os.remove(self.path(key))
+            except FileNotFoundError:
+                pass
@@ -5,17 +5,33 @@ from PyQt5.QtCore import Qt, QByteArray
 from PyQt5.QtGui import QPixmap
 from PyQt5.QtWidgets import QDialog, QLabel, QToolBar, QPushButton, QVBoxLayout, QFileDialog, QScrollArea
 
+from message import RESOURCE_ORIGINAL
+
 
 class ImagePreviewDialog(QDialog):
     list = None
     app_state = None
+    resource_id = None
     data = None
 
-    def __init__(self, data):
+    image = None
+    download_btn = None
+
+    def __init__(self, app_state, resource_id):
         super().__init__()
-        self.data = data
+        self.app_state = app_state
+        self.resource_id = resource_id
         self.construct_ui()
 
+        # Only the preview is shown in the chat, so the original is
+        # downloaded when first opened
+        data = self.app_state.client_thread.cached_resource(resource_id)
+        if data is not None:
+            self.show_image(data)
+        else:
+            self.app_state.client_thread.resource_transfer.connect(self.on_resource_transferred)
+            self.app_state.client_thread.download_resource(resource_id)
+
     def construct_ui(self):
 
         vbox = QVBoxLayout()
@@ -26,20 +42,33 @@ class ImagePreviewDialog(QDialog):
         scroll = QScrollArea()
         vbox.addWidget(scroll)
 
+        self.image = QLabel("Loading...")
+        self.image.setAlignment(Qt.AlignCenter)
+        scroll.setWidget(self.image)
+        scroll.setWidgetResizable(True)
+
+        self.download_btn = QPushButton("Download")
+        self.download_btn.setEnabled(False)
+        self.download_btn.clicked.connect(self.download_image)
+        vbox.addWidget(self.download_btn)
+
+        self.setLayout(vbox)
+
+    def show_image(self, data):
+        self.data = data
+
         pixmap = QPixmap()
         pixmap.loadFromData(QByteArray(self.data))
 
-        image = QLabel()
-        image.setPixmap(pixmap)
-        image.setAlignment(Qt.AlignCenter)
-        scroll.setWidget(image)
-        scroll.setWidgetResizable(True)
+        self.image.setPixmap(pixmap)
+        self.download_btn.setEnabled(True)
 
-        button = QPushButton("Download")
-        button.clicked.connect(self.download_image)
-        vbox.addWidget(button)
+    def on_resource_transferred(self, resource_id, variant, resource_data):
+        if resource_id != self.resource_id or variant != RESOURCE_ORIGINAL:
+            return
 
-        self.setLayout(vbox)
+        self.app_state.client_thread.resource_transfer.disconnect(self.on_resource_transferred)
+        self.show_image(resource_data)
 
     def download_image(self):
         filename = QFileDialog.getSaveFileName(self, "Save image", "/", "Image files (*.png *.jpg)")
@@ -47,7 +47,8 @@ class AppState:
         self.rooms[room_id] = (room_title, host_id, host_name)
 
     def get_known_client_name(self, client_id):
-        return self.clients[client_id]
+        # History can include clients who have since disconnected
+        return self.clients.get(client_id, f"User {client_id}")
 
     def get_known_room_name(self, room_id):
         return self.rooms[room_id][0]
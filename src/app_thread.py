@@ -2,6 +2,7 @@
 # Name: Matthew Jakeman
 # UPI: mjak923
 
+import hashlib
 import queue
 import sys
 import traceback
@@ -9,7 +10,22 @@ from datetime import datetime
 
 from PyQt5.QtCore import QThread, pyqtSignal
 
-from message import MessageType
+from config import INVALID_ID, RESOURCE_CHUNK_SIZE, DOWNLOAD_WINDOW
+from message import MessageType, ResourceUploadBeginMessage, ResourceUploadChunkMessage, ResourceUploadEndMessage, \
+    ResourceDownloadMessage, RESOURCE_ORIGINAL
+
+
+class Download:
+    # A download in progress, written to its partial file in the cache
+    file = None
+    received = 0   # Bytes in the partial file
+    requested = 0  # Offset of the next chunk to ask for
+    total = None   # Unknown until the first chunk arrives
+
+    def __init__(self, file):
+        self.file = file
+        self.received = file.tell()
+        self.requested = self.received
 
 
 class ClientThread(QThread):
@@ -18,80 +34,274 @@ class ClientThread(QThread):
 
     running = None
 
+    # MessageType -> handler
+    handlers = None
+
+    # Transfers in progress
+    uploads = None    # digest -> (filename, size)
+    downloads = None  # (resource_id, variant) -> Download
+
+    # Downloaded resources, kept on disk
+    cache = None
+
     discovered_client = pyqtSignal(int, str)
     discovered_room = pyqtSignal(int, str, int, str)
+    discovered_clients = pyqtSignal(object)
+    discovered_rooms = pyqtSignal(object)
     created_room = pyqtSignal(int)
     started_chat = pyqtSignal(int, int, str)
     received_message = pyqtSignal(int, int, datetime, str, int)
     resource_ack = pyqtSignal(int)
-    resource_transfer = pyqtSignal(bytearray)
+    resource_transfer = pyqtSignal(int, int, bytearray)
     room_membership = pyqtSignal(int, object)
+    received_history = pyqtSignal(int, int, object)
+    upload_progress = pyqtSignal(int, int)
+    download_progress = pyqtSignal(int, int, int, int)
 
-    def __init__(self, client):
+    def __init__(self, client, cache):
         super().__init__()
         self.client = client
+        self.cache = cache
         self.queue = queue.Queue()
         self.running = True
 
+        self.uploads = {}
+        self.downloads = {}
+
+        self.handlers = {
+            MessageType.CLIENT_DISCOVERY: self.handle_client_discovery,
+            MessageType.ROOM_DISCOVERY: self.handle_room_discovery,
+            MessageType.CLIENT_DIRECTORY: self.handle_client_directory,
+            MessageType.ROOM_DIRECTORY: self.handle_room_directory,
+            MessageType.ACKNOWLEDGE_ROOM_CREATE: self.handle_acknowledge_room_create,
+            MessageType.ACKNOWLEDGE_USER_CHAT: self.handle_acknowledge_user_chat,
+            MessageType.ROOM_MESSAGE_BROADCAST: self.handle_room_message_broadcast,
+            MessageType.ACKNOWLEDGE_RESOURCE: self.handle_acknowledge_resource,
+            MessageType.RESOURCE_TRANSFER: self.handle_resource_transfer,
+            MessageType.RESOURCE_UPLOAD_ACK: self.handle_resource_upload_ack,
+            MessageType.RESOURCE_CHUNK: self.handle_resource_chunk,
+            MessageType.ROOM_MEMBERSHIP_DISCOVERY: self.handle_room_membership_discovery,
+            MessageType.HISTORY_BATCH: self.handle_history_batch,
+        }
+
     def dispatch(self, server_socket, message):
-        if message.message_type is MessageType.CLIENT_DISCOVERY:
-            print(f"Discovered client: {message.nickname}")
-            self.discovered_client.emit(message.client_id, message.nickname)
+        handler = self.handlers.get(message.message_type)
+        if handler is None:
+            print(f"Unsupported message: {message.message_type}")
             return
 
-        if message.message_type is MessageType.ROOM_DISCOVERY:
-            print(f"Discovered room: {message.title}")
-            self.discovered_room.emit(message.room_id, message.title, message.host_id, message.host_name)
-            return
+        handler(message)
 
-        if message.message_type is MessageType.ACKNOWLEDGE_ROOM_CREATE:
-            print(f"Ack'd room creation: {message.room_id}")
-            self.created_room.emit(message.room_id)
-            return
+    def handle_client_discovery(self, message):
+        print(f"Discovered client: {message.nickname}")
+        self.discovered_client.emit(message.client_id, message.nickname)
 
-        if message.message_type is MessageType.ACKNOWLEDGE_USER_CHAT:
-            print(f"Ack'd user chat: {message.room_id}")
-            self.started_chat.emit(message.user_id, message.room_id, message.user_nick)
-            return
+    def handle_room_discovery(self, message):
+        print(f"Discovered room: {message.title}")
+        self.discovered_room.emit(message.room_id, message.title, message.host_id, message.host_name)
 
-        if message.message_type is MessageType.ROOM_MESSAGE_BROADCAST:
-            print(f"Room {message.room_id}, User {message.user_id}, Time {str(message.timestamp)}: {message.text}, "
-                  f"Resource: {str(message.resource_id)}")
+    def handle_client_directory(self, message):
+        print(f"Discovered {len(message.clients)} clients")
+        self.discovered_clients.emit(message.clients)
 
-            self.received_message.emit(message.room_id, message.user_id, message.timestamp,
-                                       message.text, message.resource_id)
-            return
+    def handle_room_directory(self, message):
+        print(f"Discovered {len(message.rooms)} rooms")
+        self.discovered_rooms.emit(message.rooms)
 
-        if message.message_type is MessageType.ACKNOWLEDGE_RESOURCE:
-            print(f"Resource created: {message.resource_id}")
-            self.resource_ack.emit(message.resource_id)
-            return
+    def handle_acknowledge_room_create(self, message):
+        print(f"Ack'd room creation: {message.room_id}")
+        self.created_room.emit(message.room_id)
 
-        if message.message_type is MessageType.RESOURCE_TRANSFER:
-            self.resource_transfer.emit(message.data)
-            return
+    def handle_acknowledge_user_chat(self, message):
+        print(f"Ack'd user chat: {message.room_id}")
+        self.started_chat.emit(message.user_id, message.room_id, message.user_nick)
 
-        if message.message_type is MessageType.ROOM_MEMBERSHIP_DISCOVERY:
-            self.room_membership.emit(message.host_id, message.members)
-            return
+    def handle_room_message_broadcast(self, message):
+        print(f"Room {message.room_id}, User {message.user_id}, Time {str(message.timestamp)}: {message.text}, "
+              f"Resource: {str(message.resource_id)}")
+
+        self.received_message.emit(message.room_id, message.user_id, message.timestamp,
+                                   message.text, message.resource_id)
+
+    def handle_acknowledge_resource(self, message):
+        print(f"Resource created: {message.resource_id}")
+        self.resource_ack.emit(message.resource_id)
+
+    def handle_resource_transfer(self, message):
+        # Whole (v1) transfers don't say which resource they are
+        self.resource_transfer.emit(INVALID_ID, RESOURCE_ORIGINAL, message.data)
 
-        print(f"Unsupported message: {message.message_type}")
+    def handle_room_membership_discovery(self, message):
+        self.room_membership.emit(message.host_id, message.members)
+
+    def handle_history_batch(self, message):
+        print(f"Room {message.room_id}, History from {message.first_offset}: {len(message.records)} messages")
+        self.received_history.emit(message.room_id, message.first_offset, message.messages(self.client.version))
 
     def run(self):
         while self.running:
-            # Poll for incoming messages
-            self.client.poll(self.dispatch)
+            # Block until messages arrive or queue_message wakes the thread
+            if not self.client.poll(self.dispatch, None):
+                print("ERROR: Lost connection to the server")
+                break
 
-            # Send all queued messages
+            # Send all queued messages, and run any queued work which
+            # would otherwise hold up the GUI thread
             while not self.queue.empty():
-                message = self.queue.get()
-                self.client.send_message(message)
+                item = self.queue.get()
+                if callable(item):
+                    item()
+                else:
+                    self.client.send_message(item)
 
         # Loop terminated, so quit
         self.client.__del__()
 
     def queue_message(self, message):
         self.queue.put(message)
+        self.client.wake()
+
+    def queue_task(self, task):
+        # Runs task on this thread
+        self.queue.put(task)
+        self.client.wake()
+
+    def upload_resource(self, filename):
+        # Resources are sent one chunk at a time, each chunk once the server
+        # has acknowledged the previous one. The server remembers how much
+        # of an upload (identified by its hash) it has, so an interrupted
+        # upload picks up where it left off.
+        self.queue_task(lambda: self.begin_upload(filename))
+
+    def begin_upload(self, filename):
+        # Hashing reads the whole file, so it is done here rather than on
+        # the GUI thread
+        sha = hashlib.sha256()
+        size = 0
+
+        try:
+            with open(filename, "rb") as file:
+                while chunk := file.read(RESOURCE_CHUNK_SIZE):
+                    sha.update(chunk)
+                    size += len(chunk)
+        except OSError as e:
+            print(f"ERROR: Could not read {filename} to upload: {e}")
+            return
+
+        digest = sha.hexdigest()
+        self.uploads[digest] = (filename, size)
+        self.client.send_message(ResourceUploadBeginMessage(digest, size))
+
+    def handle_resource_upload_ack(self, message):
+        digest = message.digest
+        offset = message.offset
+
+        upload = self.uploads.get(digest)
+        if upload is None:
+            return
+
+        (filename, size) = upload
+        self.upload_progress.emit(offset, size)
+
+        if offset >= size:
+            del self.uploads[digest]
+            self.client.send_message(ResourceUploadEndMessage(digest))
+            return
+
+        with open(filename, "rb") as file:
+            file.seek(offset)
+            data = file.read(RESOURCE_CHUNK_SIZE)
+
+        self.client.send_message(ResourceUploadChunkMessage(digest, offset, data))
+
+    def cached_resource(self, resource_id, variant=RESOURCE_ORIGINAL):
+        return self.cache.get(resource_id, variant)
+
+    def download_resource(self, resource_id, variant=RESOURCE_ORIGINAL):
+        # Resources are downloaded in chunks, with up to DOWNLOAD_WINDOW
+        # chunks asked for at once, into a partial file in the cache. A
+        # download which was interrupted (even by closing the app) carries on
+        # from the end of its partial file.
+        self.queue_task(lambda: self.start_download(resource_id, variant))
+
+    def start_download(self, resource_id, variant):
+        # A resource already being downloaded is not asked for twice
+        key = (resource_id, variant)
+        if key in self.downloads:
+            return
+
+        try:
+            download = Download(self.cache.open_partial(resource_id, variant))
+        except OSError as e:
+            print(f"ERROR: Could not start downloading resource {resource_id}: {e}")
+            return
+
+        self.downloads[key] = download
+
+        # The size is not known yet, so only the first chunk is asked for
+        self.request_chunk(resource_id, variant, download)
+
+    def request_chunk(self, resource_id, variant, download):
+        self.client.send_message(ResourceDownloadMessage(resource_id, download.requested, variant))
+        download.requested += RESOURCE_CHUNK_SIZE
+
+    def cancel_download(self, resource_id, variant=RESOURCE_ORIGINAL):
+        self.queue_task(lambda: self.stop_download(resource_id, variant))
+
+    def stop_download(self, resource_id, variant):
+        # Any chunk already on its way is ignored, and the partial file is
+        # kept to resume from
+        download = self.downloads.pop((resource_id, variant), None)
+        if download is not None:
+            download.file.close()
+
+    def handle_resource_chunk(self, message):
+        resource_id = message.resource_id
+        variant = message.variant
+        download = self.downloads.get((resource_id, variant))
+
+        # Ignore cancelled downloads and repeated chunks
+        if download is None or message.offset != download.received:
+            return
+
+        download.total = message.total
+
+        if message.data:
+            try:
+                download.file.write(message.data)
+            except OSError as e:
+                print(f"ERROR: Could not save resource {resource_id}: {e}")
+                self.finish_download(resource_id, variant, False)
+                return
+
+            download.received += len(message.data)
+            self.download_progress.emit(resource_id, variant, download.received, download.total)
+
+            if download.received < download.total:
+                # Keep the window of requests full
+                while download.requested < download.total and \
+                        download.requested - download.received < DOWNLOAD_WINDOW * RESOURCE_CHUNK_SIZE:
+                    self.request_chunk(resource_id, variant, download)
+                return
+
+        self.finish_download(resource_id, variant, download.received == download.total)
+
+    def finish_download(self, resource_id, variant, complete):
+        download = self.downloads.pop((resource_id, variant))
+        download.file.close()
+
+        data = b""
+        try:
+            if complete:
+                data = self.cache.finish_partial(resource_id, variant)
+            else:
+                # The resource can't be read from where the partial file ends
+                self.cache.discard_partial(resource_id, variant)
+        except OSError as e:
+            print(f"ERROR: Could not save resource {resource_id}: {e}")
+
+        self.resource_transfer.emit(resource_id, variant, bytearray(data))
 
     def stop(self):
         self.running = False
+        self.client.wake()
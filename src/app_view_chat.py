@@ -4,7 +4,7 @@
 
 from datetime import datetime
 
-from PyQt5.QtCore import QByteArray, Qt, QRectF
+from PyQt5.QtCore import QByteArray, Qt, QRectF, QPoint, QTimer
 from PyQt5.QtGui import QPixmap, QPainter, QPainterPath, QStandardItemModel, QStandardItem, QColor
 from PyQt5.QtWidgets import QWidget, QGridLayout, QLabel, QVBoxLayout, QScrollArea, QHBoxLayout, QLineEdit, QPushButton, \
     QListView, QFileDialog, QProgressDialog, QFrame
@@ -12,23 +12,50 @@ from PyQt5.QtWidgets import QWidget, QGridLayout, QLabel, QVBoxLayout, QScrollAr
 from app_dialog_image import ImagePreviewDialog
 from app_dialog_invite import InviteToRoomDialog
 from config import INVALID_ID
-from message import RoomEntrySendMessage, RoomInviteMessage, ResourceCreateMessage, ResourceFetchMessage, \
-    ListRoomMembersMessage
+from message import RoomEntrySendMessage, RoomInviteMessage, ListRoomMembersMessage, HistoryFetchMessage, \
+    RESOURCE_PREVIEW
 
 IMAGE_PREVIEW_HEIGHT = 200
 IMAGE_PREVIEW_WIDTH = 300
 
+# Messages loaded when opening a room, and each time earlier messages are requested
+HISTORY_PAGE_SIZE = 50
+
+# Images are loaded once they are within this many pixels of the visible
+# part of the chat, with at most MAX_IMAGE_DOWNLOADS downloading at a time.
+# Scrolling is left to settle for IMAGE_LOAD_DELAY milliseconds first.
+IMAGE_LOAD_MARGIN = 600
+MAX_IMAGE_DOWNLOADS = 4
+IMAGE_LOAD_DELAY = 50
+
 
 class ImageLabel(QLabel):
-    data = None
+    # A placeholder until its image is loaded
+    app_state = None
+    resource_id = None
+    loaded = False
     viewer = None
 
-    def set_click_handler(self, data):
-        self.data = data
-        self.mousePressEvent = self.open_image
+    def __init__(self, app_state, resource_id):
+        super(ImageLabel, self).__init__("Image")
+        self.app_state = app_state
+        self.resource_id = resource_id
+
+    def set_image(self, resource_data):
+        # Servers without previews send the original, so it may still need scaling
+        pixmap = QPixmap()
+        pixmap.loadFromData(QByteArray(resource_data))
+        pixmap = pixmap.scaled(IMAGE_PREVIEW_WIDTH, IMAGE_PREVIEW_HEIGHT, Qt.KeepAspectRatio)
+
+        self.setPixmap(pixmap)
+        self.loaded = True
+
+    def mousePressEvent(self, event):
+        if not self.loaded:
+            return
 
-    def open_image(self, event):
-        self.viewer = ImagePreviewDialog(self.data)
+        # The chat only has the preview, so the dialog fetches the original
+        self.viewer = ImagePreviewDialog(self.app_state, self.resource_id)
         self.viewer.setModal(True)
         self.viewer.show()
 
@@ -42,14 +69,23 @@ class RoomView(QWidget):
 
     participants = None
     chat_vbox = None
+    chat_scroll = None
+    chat_inner = None
     message_entry = None
+    history_btn = None
+
+    # Offset of the oldest loaded message, used to fetch the page before it
+    history_cursor = None
 
     participants_model = None
 
     should_show_participants = None
     upload_progress = None
-    transfer_progress = None
-    image = None
+
+    # Images which have not been loaded yet, and the previews this view is downloading
+    placeholders = None
+    downloads = None
+    load_timer = None
 
     def __init__(self, parent, app_state, room_id, title, should_show_participants=False):
         super(RoomView, self).__init__()
@@ -62,9 +98,20 @@ class RoomView(QWidget):
 
         self.should_show_participants = should_show_participants
 
+        self.placeholders = []
+        self.downloads = set()
+
+        self.load_timer = QTimer()
+        self.load_timer.setSingleShot(True)
+        self.load_timer.setInterval(IMAGE_LOAD_DELAY)
+        self.load_timer.timeout.connect(self.load_visible_images)
+
         self.app_state.client_thread.received_message.connect(self.on_message)
         self.app_state.client_thread.resource_ack.connect(self.on_resource_created)
         self.app_state.client_thread.resource_transfer.connect(self.on_resource_transferred)
+        self.app_state.client_thread.upload_progress.connect(self.on_upload_progress)
+        self.app_state.client_thread.download_progress.connect(self.on_download_progress)
+        self.app_state.client_thread.received_history.connect(self.on_history)
 
         if self.should_show_participants:
             self.app_state.client_thread.room_membership.connect(self.on_room_membership)
@@ -76,6 +123,10 @@ class RoomView(QWidget):
 
         self.construct_ui()
 
+        # Load the most recent messages
+        new_msg = HistoryFetchMessage(self.room_id, INVALID_ID, HISTORY_PAGE_SIZE)
+        self.app_state.client_thread.queue_message(new_msg)
+
     def construct_ui(self):
         # (0,0) Label
         grid = QGridLayout()
@@ -95,6 +146,18 @@ class RoomView(QWidget):
         inner.setLayout(self.chat_vbox)
         scroll_area.setWidget(inner)
 
+        # Scrolling, or messages being added, can bring images into view
+        scroll_area.verticalScrollBar().valueChanged.connect(self.schedule_image_load)
+        scroll_area.verticalScrollBar().rangeChanged.connect(self.schedule_image_load)
+        self.chat_scroll = scroll_area
+        self.chat_inner = inner
+
+        # Older messages are inserted below this button
+        self.history_btn = QPushButton("Load earlier messages")
+        self.history_btn.setVisible(False)
+        self.history_btn.clicked.connect(self.load_earlier_messages)
+        self.chat_vbox.addWidget(self.history_btn)
+
         grid.addWidget(scroll_area, 1, 0)
 
         # (2,0) Entry and Send Buttons
@@ -128,7 +191,7 @@ class RoomView(QWidget):
 
         self.setLayout(grid)
 
-    def append_message(self, widget, is_current_user):
+    def append_message(self, widget, is_current_user, index=-1):
         parent_hbox = QHBoxLayout()
 
         if is_current_user:
@@ -138,28 +201,55 @@ class RoomView(QWidget):
             parent_hbox.addWidget(widget)
             parent_hbox.addStretch()
 
-        self.chat_vbox.addLayout(parent_hbox)
+        self.chat_vbox.insertLayout(index, parent_hbox)
 
     def on_message(self, room_id, user_id, timestamp, text, resource_id):
-        if room_id is not self.room_id:
+        if room_id != self.room_id:
             return
 
-        is_current_user = (user_id is self.app_state.client_id)
+        self.add_message(user_id, timestamp, text, resource_id)
 
-        if resource_id is not INVALID_ID:
-            # Create image and setup scaling
-            self.image = ImageLabel()
-            self.image.setFixedWidth(IMAGE_PREVIEW_WIDTH)
-            self.image.setFixedHeight(IMAGE_PREVIEW_HEIGHT)
-            self.image.setAlignment(Qt.AlignCenter)
-            self.append_message(self.image, is_current_user)
+    def on_history(self, room_id, first_offset, messages):
+        if room_id != self.room_id:
+            return
+
+        # Insert the page (oldest first) above everything already shown
+        index = 1
+        for message in messages:
+            index += self.add_message(message.user_id, message.timestamp, message.text, message.resource_id, index)
+
+        self.history_cursor = first_offset
+        self.history_btn.setVisible(first_offset > 0)
+
+    def load_earlier_messages(self):
+        if self.history_cursor is None:
+            return
+
+        new_msg = HistoryFetchMessage(self.room_id, self.history_cursor, HISTORY_PAGE_SIZE)
+        self.app_state.client_thread.queue_message(new_msg)
+
+    def add_message(self, user_id, timestamp, text, resource_id, index=-1):
+        # Returns the number of rows added to the chat
+        rows = 0
+        is_current_user = (user_id == self.app_state.client_id)
+
+        if resource_id != INVALID_ID:
+            # Create a placeholder, which is loaded once it is scrolled near
+            image = ImageLabel(self.app_state, resource_id)
+            image.setFixedWidth(IMAGE_PREVIEW_WIDTH)
+            image.setFixedHeight(IMAGE_PREVIEW_HEIGHT)
+            image.setAlignment(Qt.AlignCenter)
+            self.append_message(image, is_current_user, index)
+            rows += 1
+
+            if index >= 0:
+                index += 1
 
             # Styling
-            self.image.setStyleSheet("background-color: black; border-radius: 8px; border 1px solid black;")
+            image.setStyleSheet("background-color: black; color: #deddda; border-radius: 8px; border 1px solid black;")
 
-            new_msg = ResourceFetchMessage(resource_id)
-            self.app_state.client_thread.queue_message(new_msg)
-            self.transfer_progress = self.show_progress_dialog("Processing")
+            self.placeholders.append(image)
+            self.schedule_image_load()
 
         frame = QFrame()
         hbox = QHBoxLayout()
@@ -183,7 +273,10 @@ class RoomView(QWidget):
         hbox.addSpacing(10)
         hbox.addWidget(time)
 
-        self.append_message(frame, is_current_user)
+        self.append_message(frame, is_current_user, index)
+        rows += 1
+
+        return rows
 
     def show_invite_dialog(self):
         dlg = InviteToRoomDialog(self.app_state)
@@ -210,11 +303,7 @@ class RoomView(QWidget):
             return
 
         try:
-            with open(filename[0], "rb") as image:
-                f = image.read()
-                b = bytearray(f)
-                new_msg = ResourceCreateMessage(b)
-                self.app_state.client_thread.queue_message(new_msg)
+            self.app_state.client_thread.upload_resource(filename[0])
         except FileNotFoundError:
             return
 
@@ -224,7 +313,7 @@ class RoomView(QWidget):
         progress = QProgressDialog()
 
         progress.setMinimum(0)
-        progress.setMaximum(0)
+        progress.setMaximum(100)
         progress.setModal(True)
         progress.setWindowTitle(title)
         progress.show()
@@ -240,31 +329,110 @@ class RoomView(QWidget):
 
             self.upload_progress = None
 
-    def on_resource_transferred(self, resource_data):
-        if self.transfer_progress is not None:
-            self.transfer_progress.close()
+    def on_upload_progress(self, sent, total):
+        if self.upload_progress is not None and total > 0:
+            self.upload_progress.setValue(sent * 100 // total)
 
-            pixmap = QPixmap()
-            pixmap.loadFromData(QByteArray(resource_data))
-            pixmap = pixmap.scaled(IMAGE_PREVIEW_WIDTH, IMAGE_PREVIEW_WIDTH, Qt.KeepAspectRatio)
+    def on_download_progress(self, resource_id, variant, received, total):
+        if variant != RESOURCE_PREVIEW or resource_id not in self.downloads or total <= 0:
+            return
+
+        for image in self.placeholders:
+            if image.resource_id == resource_id:
+                image.setText(f"Loading {received * 100 // total}%")
 
-            self.image.setPixmap(pixmap)
-            self.image.set_click_handler(resource_data)
+    def on_resource_transferred(self, resource_id, variant, resource_data):
+        # Originals are only for the image preview dialog
+        if variant != RESOURCE_PREVIEW or resource_id not in self.downloads:
+            return
 
-            self.image = None
-            self.transfer_progress = None
+        self.downloads.remove(resource_id)
+        self.show_images(resource_id, resource_data)
+
+        # Start the next download
+        self.schedule_image_load()
+
+    def show_images(self, resource_id, resource_data):
+        # The same image can be in a chat more than once
+        for image in self.placeholders:
+            if image.resource_id == resource_id:
+                image.set_image(resource_data)
+
+        self.placeholders = [image for image in self.placeholders if not image.loaded]
+
+    def schedule_image_load(self):
+        # Restarting the timer waits for scrolling to settle
+        self.load_timer.start()
+
+    def load_visible_images(self):
+        # Loads the images in or near the visible part of the chat (closest
+        # first), and cancels downloads of images which are no longer near it
+        wanted = []
+
+        if self.isVisible():
+            scroll_bar = self.chat_scroll.verticalScrollBar()
+            top = scroll_bar.value() - IMAGE_LOAD_MARGIN
+            bottom = scroll_bar.value() + self.chat_scroll.viewport().height() + IMAGE_LOAD_MARGIN
+            middle = scroll_bar.value() + self.chat_scroll.viewport().height() // 2
+
+            nearby = []
+            for image in self.placeholders:
+                image_top = image.mapTo(self.chat_inner, QPoint(0, 0)).y()
+                if image_top + image.height() >= top and image_top <= bottom:
+                    nearby.append((abs(image_top + image.height() // 2 - middle), image.resource_id))
+
+            for (_, resource_id) in sorted(nearby):
+                if resource_id not in wanted:
+                    wanted.append(resource_id)
+
+        client_thread = self.app_state.client_thread
+
+        for resource_id in list(self.downloads):
+            if resource_id not in wanted:
+                client_thread.cancel_download(resource_id, RESOURCE_PREVIEW)
+                self.downloads.remove(resource_id)
+
+                for image in self.placeholders:
+                    if image.resource_id == resource_id:
+                        image.setText("Image")
+
+        for resource_id in wanted:
+            if resource_id in self.downloads:
+                continue
+
+            # Images downloaded before are shown straight from the cache
+            resource_data = client_thread.cached_resource(resource_id, RESOURCE_PREVIEW)
+            if resource_data is not None:
+                self.show_images(resource_id, resource_data)
+            elif len(self.downloads) < MAX_IMAGE_DOWNLOADS:
+                self.downloads.add(resource_id)
+                client_thread.download_resource(resource_id, RESOURCE_PREVIEW)
+
+    def showEvent(self, event):
+        super(RoomView, self).showEvent(event)
+        self.schedule_image_load()
+
+    def hideEvent(self, event):
+        # Hidden views (such as when leaving a room) cancel their downloads
+        super(RoomView, self).hideEvent(event)
+        self.load_timer.stop()
+        self.load_visible_images()
+
+    def resizeEvent(self, event):
+        super(RoomView, self).resizeEvent(event)
+        self.schedule_image_load()
 
     def on_room_membership(self, host_id, member_arr):
         self.participants_model.clear()
         for client_id in member_arr:
             nickname = self.app_state.get_known_client_name(client_id)
 
-            if client_id is host_id:
+            if client_id == host_id:
                 nickname += " (host)"
 
             item = QStandardItem(nickname)
 
-            if client_id is self.app_state.client_id:
+            if client_id == self.app_state.client_id:
                 color = QColor()
                 color.setNamedColor("blue")
                 item.setForeground(color)
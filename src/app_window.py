@@ -3,11 +3,13 @@
 # UPI: mjak923
 from PyQt5.QtWidgets import QWidget, QVBoxLayout, QStackedWidget, QHBoxLayout, QPushButton, QApplication
 
+from app_cache import ResourceDiskCache, server_cache_location
 from app_state import AppState
 from app_thread import ClientThread
 from app_view_chat import RoomView
 from app_view_main import MainView
 from client import Client
+from config import CLIENT_CACHE_LOCATION, CLIENT_CACHE_SIZE
 from message import ListClientsMessage, ListRoomsMessage
 
 
@@ -31,13 +33,16 @@ class ChatWindow(QWidget):
         # Setup Client
         client = Client(address, port, nickname)
         client_id = client.client_id
-        client_thread = ClientThread(client)
+        cache = ResourceDiskCache(server_cache_location(CLIENT_CACHE_LOCATION, address, port), CLIENT_CACHE_SIZE)
+        client_thread = ClientThread(client, cache)
         client_thread.start()
 
         # Setup State
         self.app_state = AppState(client_thread, client_id)
         self.app_state.client_thread.discovered_client.connect(self.on_discover_client)
         self.app_state.client_thread.discovered_room.connect(self.on_discover_room)
+        self.app_state.client_thread.discovered_clients.connect(self.on_discover_clients)
+        self.app_state.client_thread.discovered_rooms.connect(self.on_discover_rooms)
 
         # Construct UI
         self.construct_ui()
@@ -57,6 +62,14 @@ class ChatWindow(QWidget):
         self.app_state.add_known_room(room_id, room_title, host_id, host_name)
         pass
 
+    def on_discover_clients(self, clients):
+        for (user_id, nickname) in clients:
+            self.app_state.add_known_client(user_id, nickname)
+
+    def on_discover_rooms(self, rooms):
+        for (room_id, room_title, host_id, host_name) in rooms:
+            self.app_state.add_known_room(room_id, room_title, host_id, host_name)
+
     def construct_ui(self):
         vbox = QVBoxLayout()
 
@@ -7,17 +7,23 @@ import sys
 from socket import *
 
 from config import INVALID_ID, SERVER_HOST, SERVER_PORT, CERTFILE
-from message import MessageType, NicknameMessage
-from socket_utils import send_message, recv_message
+from message import MessageType, NicknameMessage, PROTOCOL_V1, PROTOCOL_VERSION
+from socket_utils import send_message, FrameReader
 
 
 class Client:
     server_socket = None
     client_id = INVALID_ID
+    version = PROTOCOL_V1
 
     poller = None
+    reader = None
 
-    def __init__(self, address, port, nickname):
+    # Writing to wakeup_sender interrupts a blocking poll
+    wakeup_sender = None
+    wakeup_receiver = None
+
+    def __init__(self, address, port, nickname, version=PROTOCOL_VERSION):
         # Create SSL Context
         context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
         context.load_verify_locations(CERTFILE)
@@ -31,36 +37,82 @@ class Client:
         # Setup client socket connection
         self.server_socket.connect((address, port))
 
+        (self.wakeup_sender, self.wakeup_receiver) = socketpair()
+        self.wakeup_sender.setblocking(False)
+        self.wakeup_receiver.setblocking(False)
+
         self.poller = select.poll()
         self.poller.register(self.server_socket, select.POLLIN)
+        self.poller.register(self.wakeup_receiver, select.POLLIN)
 
         print('Connection established to src {}: {}'.format(address, port))
 
-        nick_message = NicknameMessage(nickname)
+        # Ask for the newest protocol version, the server picks which one to use
+        nick_message = NicknameMessage(nickname, version)
         send_message(self.server_socket, nick_message)
 
-        ack_message = recv_message(self.server_socket)
+        self.reader = FrameReader(self.server_socket)
+        ack_message = self.reader.read_message()
         self.client_id = ack_message.client_id
+        self.version = ack_message.version
 
         if self.client_id == INVALID_ID:
             raise Exception("Nickname is already taken")
 
-    def poll(self, dispatch_func):
-        # Poll socket for messages
-        events = self.poller.poll(0)
-
-        # Process messages
-        for sock, event in events:
-            if event and select.POLLIN:
-                msg = recv_message(self.server_socket)
-                dispatch_func(self.server_socket, msg)
+    def poll(self, dispatch_func, timeout=0):
+        # Waits up to timeout milliseconds (forever if None) for messages or
+        # a wakeup, and dispatches every message which has arrived. Returns
+        # False once the server has disconnected.
+        #
+        # Frames which have already been read into the buffer (or decrypted
+        # by TLS) do not make the socket readable, so they are handled
+        # without waiting.
+        if not self.reader.buffered():
+            readable = False
+
+            for (fd, _) in self.poller.poll(timeout):
+                if fd == self.wakeup_receiver.fileno():
+                    self.clear_wakeup()
+                else:
+                    readable = True
+
+            if not readable:
+                return True
+
+        # One read may buffer several frames, so handle all of them
+        while True:
+            msg = self.reader.read_message(self.version)
+            if msg is None:
+                return False
+
+            dispatch_func(self.server_socket, msg)
+
+            if not self.reader.buffered():
+                return True
+
+    def wake(self):
+        # Interrupts a blocking poll, from any thread
+        try:
+            self.wakeup_sender.send(b"\0")
+        except BlockingIOError:
+            # Plenty of wakeups are already pending
+            pass
+
+    def clear_wakeup(self):
+        try:
+            while self.wakeup_receiver.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
 
     def send_message(self, message):
-        send_message(self.server_socket, message)
+        send_message(self.server_socket, message, self.version)
 
     def __del__(self):
         # Cleanup
         self.server_socket.close()
+        self.wakeup_sender.close()
+        self.wakeup_receiver.close()
 
 
 def default_dispatch(server_socket, message):
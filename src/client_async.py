@@ -0,0 +1,313 @@
+# Asyncio Client
+# Name: Matthew Jakeman
+# UPI: mjak923
+
+import asyncio
+import datetime
+import hashlib
+import os
+import ssl
+from collections import deque
+
+from config import INVALID_ID, CERTFILE, HISTORY_PAGE_LIMIT, RESOURCE_CHUNK_SIZE, CLIENT_REQUEST_TIMEOUT, \
+    DOWNLOAD_WINDOW, PARTIAL_DOWNLOAD_SUFFIX
+from message import *
+
+
+# Asyncio Client:
+#
+# A headless client for bots and integrations, with no Qt and no thread of
+# its own, so one process can run many sessions on a single event loop.
+#
+#   client = AsyncClient("bot")
+#   await client.connect("localhost", 12000)
+#   room_id = await client.create_room("Bot Room")
+#   await client.send_text(room_id, "Hello")
+#
+#   async for message in client:
+#       ...
+#
+# Requests which have a reply (creating a room, fetching history or a
+# resource, ...) return it once it arrives. Replies carry no request id,
+# so a reply goes to the oldest request waiting for its type whose match
+# accepts it. Where a reply names what it is for (a room, an upload or a
+# resource), the match checks that, so a reply can't be taken by another
+# request. Otherwise pairing relies on the server replying in order.
+# Requests fail after request_timeout seconds, as the server drops some
+# requests (such as an invalid upload) without replying. Every other
+# message is passed to on_message, or if there is none, queued for the
+# async iterator.
+
+
+def create_client_context(cafile=CERTFILE):
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.load_verify_locations(cafile)
+    return context
+
+
+async def read_message(reader, version):
+    # As recv_message_async, without logging every message
+    header = await reader.readexactly(MESSAGE_HEADER_SIZE)
+    (length, msg_type, compressed) = parse_frame_header(header)
+
+    contents = await reader.readexactly(length) if length > 0 else None
+    if compressed:
+        contents = decompress_body(contents)
+
+    return parse_message_contents(msg_type, contents, version)
+
+
+class AsyncClient:
+    nickname = None
+    client_id = INVALID_ID
+    version = None
+
+    reader = None
+    writer = None
+    listener = None
+
+    # (reply types, match, future) for each request waiting for a reply, oldest first
+    waiting = None
+    request_timeout = None
+
+    # Messages which are not replies go to on_message, or the incoming queue
+    on_message = None
+    incoming = None
+
+    messages_sent = 0
+    messages_received = 0
+
+    def __init__(self, nickname, version=PROTOCOL_VERSION, on_message=None, request_timeout=CLIENT_REQUEST_TIMEOUT):
+        self.nickname = nickname
+        self.version = version
+        self.on_message = on_message
+        self.request_timeout = request_timeout
+
+        self.waiting = []
+        self.incoming = asyncio.Queue()
+
+    async def connect(self, host, port, context=None):
+        if context is None:
+            context = create_client_context()
+
+        (self.reader, self.writer) = await asyncio.open_connection(host, port, ssl=context, server_hostname=host)
+
+        # Logging in is always done in v1, and the server picks the version to use
+        self.writer.writelines(message_to_frame(NicknameMessage(self.nickname, self.version)))
+        ack_message = await read_message(self.reader, PROTOCOL_V1)
+
+        if ack_message.client_id == INVALID_ID:
+            self.writer.close()
+            raise Exception("Nickname is already taken")
+
+        self.client_id = ack_message.client_id
+        self.version = ack_message.version
+        self.listener = asyncio.get_running_loop().create_task(self.listen())
+
+    async def close(self):
+        if self.writer is None:
+            return
+
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except (ConnectionError, ssl.SSLError):
+            pass
+
+        if self.listener is not None:
+            await asyncio.gather(self.listener, return_exceptions=True)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, traceback):
+        await self.close()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        message = await self.incoming.get()
+        if message is None:
+            raise StopAsyncIteration
+
+        return message
+
+    async def send(self, message):
+        self.writer.writelines(message_to_frame(message, self.version))
+        self.messages_sent += 1
+
+        # Wait for the transport if the server is not keeping up
+        await self.writer.drain()
+
+    async def request(self, message, *reply_types, match=None):
+        # Sends a message and returns its reply, which is the first message
+        # of any of the reply types (and accepted by match, if given) to
+        # arrive after earlier requests' replies. Raises asyncio.TimeoutError
+        # if there is none within request_timeout.
+        future = asyncio.get_running_loop().create_future()
+        entry = (reply_types, match, future)
+        self.waiting.append(entry)
+
+        try:
+            await self.send(message)
+            return await asyncio.wait_for(future, self.request_timeout)
+        finally:
+            # Stop waiting for a reply which may never come
+            if entry in self.waiting:
+                self.waiting.remove(entry)
+
+    async def listen(self):
+        try:
+            while True:
+                message = await read_message(self.reader, self.version)
+                self.messages_received += 1
+                self.dispatch(message)
+        except (asyncio.IncompleteReadError, ConnectionError, ssl.SSLError):
+            pass
+        finally:
+            # Nothing else is coming, so fail any outstanding requests
+            for (_, _, future) in self.waiting:
+                if not future.done():
+                    future.set_exception(ConnectionError("Lost connection to the server"))
+
+            self.waiting = []
+            self.incoming.put_nowait(None)
+
+    def dispatch(self, message):
+        for (index, (reply_types, match, future)) in enumerate(self.waiting):
+            if message.message_type in reply_types and (match is None or match(message)):
+                del self.waiting[index]
+                if not future.done():
+                    future.set_result(message)
+                return
+
+        if self.on_message is not None:
+            self.on_message(message)
+        else:
+            self.incoming.put_nowait(message)
+
+    async def list_clients(self):
+        # Directory pages arrive as incoming messages
+        await self.send(ListClientsMessage())
+
+    async def list_rooms(self):
+        await self.send(ListRoomsMessage())
+
+    async def create_room(self, title):
+        ack_message = await self.request(RoomCreateMessage(self.client_id, title), MessageType.ACKNOWLEDGE_ROOM_CREATE)
+        return ack_message.room_id
+
+    async def invite(self, room_id, client_id):
+        # Only the host of a room can invite people to it
+        await self.send(RoomInviteMessage(room_id, client_id))
+
+    async def start_chat(self, user_id):
+        # Returns the id of the direct chat room with another user
+        ack_message = await self.request(InitiateUserChatMessage(user_id), MessageType.ACKNOWLEDGE_USER_CHAT,
+                                         match=lambda reply: reply.user_id == user_id)
+        return ack_message.room_id
+
+    async def send_text(self, room_id, text, resource_id=INVALID_ID):
+        await self.send(RoomEntrySendMessage(room_id, text, datetime.datetime.now(), resource_id))
+
+    async def fetch_history(self, room_id, cursor=INVALID_ID, count=HISTORY_PAGE_LIMIT, direction=HISTORY_BEFORE):
+        # Returns (offset of the first message, RoomEntryBroadcastMessages)
+        reply = await self.request(HistoryFetchMessage(room_id, cursor, count, direction), MessageType.HISTORY_BATCH,
+                                   match=lambda reply: reply.room_id == room_id)
+        return reply.first_offset, reply.messages(self.version)
+
+    async def upload_resource(self, data):
+        # Uploads in chunks (resuming a previous upload of the same data)
+        # and returns the new resource's id
+        digest = hashlib.sha256(data).hexdigest()
+
+        def match(reply):
+            return reply.message_type == MessageType.ACKNOWLEDGE_RESOURCE or reply.digest == digest
+
+        reply = await self.request(ResourceUploadBeginMessage(digest, len(data)), MessageType.RESOURCE_UPLOAD_ACK,
+                                   match=match)
+
+        while True:
+            offset = reply.offset
+
+            if offset >= len(data):
+                reply = await self.request(ResourceUploadEndMessage(digest),
+                                           MessageType.ACKNOWLEDGE_RESOURCE, MessageType.RESOURCE_UPLOAD_ACK,
+                                           match=match)
+
+                if reply.message_type == MessageType.ACKNOWLEDGE_RESOURCE:
+                    return reply.resource_id
+
+                # The server's copy was corrupt, and the ack says where to restart
+                continue
+
+            chunk = ResourceUploadChunkMessage(digest, offset, data[offset:offset + RESOURCE_CHUNK_SIZE])
+            reply = await self.request(chunk, MessageType.RESOURCE_UPLOAD_ACK, match=match)
+
+    async def fetch_chunks(self, resource_id, variant, offset):
+        # Yields the chunks of a variant of a resource from offset, with up
+        # to DOWNLOAD_WINDOW chunks asked for at once. Only the first is
+        # asked for until the size is known.
+        pending = deque()
+        next_offset = offset
+        total = None
+
+        def match_offset(chunk_offset):
+            return lambda reply: (reply.resource_id, reply.variant, reply.offset) == (resource_id, variant, chunk_offset)
+
+        try:
+            while True:
+                while (total is None and not pending) or \
+                        (total is not None and next_offset < total and len(pending) < DOWNLOAD_WINDOW):
+                    request = self.request(ResourceDownloadMessage(resource_id, next_offset, variant),
+                                           MessageType.RESOURCE_CHUNK, match=match_offset(next_offset))
+                    pending.append(asyncio.ensure_future(request))
+                    next_offset += RESOURCE_CHUNK_SIZE
+
+                if not pending:
+                    return
+
+                chunk = await pending.popleft()
+                total = chunk.total
+                yield chunk
+
+                if len(chunk.data) == 0:
+                    return
+        finally:
+            # Stop waiting for chunks no longer wanted
+            for request in pending:
+                request.cancel()
+
+    async def fetch_resource(self, resource_id, variant=RESOURCE_ORIGINAL):
+        # Downloads a variant of a resource into memory
+        data = bytearray()
+
+        async for chunk in self.fetch_chunks(resource_id, variant, 0):
+            data += chunk.data
+
+        return bytes(data)
+
+    async def download_resource(self, resource_id, path, variant=RESOURCE_ORIGINAL):
+        # Downloads a variant of a resource to path, through a partial file
+        # which is kept if the download is interrupted, so calling this again
+        # carries on from where it stopped. Returns the size of the resource.
+        loop = asyncio.get_running_loop()
+        partial_path = path + PARTIAL_DOWNLOAD_SUFFIX
+
+        with open(partial_path, "ab") as file:
+            size = file.tell()
+            total = size
+
+            async for chunk in self.fetch_chunks(resource_id, variant, size):
+                await loop.run_in_executor(None, file.write, chunk.data)
+                size += len(chunk.data)
+                total = chunk.total
+
+        if size != total:
+            # The partial file doesn't match the resource, so start again next time
+            os.remove(partial_path)
+            raise ValueError(f"Download of resource {resource_id} stopped at {size} of {total} bytes")
+
+        os.replace(partial_path, path)
+        return size
@@ -5,9 +5,105 @@
 SERVER_HOST = 'localhost'
 SERVER_PORT = 12000
 
+# Either 'threaded' (one thread per client) or 'asyncio' (single event loop)
+SERVER_ENGINES = ['threaded', 'asyncio']
+SERVER_ENGINE = 'threaded'
+
+# Worker processes sharing the server port (SO_REUSEPORT), and the Unix
+# socket used by the workers to share state with each other
+SERVER_WORKERS = 1
+BUS_SOCKET_PATH = "server-bus.sock"
+
+# Deadlines (in seconds) for each stage of accepting a connection
+HANDSHAKE_TIMEOUT = 5.0
+LOGIN_TIMEOUT = 5.0
+
+# Connections in the handshake or login stages beyond this are refused
+MAX_PENDING_LOGINS = 256
+
 INVALID_ID = -1
 DIRECT_CHAT_ROOM_ID = INVALID_ID
 RESOURCE_LOCATION = "res"
 
+# Memory used to cache popular resources on the server, in bytes
+RESOURCE_CACHE_SIZE = 64 * 1024 * 1024
+
+# Image previews fit within this size (width, height) in pixels, and are
+# saved as JPEG at this quality (1 to 95)
+RESOURCE_PREVIEW_SIZE = (300, 200)
+RESOURCE_PREVIEW_QUALITY = 85
+
+# Resources are uploaded and downloaded in chunks of at most this many bytes.
+# Clients keep up to DOWNLOAD_WINDOW chunk requests in flight, and write
+# downloads to a file with PARTIAL_DOWNLOAD_SUFFIX added to its name until
+# they finish, so an interrupted download carries on from where it stopped.
+RESOURCE_CHUNK_SIZE = 256 * 1024
+DOWNLOAD_WINDOW = 4
+PARTIAL_DOWNLOAD_SUFFIX = ".partial"
+
+# Largest resource which may be uploaded, in bytes. Uploads left unfinished
+# for PARTIAL_UPLOAD_EXPIRY seconds are deleted, checked every
+# PARTIAL_UPLOAD_CHECK_INTERVAL seconds.
+MAX_UPLOAD_SIZE = 64 * 1024 * 1024
+PARTIAL_UPLOAD_EXPIRY = 24 * 60 * 60
+PARTIAL_UPLOAD_CHECK_INTERVAL = 60 * 60
+
+# Largest frame body (in bytes) the server reads from a client, with room
+# for a resource of MAX_UPLOAD_SIZE sent in one message. Until a client has
+# logged in, only its nickname is expected, so the limit is much smaller.
+MAX_FRAME_SIZE = MAX_UPLOAD_SIZE + 64 * 1024
+MAX_LOGIN_FRAME_SIZE = 4 * 1024
+
+# Room history is kept in a segmented log per room. Segments roll over
+# once they reach LOG_SEGMENT_SIZE bytes, and every LOG_INDEX_INTERVAL'th
+# record is indexed. Appends are synced to disk by a background thread,
+# once a log has LOG_SYNC_BATCH unsynced records or after LOG_SYNC_INTERVAL
+# seconds.
+HISTORY_LOCATION = "history"
+LOG_SEGMENT_SIZE = 16 * 1024 * 1024
+LOG_INDEX_INTERVAL = 64
+LOG_SYNC_BATCH = 32
+LOG_SYNC_INTERVAL = 1.0
+
+# Room logs holding their files open (two each), the least recently
+# written are closed beyond this
+MAX_OPEN_LOGS = 256
+
+# Most messages returned for a single history fetch
+HISTORY_PAGE_LIMIT = 200
+
 CERTFILE = "certs/cert.pem"
 KEYFILE = "certs/cert.key"
+
+# Outbound queue limits for each client, in frames and bytes
+OUTBOUND_QUEUE_LIMIT = 1024
+OUTBOUND_HIGH_WATER = 8 * 1024 * 1024
+
+# What to do once a client's outbound queue reaches its limit:
+# 'drop', 'coalesce' or 'disconnect'
+SLOW_CONSUMER_POLICIES = ['drop', 'coalesce', 'disconnect']
+SLOW_CONSUMER_POLICY = 'disconnect'
+
+# Most entries sent in a single client or room directory message
+DIRECTORY_PAGE_SIZE = 1000
+
+# Message bodies of at least this many bytes are compressed for clients
+# which support it, at this zlib level (1 is fastest, 9 is smallest)
+COMPRESSION_THRESHOLD = 512
+COMPRESSION_LEVEL = 6
+
+# Metrics are served to local scrapers at http://METRICS_HOST:METRICS_PORT/metrics
+# (with the worker index added to the port), 0 disables them
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9464
+
+# Resources downloaded by the GUI client are cached on disk (per server)
+# up to this many bytes, evicting the least recently used. Downloads left
+# unfinished for PARTIAL_DOWNLOAD_EXPIRY seconds are deleted at startup.
+CLIENT_CACHE_LOCATION = "cache"
+CLIENT_CACHE_SIZE = 256 * 1024 * 1024
+PARTIAL_DOWNLOAD_EXPIRY = 24 * 60 * 60
+
+# Requests made by the asyncio client fail if the server has not replied
+# within this many seconds
+CLIENT_REQUEST_TIMEOUT = 30.0
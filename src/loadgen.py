@@ -0,0 +1,294 @@
+# Load Generator
+# Name: Matthew Jakeman
+# UPI: mjak923
+
+import argparse
+import asyncio
+import os
+import random
+import time
+
+from client_async import AsyncClient, create_client_context
+from config import INVALID_ID, SERVER_HOST, SERVER_PORT
+from message import *
+
+# Load Generator:
+#
+# Simulates many users against a running server from a single process,
+# with one asyncio connection per user. Users log in (at up to
+# --connect-rate per second), are grouped into rooms of --room-size
+# members, and then each performs a random action from the mix about
+# --action-rate times a second:
+#  - chat: sends a message to one of its rooms
+#  - create: creates a room and invites another user to it
+#  - invite: invites another user to one of the rooms it hosts
+#  - upload: uploads a unique copy of an image and sends it to one of its rooms
+#
+# Every chat message carries the time it was sent, so each member that
+# receives it records the delivery latency. Users are AsyncClients, so
+# the load generator also exercises the client library.
+
+LOAD_TEXT_PREFIX = "load "
+DEFAULT_MIX = "chat=90,create=2,invite=3,upload=5"
+PERCENTILES = [50, 99, 99.9]
+UPLOAD_SUFFIX_SIZE = 16
+
+
+def parse_mix(mix):
+    # "chat=90,upload=10" -> {"chat": 90, "upload": 10}
+    weights = {}
+
+    for item in mix.split(","):
+        (action, weight) = item.split("=")
+        if action not in ACTIONS:
+            raise ValueError(f"Unknown action '{action}'")
+
+        weights[action] = float(weight)
+
+    return weights
+
+
+def percentile(sorted_values, percent):
+    if not sorted_values:
+        return 0
+
+    index = min(len(sorted_values) - 1, int(len(sorted_values) * percent / 100))
+    return sorted_values[index]
+
+
+class LoadStats:
+    connect_times = None
+    latencies = None
+
+    sent = 0
+    received = 0
+    delivered = 0
+    errors = 0
+
+    def __init__(self):
+        self.connect_times = []
+        self.latencies = []
+
+    def report(self, users, connect_duration, run_duration):
+        print(f"Users:        {len(self.connect_times)} of {users} connected, {self.errors} errors")
+
+        if connect_duration > 0:
+            connect_times = sorted(self.connect_times)
+            print(f"Connections:  {len(connect_times) / connect_duration:.1f}/s, "
+                  f"setup p50 {percentile(connect_times, 50) * 1000:.1f}ms, "
+                  f"p99 {percentile(connect_times, 99) * 1000:.1f}ms")
+
+        if run_duration > 0:
+            print(f"Messages:     {self.sent / run_duration:.1f}/s sent, {self.received / run_duration:.1f}/s received, "
+                  f"{self.delivered / run_duration:.1f}/s chat deliveries")
+
+        latencies = sorted(self.latencies)
+        summary = ", ".join(f"p{percent:g} {percentile(latencies, percent) * 1000:.2f}ms" for percent in PERCENTILES)
+        print(f"Latency:      {summary} ({len(latencies)} deliveries)")
+
+
+class SimulatedUser:
+    client = None
+    stats = None
+
+    # Rooms this user is a member of, and those it hosts
+    rooms = None
+    hosted_rooms = None
+
+    def __init__(self, nickname, version, stats):
+        self.client = AsyncClient(nickname, version, self.handle)
+        self.stats = stats
+
+        self.rooms = []
+        self.hosted_rooms = []
+
+    @property
+    def nickname(self):
+        return self.client.nickname
+
+    async def connect(self, host, port, context):
+        start = time.perf_counter()
+        await self.client.connect(host, port, context)
+        self.stats.connect_times.append(time.perf_counter() - start)
+
+    def handle(self, message):
+        msg_type = message.message_type
+
+        if msg_type == MessageType.ROOM_MESSAGE_BROADCAST and message.text.startswith(LOAD_TEXT_PREFIX):
+            sent_at = float(message.text[len(LOAD_TEXT_PREFIX):])
+            self.stats.latencies.append(time.perf_counter() - sent_at)
+            self.stats.delivered += 1
+        elif msg_type == MessageType.ROOM_DISCOVERY and message.room_id not in self.rooms:
+            self.rooms.append(message.room_id)
+
+    async def create_room(self, title):
+        room_id = await self.client.create_room(title)
+
+        self.rooms.append(room_id)
+        self.hosted_rooms.append(room_id)
+        return room_id
+
+    async def invite(self, room_id, user):
+        await self.client.invite(room_id, user.client.client_id)
+
+    async def chat(self, room_id, resource_id=INVALID_ID):
+        await self.client.send_text(room_id, f"{LOAD_TEXT_PREFIX}{time.perf_counter()}", resource_id)
+
+    async def upload(self, data):
+        return await self.client.upload_resource(data)
+
+
+async def do_chat(user, users, image):
+    if user.rooms:
+        await user.chat(random.choice(user.rooms))
+
+
+async def do_create(user, users, image):
+    room_id = await user.create_room(f"Room of {user.nickname}")
+    await user.invite(room_id, random.choice(users))
+
+
+async def do_invite(user, users, image):
+    if user.hosted_rooms:
+        await user.invite(random.choice(user.hosted_rooms), random.choice(users))
+
+
+async def do_upload(user, users, image):
+    if user.rooms:
+        # The store keeps one copy of identical uploads, so each one ends
+        # in random bytes (which image decoders ignore) to make it unique
+        resource_id = await user.upload(image + os.urandom(UPLOAD_SUFFIX_SIZE))
+        await user.chat(random.choice(user.rooms), resource_id)
+
+
+ACTIONS = {
+    "chat": do_chat,
+    "create": do_create,
+    "invite": do_invite,
+    "upload": do_upload,
+}
+
+
+async def connect_users(args, stats, context):
+    # Starts connections at up to connect_rate per second, with their
+    # setup overlapping
+    users = []
+    tasks = []
+    start = time.perf_counter()
+
+    async def connect(user):
+        try:
+            await user.connect(args.host, args.port, context)
+            users.append(user)
+        except Exception as e:
+            stats.errors += 1
+            print(f"WARN: {user.nickname} failed to connect: {e}")
+
+    for index in range(args.users):
+        user = SimulatedUser(f"{args.prefix}{index}", args.version, stats)
+        tasks.append(asyncio.create_task(connect(user)))
+
+        # Sleep until the next connection is due
+        delay = start + (index + 1) / args.connect_rate - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    await asyncio.gather(*tasks)
+    return users, time.perf_counter() - start
+
+
+async def setup_rooms(users, room_size):
+    # The first user of each group hosts a room and invites the rest
+    async def setup(group):
+        room_id = await group[0].create_room(f"Room of {group[0].nickname}")
+        for user in group[1:]:
+            await group[0].invite(room_id, user)
+
+    groups = [users[start:start + room_size] for start in range(0, len(users), room_size)]
+    await asyncio.gather(*[setup(group) for group in groups])
+
+
+async def run_user(user, users, args, weights, image, deadline):
+    actions = [ACTIONS[action] for action in weights]
+    action_weights = list(weights.values())
+
+    while True:
+        # Actions arrive as a Poisson process at action_rate per second
+        delay = random.expovariate(args.action_rate)
+        if time.perf_counter() + delay >= deadline:
+            return
+
+        await asyncio.sleep(delay)
+
+        action = random.choices(actions, action_weights)[0]
+        try:
+            await action(user, users, image)
+        except ConnectionError:
+            return
+        except asyncio.TimeoutError:
+            print(f"WARN: {user.nickname} got no reply from the server")
+
+
+async def run(args):
+    weights = parse_mix(args.mix)
+
+    # Random bytes, which like a real image do not compress
+    image = os.urandom(args.image_size)
+    if args.image is not None:
+        with open(args.image, "rb") as image_file:
+            image = image_file.read()
+
+    context = create_client_context()
+
+    stats = LoadStats()
+    (users, connect_duration) = await connect_users(args, stats, context)
+    print(f"STATUS: Connected {len(users)} users in {connect_duration:.2f}s")
+
+    if users:
+        await setup_rooms(users, args.room_size)
+
+        # Let the invites arrive before measuring
+        await asyncio.sleep(args.settle)
+
+    sent = sum(user.client.messages_sent for user in users)
+    received = sum(user.client.messages_received for user in users)
+    stats.delivered = 0
+    start = time.perf_counter()
+    deadline = start + args.duration
+
+    await asyncio.gather(*[run_user(user, users, args, weights, image, deadline) for user in users])
+
+    # Wait for messages still in flight
+    await asyncio.sleep(args.settle)
+    run_duration = time.perf_counter() - start
+
+    stats.sent = sum(user.client.messages_sent for user in users) - sent
+    stats.received = sum(user.client.messages_received for user in users) - received
+
+    await asyncio.gather(*[user.client.close() for user in users])
+
+    stats.report(args.users, connect_duration, run_duration)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulates many users against a running server")
+    parser.add_argument("--host", default=SERVER_HOST)
+    parser.add_argument("--port", type=int, default=SERVER_PORT)
+    parser.add_argument("--users", type=int, default=100, help="number of simulated users")
+    parser.add_argument("--connect-rate", type=float, default=200, help="new connections per second")
+    parser.add_argument("--room-size", type=int, default=10, help="users in each room set up at the start")
+    parser.add_argument("--action-rate", type=float, default=1, help="actions per second for each user")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="relative weight of each action")
+    parser.add_argument("--duration", type=float, default=10, help="seconds to run for after setup")
+    parser.add_argument("--settle", type=float, default=1, help="seconds to wait for messages in flight")
+    parser.add_argument("--image", help="image to upload, instead of random data")
+    parser.add_argument("--image-size", type=int, default=64 * 1024, help="bytes of random data to upload")
+    parser.add_argument("--prefix", default="load", help="prefix for the users' nicknames")
+    parser.add_argument("--version", type=int, default=PROTOCOL_VERSION, help="protocol version to ask for")
+    args = parser.parse_args()
+
+    asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
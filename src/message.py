@@ -2,13 +2,44 @@
 # Name: Matthew Jakeman
 # UPI: mjak923
 import datetime
+import struct
+import zlib
 from enum import IntEnum
 
-from config import INVALID_ID
+from config import INVALID_ID, COMPRESSION_THRESHOLD, COMPRESSION_LEVEL
 
 SEPERATOR_TOKEN = chr(0xFFFF)
+SEPERATOR_BYTES = SEPERATOR_TOKEN.encode()
+
+# v1 has no way to escape the separator, so strings arriving in the binary
+# encoding have it replaced. Anything the server relays or logs can then
+# still be sent to v1 clients.
+SEPERATOR_REPLACEMENT = chr(0xFFFD)
 MESSAGE_HEADER_SIZE = 8
 
+# History fetch directions, relative to the cursor
+HISTORY_BEFORE = 0
+HISTORY_AFTER = 1
+
+# Resource variants a client can download. The preview is a scaled down
+# copy of an image, or the original if the server cannot make one.
+RESOURCE_ORIGINAL = 0
+RESOURCE_PREVIEW = 1
+RESOURCE_VARIANTS = [RESOURCE_ORIGINAL, RESOURCE_PREVIEW]
+
+# Protocol versions, negotiated at login
+PROTOCOL_V1 = 1
+PROTOCOL_V2 = 2
+PROTOCOL_V3 = 3
+PROTOCOL_VERSION = PROTOCOL_V3
+
+# Set in the type byte of a frame whose body is compressed
+COMPRESSED_FLAG = 0x80
+MESSAGE_TYPE_MASK = 0x7F
+
+# Most bytes a compressed body may expand to
+MAX_DECOMPRESSED_SIZE = 64 * 1024 * 1024
+
 
 # Message Protocol:
 #
@@ -22,6 +53,22 @@ MESSAGE_HEADER_SIZE = 8
 #
 # The content encoding depends on the message and will have
 # a length of exactly 'length' bits.
+#
+# There are two content encodings:
+#  - v1: fields as text, joined by SEPERATOR_TOKEN
+#  - v2: binary fields (see encode_binary), with variable length integers,
+#    timestamps in microseconds since the epoch, and length-prefixed strings
+#
+# v3 uses the v2 encoding, but bodies of at least COMPRESSION_THRESHOLD
+# bytes may be compressed with zlib (using COMPRESSION_DICTIONARY). This is
+# signalled by COMPRESSED_FLAG in the frame's type byte, so message types
+# must stay below 128. Messages carrying resource data (which is already
+# compressed) are never compressed.
+#
+# A client asks for v2 by adding its version to the NicknameMessage, and the
+# server replies with the version to use in the AcknowledgeClientMessage.
+# Both of these are always encoded as v1, so older clients and servers
+# (which send no version) keep using v1.
 
 
 class MessageType(IntEnum):
@@ -43,7 +90,31 @@ class MessageType(IntEnum):
     RESOURCE_FETCH = 16,
     RESOURCE_TRANSFER = 17,
     ROOM_MEMBERSHIP_DISCOVERY = 18,
-    LIST_ROOM_MEMBERS = 19
+    LIST_ROOM_MEMBERS = 19,
+    CLIENT_DEPARTURE = 20,
+    HISTORY_FETCH = 21,
+    HISTORY_BATCH = 22,
+    RESOURCE_UPLOAD_BEGIN = 23,
+    RESOURCE_UPLOAD_ACK = 24,
+    RESOURCE_UPLOAD_CHUNK = 25,
+    RESOURCE_UPLOAD_END = 26,
+    RESOURCE_DOWNLOAD = 27,
+    RESOURCE_CHUNK = 28,
+    CLIENT_DIRECTORY = 29,
+    ROOM_DIRECTORY = 30
+
+
+# Preset dictionary for compressed bodies, made of patterns found in most
+# compressible messages: the high zero bytes of frame headers, v1
+# separators and timestamps, and the headers of the room entries in a
+# history batch. Both ends must use the same dictionary, so changing it
+# needs a new protocol version.
+COMPRESSION_DICTIONARY = b"".join([
+    bytes(16),
+    b"-01 00:00:00.000000",
+    SEPERATOR_BYTES + b"-1" + SEPERATOR_BYTES,
+    bytes(6) + bytes([MessageType.ROOM_MESSAGE_BROADCAST]),
+])
 
 
 def build_message_header(length, msg_type):
@@ -51,121 +122,354 @@ def build_message_header(length, msg_type):
     return header.to_bytes(MESSAGE_HEADER_SIZE, byteorder='big')
 
 
-def parse_message_header(header):
+def parse_frame_header(header):
+    # Returns the length, message type and whether the body is compressed
     integer_val = int.from_bytes(header, byteorder='big')
 
     length = (integer_val >> 8)
-    msg_type = integer_val & 0b11111111
-    return length, MessageType(msg_type)
+    msg_type = integer_val & MESSAGE_TYPE_MASK
+    compressed = (integer_val & COMPRESSED_FLAG) != 0
+    return length, MessageType(msg_type), compressed
 
 
-def message_to_wire(message):
-    message_data = message.to_bytes()
-    msg_type = message.message_type
+def parse_message_header(header):
+    (length, msg_type, _) = parse_frame_header(header)
+    return length, msg_type
 
-    if message_data:
-        message_bytes = bytearray(message_data)
 
-        length = len(message_bytes)
-        header = build_message_header(length, msg_type)
-        message_bytes[:0] = header  # prepend to byte array
+def compress_body(body):
+    compressor = zlib.compressobj(COMPRESSION_LEVEL, zdict=COMPRESSION_DICTIONARY)
+    return compressor.compress(body) + compressor.flush()
 
-        return message_bytes
-    else:
-        header = build_message_header(0, msg_type)
-        return header
 
+def decompress_body(body):
+    decompressor = zlib.decompressobj(zdict=COMPRESSION_DICTIONARY)
+    data = decompressor.decompress(body, MAX_DECOMPRESSED_SIZE)
+
+    if decompressor.unconsumed_tail:
+        raise ValueError("Compressed message is too large")
+
+    return data
+
+
+def negotiate_version(requested):
+    # The newest version both sides support. The client's version is only
+    # a number it sent, so anything below v1 is treated as v1.
+    return max(PROTOCOL_V1, min(requested, PROTOCOL_VERSION))
+
+
+def message_body(message, version=PROTOCOL_V1):
+    if version == PROTOCOL_V1 or message.layout is None:
+        return message.to_bytes()
+
+    return encode_binary(message)
+
+
+def body_to_frame(msg_type, body):
+    # A frame is a tuple of buffers, the header followed by the body (if
+    # any), so the body never has to be copied to put a header in front
+    if not body:
+        return (build_message_header(0, msg_type),)
+
+    return build_message_header(len(body), msg_type), body
+
+
+def frame_size(frame):
+    return sum(len(buffer) for buffer in frame)
+
+
+def message_to_frame(message, version=PROTOCOL_V1):
+    body = message_body(message, version)
+
+    # Small bodies are not worth the time it takes to compress them
+    if version >= PROTOCOL_V3 and message.compressible and body and len(body) >= COMPRESSION_THRESHOLD:
+        compressed = compress_body(body)
+        if len(compressed) < len(body):
+            return body_to_frame(message.message_type | COMPRESSED_FLAG, compressed)
+
+    return body_to_frame(message.message_type, body)
 
-def parse_message_contents(message_type, byte_data):
-    if message_type == MessageType.NICKNAME:
-        return NicknameMessage(byte_data.decode())
-    elif message_type == MessageType.ACKNOWLEDGE_CLIENT:
-        client_id = int(byte_data.decode())
-        return AcknowledgeClientMessage(client_id)
-    elif message_type == MessageType.LIST_CLIENTS:
-        return ListClientsMessage()
-    elif message_type == MessageType.CLIENT_DISCOVERY:
-        tokens = byte_data.decode().split(SEPERATOR_TOKEN)
-        client_id = int(tokens[0])
-        nickname = tokens[1]
-        return ClientDiscoveryMessage(client_id, nickname)
-    elif message_type == MessageType.LIST_ROOMS:
-        return ListRoomsMessage()
-    elif message_type == MessageType.ROOM_DISCOVERY:
-        tokens = byte_data.decode().split(SEPERATOR_TOKEN)
-        room_id = int(tokens[0])
-        title = tokens[1]
-        host_id = int(tokens[2])
-        host_name = tokens[3]
-        return RoomDiscoveryMessage(room_id, title, host_id, host_name)
-    elif message_type == MessageType.ROOM_CREATE:
-        tokens = byte_data.decode().split(SEPERATOR_TOKEN)
-        host_id = int(tokens[0])
-        title = tokens[1]
-        return RoomCreateMessage(host_id, title)
-    elif message_type == MessageType.ACKNOWLEDGE_ROOM_CREATE:
-        room_id = int(byte_data.decode())
-        return AcknowledgeRoomCreateMessage(room_id)
-    elif message_type == MessageType.ROOM_INVITE:
-        tokens = byte_data.decode().split(SEPERATOR_TOKEN)
-        room_id = int(tokens[0])
-        client_id = int(tokens[1])
-        return RoomInviteMessage(room_id, client_id)
-    elif message_type == MessageType.INITIATE_USER_CHAT:
-        user_id = int(byte_data.decode())
-        return InitiateUserChatMessage(user_id)
-    elif message_type == MessageType.ACKNOWLEDGE_USER_CHAT:
-        tokens = byte_data.decode().split(SEPERATOR_TOKEN)
-        room_id = int(tokens[0])
-        user_id = int(tokens[1])
-        user_nick = tokens[2]
-        return AcknowledgeUserChatMessage(room_id, user_id, user_nick)
-    elif message_type == MessageType.ROOM_MESSAGE_SEND:
-        tokens = byte_data.decode().split(SEPERATOR_TOKEN)
-        room_id = int(tokens[0])
-        text = tokens[1]
-        timestamp = datetime.datetime.fromisoformat(tokens[2])
-        resource_id = int(tokens[3])
-        return RoomEntrySendMessage(room_id, text, timestamp, resource_id)
-    elif message_type == MessageType.ROOM_MESSAGE_BROADCAST:
-        tokens = byte_data.decode().split(SEPERATOR_TOKEN)
-        room_id = int(tokens[0])
-        text = tokens[1]
-        timestamp = datetime.datetime.fromisoformat(tokens[2])
-        user_id = int(tokens[3])
-        resource_id = int(tokens[4])
-        return RoomEntryBroadcastMessage(room_id, text, timestamp, user_id, resource_id)
-    elif message_type == MessageType.RESOURCE_CREATE:
-        return ResourceCreateMessage(byte_data)
-    elif message_type == MessageType.ACKNOWLEDGE_RESOURCE:
-        resource_id = int(byte_data.decode())
-        return AcknowledgeResourceMessage(resource_id)
-    elif message_type == MessageType.RESOURCE_FETCH:
-        resource_id = int(byte_data.decode())
-        return ResourceFetchMessage(resource_id)
-    elif message_type == MessageType.RESOURCE_TRANSFER:
-        return ResourceTransferMessage(byte_data)
-    elif message_type == MessageType.ROOM_MEMBERSHIP_DISCOVERY:
-        members = byte_data.decode().split(SEPERATOR_TOKEN)
-        members = [int(client_id) for client_id in members]
-        host_id = members[0]
-        members = members[1:]
-        return RoomMembershipDiscoveryMessage(host_id, members)
-    elif message_type == MessageType.LIST_ROOM_MEMBERS:
-        room_id = int(byte_data.decode())
-        return ListRoomMembersMessage(room_id)
 
+def message_to_wire(message, version=PROTOCOL_V1):
+    # The frame as one contiguous buffer
+    return b"".join(message_to_frame(message, version))
+
+
+def parse_message_contents(message_type, byte_data, version=PROTOCOL_V1):
+    message_class = MESSAGE_CLASSES[message_type]
+
+    if version != PROTOCOL_V1 and message_class.layout is not None:
+        return decode_binary(message_class, byte_data)
+
+    return message_class.from_bytes(byte_data)
+
+
+def split_records(byte_data):
+    # Splits concatenated wire messages into a list of records
+    records = []
+    position = 0
+
+    while position < len(byte_data):
+        (length, _) = parse_message_header(byte_data[position:position + MESSAGE_HEADER_SIZE])
+        end = position + MESSAGE_HEADER_SIZE + length
+        records.append(byte_data[position:end])
+        position = end
+
+    return records
+
+
+def owned_data(byte_data, position=0):
+    # Raw data for a message to keep. Frames in a FrameReader's shared
+    # buffer arrive as memoryviews which are reused by the next read, so
+    # they are copied, but a frame with a buffer of its own is kept as is.
+    if byte_data is None:
+        return None
+
+    if isinstance(byte_data, memoryview):
+        return bytes(byte_data[position:])
+
+    if position == 0:
+        return byte_data
+
+    return memoryview(byte_data)[position:]
+
+
+def parse_message(byte_data, version=PROTOCOL_V1):
+    (_, msg_type, compressed) = parse_frame_header(byte_data[0:MESSAGE_HEADER_SIZE])
+    contents = byte_data[MESSAGE_HEADER_SIZE:]
+
+    if compressed:
+        contents = decompress_body(contents)
+
+    return parse_message_contents(msg_type, contents, version)
+
+
+# Binary (v2) Encoding:
+#
+# Each message class declares its layout as a list of (attribute, field type)
+# pairs, in the order of its constructor arguments. Field types:
+#  - FIELD_INT: signed 64-bit integer
+#  - FIELD_STR: UTF-8 string, prefixed with its length
+#  - FIELD_TIME: naive datetime as microseconds since the epoch (aware
+#    datetimes are converted to UTC)
+#  - FIELD_INTS: list of integers, prefixed with the count and the width
+#    (1, 2, 4 or 8 bytes) of the smallest signed big endian integer which
+#    fits them all, so a long list is packed in one go
+#  - FIELD_DATA: raw bytes, running to the end of the message
+#  - FIELD_RECORDS: concatenated wire messages, running to the end. Records
+#    are stored as v1 messages (see server_log.py), and are converted to
+#    the binary encoding when sent.
+#  - a list of field types: list of rows (tuples) with those fields,
+#    prefixed with the count
+#
+# Integers (including lengths and counts) are variable length, 7 bits to a
+# byte with the low bits first and the top bit set on all but the last
+# byte, so the small ids and lengths in most messages take a byte or two.
+# Signed values are zigzag encoded first (0, -1, 1, -2, ... as 0, 1, 2,
+# 3, ...), so INVALID_ID takes one byte too. FIELD_DATA and FIELD_RECORDS
+# may only be last.
 
-def parse_message(byte_data):
-    (_, msg_type) = parse_message_header(byte_data[0:MESSAGE_HEADER_SIZE])
-    return parse_message_contents(msg_type, byte_data[MESSAGE_HEADER_SIZE:])
+FIELD_INT = 0
+FIELD_STR = 1
+FIELD_TIME = 2
+FIELD_INTS = 3
+FIELD_DATA = 4
+FIELD_RECORDS = 5
+
+SMALL_VARINTS = [bytes([value]) for value in range(0x80)]
+MAX_VARINT_SHIFT = 63
+
+# Width in bytes -> struct format character, narrowest first
+INT_WIDTHS = {1: "b", 2: "h", 4: "i", 8: "q"}
+
+EPOCH = datetime.datetime(1970, 1, 1)
+MICROSECOND = datetime.timedelta(microseconds=1)
+
+
+def timestamp_to_micros(timestamp):
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+
+    return (timestamp - EPOCH) // MICROSECOND
+
+
+def encode_varint(value):
+    # Unsigned
+    if value < 0x80:
+        return SMALL_VARINTS[value]
+
+    encoded = bytearray()
+    while value >= 0x80:
+        encoded.append((value & 0x7F) | 0x80)
+        value >>= 7
+
+    encoded.append(value)
+    return bytes(encoded)
+
+
+def encode_signed(value):
+    return encode_varint(value << 1 if value >= 0 else (-value << 1) - 1)
+
+
+def encode_ints(values):
+    low = min(values, default=0)
+    high = max(values, default=0)
+
+    for (width, code) in INT_WIDTHS.items():
+        limit = 1 << (8 * width - 1)
+        if -limit <= low and high < limit:
+            break
+
+    return encode_varint(len(values)) + SMALL_VARINTS[width] + struct.pack(f">{len(values)}{code}", *values)
+
+
+def decode_ints(byte_data, position):
+    (count, position) = decode_varint(byte_data, position)
+    (width, position) = decode_varint(byte_data, position)
+
+    code = INT_WIDTHS.get(width)
+    if code is None:
+        raise ValueError(f"Invalid integer width {width}")
+
+    try:
+        values = list(struct.unpack_from(f">{count}{code}", byte_data, position))
+    except struct.error:
+        raise ValueError("Message ends part way through a list of integers")
+
+    return values, position + count * width
+
+
+def decode_varint(byte_data, position):
+    # Returns the (unsigned) value and the position after it
+    try:
+        byte = byte_data[position]
+        if byte < 0x80:
+            return byte, position + 1
+
+        value = byte & 0x7F
+        shift = 7
+
+        while True:
+            position += 1
+            byte = byte_data[position]
+            value |= (byte & 0x7F) << shift
+
+            if byte < 0x80:
+                return value, position + 1
+
+            shift += 7
+            if shift > MAX_VARINT_SHIFT:
+                raise ValueError("Integer is too long")
+    except IndexError:
+        raise ValueError("Message ends part way through an integer")
+
+
+def decode_signed(byte_data, position):
+    (value, position) = decode_varint(byte_data, position)
+    return (value >> 1) ^ -(value & 1), position
+
+
+def binary_record(record):
+    # A stored (v1) record as a binary wire message. One which can't be read
+    # is sent as it is, and is skipped by the client.
+    try:
+        message = parse_message(record)
+    except (ValueError, IndexError):
+        return record
+
+    return message_to_wire(message, PROTOCOL_V2)
+
+
+def encode_field(parts, field_type, value):
+    if isinstance(field_type, list):
+        # A list of rows, each row a tuple with these field types
+        parts.append(encode_varint(len(value)))
+        for row in value:
+            for (row_field_type, row_value) in zip(field_type, row):
+                encode_field(parts, row_field_type, row_value)
+    elif field_type == FIELD_INT:
+        parts.append(encode_signed(value))
+    elif field_type == FIELD_STR:
+        encoded = value.encode()
+        parts.append(encode_varint(len(encoded)))
+        parts.append(encoded)
+    elif field_type == FIELD_TIME:
+        parts.append(encode_signed(timestamp_to_micros(value)))
+    elif field_type == FIELD_INTS:
+        parts.append(encode_ints(value))
+    elif field_type == FIELD_DATA:
+        parts.append(value)
+    elif field_type == FIELD_RECORDS:
+        parts.extend(map(binary_record, value))
+
+
+def decode_field(byte_data, position, field_type):
+    # Returns the value and the position after it
+    if isinstance(field_type, list):
+        (count, position) = decode_varint(byte_data, position)
+        rows = []
+
+        for _ in range(count):
+            row = []
+            for row_field_type in field_type:
+                (value, position) = decode_field(byte_data, position, row_field_type)
+                row.append(value)
+            rows.append(tuple(row))
+
+        return rows, position
+
+    if field_type == FIELD_INT:
+        return decode_signed(byte_data, position)
+
+    if field_type == FIELD_STR:
+        (length, position) = decode_varint(byte_data, position)
+        value = str(byte_data[position:position + length], "utf-8").replace(SEPERATOR_TOKEN, SEPERATOR_REPLACEMENT)
+        return value, position + length
+
+    if field_type == FIELD_TIME:
+        (micros, position) = decode_signed(byte_data, position)
+        return EPOCH + datetime.timedelta(microseconds=micros), position
+
+    if field_type == FIELD_INTS:
+        return decode_ints(byte_data, position)
+
+    if field_type == FIELD_DATA:
+        return owned_data(byte_data, position), len(byte_data)
+
+    if field_type == FIELD_RECORDS:
+        return split_records(bytes(byte_data[position:])), len(byte_data)
+
+
+def encode_binary(message):
+    parts = []
+
+    for (attribute, field_type) in message.layout:
+        encode_field(parts, field_type, getattr(message, attribute))
+
+    return b"".join(parts)
+
+
+def decode_binary(message_class, byte_data):
+    byte_data = byte_data or b""
+    values = []
+    position = 0
+
+    for (_, field_type) in message_class.layout:
+        (value, position) = decode_field(byte_data, position, field_type)
+        values.append(value)
+
+    return message_class(*values)
 
 
 class Message:
+    # Each message type is a subclass declaring its MessageType, its binary
+    # layout (None if it is always sent as v1) and its v1 encoding, which
+    # is all that is needed to add a new message type.
     message_type = None
+    layout = None
 
-    def __init__(self, message_type):
-        self.message_type = message_type
+    # Whether a v3 body may be compressed
+    compressible = True
 
     def __str__(self):
         raise Exception("Cannot serialise the base Message type")
@@ -173,40 +477,79 @@ class Message:
     def to_bytes(self):
         raise Exception("Cannot serialise the base Message type")
 
+    @staticmethod
+    def from_bytes(byte_data):
+        raise Exception("Cannot parse the base Message type")
+
+    def coalesce_key(self):
+        # Messages which describe the latest state of something return a key
+        # identifying that thing, so a queued copy can be replaced by a newer one
+        return None
+
 
 class NicknameMessage(Message):
+    message_type = MessageType.NICKNAME
+
     nickname = None
+    version = None
 
-    def __init__(self, content):
-        super(NicknameMessage, self).__init__(MessageType.NICKNAME)
+    def __init__(self, content, version=PROTOCOL_V1):
+        super(NicknameMessage, self).__init__()
 
         self.nickname = content
+        self.version = version  # Latest protocol version the client supports
 
     def __str__(self):
-        return self.nickname
+        if self.version == PROTOCOL_V1:
+            return self.nickname
+
+        return SEPERATOR_TOKEN.join([self.nickname, str(self.version)])
 
     def to_bytes(self):
         return self.__str__().encode()
 
+    @staticmethod
+    def from_bytes(byte_data):
+        tokens = str(byte_data, "utf-8").split(SEPERATOR_TOKEN)
+        version = int(tokens[1]) if len(tokens) > 1 else PROTOCOL_V1
+        return NicknameMessage(tokens[0], version)
+
 
 class AcknowledgeClientMessage(Message):
+    message_type = MessageType.ACKNOWLEDGE_CLIENT
+
     client_id = None
+    version = None
 
-    def __init__(self, client_id):
-        super(AcknowledgeClientMessage, self).__init__(MessageType.ACKNOWLEDGE_CLIENT)
+    def __init__(self, client_id, version=PROTOCOL_V1):
+        super(AcknowledgeClientMessage, self).__init__()
 
         self.client_id = client_id
+        self.version = version  # Protocol version for the rest of the connection
 
     def __str__(self):
-        return str(self.client_id)
+        if self.version == PROTOCOL_V1:
+            return str(self.client_id)
+
+        return SEPERATOR_TOKEN.join([str(self.client_id), str(self.version)])
 
     def to_bytes(self):
         return self.__str__().encode()
 
+    @staticmethod
+    def from_bytes(byte_data):
+        tokens = str(byte_data, "utf-8").split(SEPERATOR_TOKEN)
+        client_id = int(tokens[0])
+        version = int(tokens[1]) if len(tokens) > 1 else PROTOCOL_V1
+        return AcknowledgeClientMessage(client_id, version)
+
 
 class ListClientsMessage(Message):
+    message_type = MessageType.LIST_CLIENTS
+    layout = []
+
     def __init__(self):
-        super(ListClientsMessage, self).__init__(MessageType.LIST_CLIENTS)
+        super(ListClientsMessage, self).__init__()
 
     def __str__(self):
         return None
@@ -214,13 +557,20 @@ class ListClientsMessage(Message):
     def to_bytes(self):
         return None
 
+    @staticmethod
+    def from_bytes(byte_data):
+        return ListClientsMessage()
+
 
 class ClientDiscoveryMessage(Message):
+    message_type = MessageType.CLIENT_DISCOVERY
+    layout = [("client_id", FIELD_INT), ("nickname", FIELD_STR)]
+
     nickname = None
     client_id = None
 
     def __init__(self, client_id, nickname):
-        super(ClientDiscoveryMessage, self).__init__(MessageType.CLIENT_DISCOVERY)
+        super(ClientDiscoveryMessage, self).__init__()
         self.client_id = client_id
         self.nickname = nickname
 
@@ -230,10 +580,23 @@ class ClientDiscoveryMessage(Message):
     def to_bytes(self):
         return self.__str__().encode()
 
+    def coalesce_key(self):
+        return self.client_id
+
+    @staticmethod
+    def from_bytes(byte_data):
+        tokens = str(byte_data, "utf-8").split(SEPERATOR_TOKEN)
+        client_id = int(tokens[0])
+        nickname = tokens[1]
+        return ClientDiscoveryMessage(client_id, nickname)
+
 
 class ListRoomsMessage(Message):
+    message_type = MessageType.LIST_ROOMS
+    layout = []
+
     def __init__(self):
-        super(ListRoomsMessage, self).__init__(MessageType.LIST_ROOMS)
+        super(ListRoomsMessage, self).__init__()
 
     def __str__(self):
         return None
@@ -241,15 +604,22 @@ class ListRoomsMessage(Message):
     def to_bytes(self):
         return None
 
+    @staticmethod
+    def from_bytes(byte_data):
+        return ListRoomsMessage()
+
 
 class RoomDiscoveryMessage(Message):
+    message_type = MessageType.ROOM_DISCOVERY
+    layout = [("room_id", FIELD_INT), ("title", FIELD_STR), ("host_id", FIELD_INT), ("host_name", FIELD_STR)]
+
     room_id = None
     title = None
     host_id = None
     host_name = None
 
     def __init__(self, room_id, room_title, host_id, host_name):
-        super(RoomDiscoveryMessage, self).__init__(MessageType.ROOM_DISCOVERY)
+        super(RoomDiscoveryMessage, self).__init__()
         self.room_id = room_id
         self.title = room_title
         self.host_id = host_id
@@ -262,13 +632,86 @@ class RoomDiscoveryMessage(Message):
     def to_bytes(self):
         return self.__str__().encode()
 
+    def coalesce_key(self):
+        return self.room_id
+
+    @staticmethod
+    def from_bytes(byte_data):
+        tokens = str(byte_data, "utf-8").split(SEPERATOR_TOKEN)
+        room_id = int(tokens[0])
+        title = tokens[1]
+        host_id = int(tokens[2])
+        host_name = tokens[3]
+        return RoomDiscoveryMessage(room_id, title, host_id, host_name)
+
+
+class ClientDirectoryMessage(Message):
+    # Many ClientDiscoveryMessages in one, so listing the clients does not
+    # cost a message per client
+    message_type = MessageType.CLIENT_DIRECTORY
+    layout = [("clients", [FIELD_INT, FIELD_STR])]
+
+    clients = None
+
+    def __init__(self, clients):
+        super(ClientDirectoryMessage, self).__init__()
+        self.clients = clients  # List of (client_id, nickname)
+
+    def __str__(self):
+        return SEPERATOR_TOKEN.join(f"{client_id}{SEPERATOR_TOKEN}{nickname}"
+                                    for (client_id, nickname) in self.clients)
+
+    def to_bytes(self):
+        return self.__str__().encode()
+
+    @staticmethod
+    def from_bytes(byte_data):
+        if not byte_data:
+            return ClientDirectoryMessage([])
+
+        tokens = str(byte_data, "utf-8").split(SEPERATOR_TOKEN)
+        clients = [(int(tokens[index]), tokens[index + 1]) for index in range(0, len(tokens), 2)]
+        return ClientDirectoryMessage(clients)
+
+
+class RoomDirectoryMessage(Message):
+    # Many RoomDiscoveryMessages in one
+    message_type = MessageType.ROOM_DIRECTORY
+    layout = [("rooms", [FIELD_INT, FIELD_STR, FIELD_INT, FIELD_STR])]
+
+    rooms = None
+
+    def __init__(self, rooms):
+        super(RoomDirectoryMessage, self).__init__()
+        self.rooms = rooms  # List of (room_id, title, host_id, host_name)
+
+    def __str__(self):
+        return SEPERATOR_TOKEN.join(SEPERATOR_TOKEN.join([str(room_id), title, str(host_id), host_name])
+                                    for (room_id, title, host_id, host_name) in self.rooms)
+
+    def to_bytes(self):
+        return self.__str__().encode()
+
+    @staticmethod
+    def from_bytes(byte_data):
+        if not byte_data:
+            return RoomDirectoryMessage([])
+
+        tokens = str(byte_data, "utf-8").split(SEPERATOR_TOKEN)
+        rooms = [(int(tokens[index]), tokens[index + 1], int(tokens[index + 2]), tokens[index + 3])
+                 for index in range(0, len(tokens), 4)]
+        return RoomDirectoryMessage(rooms)
+
 
 class RoomCreateMessage(Message):
+    message_type = MessageType.ROOM_CREATE
+    layout = [("host_id", FIELD_INT), ("title", FIELD_STR)]
+
     host_id = None
     title = None
 
     def __init__(self, host_id, title):
-        super(RoomCreateMessage, self).__init__(MessageType.ROOM_CREATE)
+        super(RoomCreateMessage, self).__init__()
         self.host_id = host_id
         self.title = title
 
@@ -278,12 +721,22 @@ class RoomCreateMessage(Message):
     def to_bytes(self):
         return self.__str__().encode()
 
+    @staticmethod
+    def from_bytes(byte_data):
+        tokens = str(byte_data, "utf-8").split(SEPERATOR_TOKEN)
+        host_id = int(tokens[0])
+        title = tokens[1]
+        return RoomCreateMessage(host_id, title)
+
 
 class AcknowledgeRoomCreateMessage(Message):
+    message_type = MessageType.ACKNOWLEDGE_ROOM_CREATE
+    layout = [("room_id", FIELD_INT)]
+
     room_id = None
 
     def __init__(self, room_id):
-        super(AcknowledgeRoomCreateMessage, self).__init__(MessageType.ACKNOWLEDGE_ROOM_CREATE)
+        super(AcknowledgeRoomCreateMessage, self).__init__()
         self.room_id = room_id
 
     def __str__(self):
@@ -292,13 +745,21 @@ class AcknowledgeRoomCreateMessage(Message):
     def to_bytes(self):
         return self.__str__().encode()
 
+    @staticmethod
+    def from_bytes(byte_data):
+        room_id = int(str(byte_data, "utf-8"))
+        return AcknowledgeRoomCreateMessage(room_id)
+
 
 class RoomInviteMessage(Message):
+    message_type = MessageType.ROOM_INVITE
+    layout = [("room_id", FIELD_INT), ("client_id", FIELD_INT)]
+
     room_id = None
     client_id = None
 
     def __init__(self, room_id, client_id):
-        super(RoomInviteMessage, self).__init__(MessageType.ROOM_INVITE)
+        super(RoomInviteMessage, self).__init__()
         self.room_id = room_id
         self.client_id = client_id
 
@@ -308,12 +769,22 @@ class RoomInviteMessage(Message):
     def to_bytes(self):
         return self.__str__().encode()
 
+    @staticmethod
+    def from_bytes(byte_data):
+        tokens = str(byte_data, "utf-8").split(SEPERATOR_TOKEN)
+        room_id = int(tokens[0])
+        client_id = int(tokens[1])
+        return RoomInviteMessage(room_id, client_id)
+
 
 class InitiateUserChatMessage(Message):
+    message_type = MessageType.INITIATE_USER_CHAT
+    layout = [("user_id", FIELD_INT)]
+
     user_id = None
 
     def __init__(self, user_id):
-        super(InitiateUserChatMessage, self).__init__(MessageType.INITIATE_USER_CHAT)
+        super(InitiateUserChatMessage, self).__init__()
         self.user_id = user_id
 
     def __str__(self):
@@ -322,14 +793,22 @@ class InitiateUserChatMessage(Message):
     def to_bytes(self):
         return self.__str__().encode()
 
+    @staticmethod
+    def from_bytes(byte_data):
+        user_id = int(str(byte_data, "utf-8"))
+        return InitiateUserChatMessage(user_id)
+
 
 class AcknowledgeUserChatMessage(Message):
+    message_type = MessageType.ACKNOWLEDGE_USER_CHAT
+    layout = [("room_id", FIELD_INT), ("user_id", FIELD_INT), ("user_nick", FIELD_STR)]
+
     room_id = None
     user_id = None
     user_nick = None
 
     def __init__(self, room_id, user_id, user_nick):
-        super(AcknowledgeUserChatMessage, self).__init__(MessageType.ACKNOWLEDGE_USER_CHAT)
+        super(AcknowledgeUserChatMessage, self).__init__()
         self.room_id = room_id
         self.user_id = user_id
         self.user_nick = user_nick
@@ -340,15 +819,26 @@ class AcknowledgeUserChatMessage(Message):
     def to_bytes(self):
         return self.__str__().encode()
 
+    @staticmethod
+    def from_bytes(byte_data):
+        tokens = str(byte_data, "utf-8").split(SEPERATOR_TOKEN)
+        room_id = int(tokens[0])
+        user_id = int(tokens[1])
+        user_nick = tokens[2]
+        return AcknowledgeUserChatMessage(room_id, user_id, user_nick)
+
 
 class RoomEntrySendMessage(Message):
+    message_type = MessageType.ROOM_MESSAGE_SEND
+    layout = [("room_id", FIELD_INT), ("text", FIELD_STR), ("timestamp", FIELD_TIME), ("resource_id", FIELD_INT)]
+
     text = None
     timestamp = None
     room_id = None
     resource_id = None
 
     def __init__(self, room_id, text, timestamp, resource_id):
-        super(RoomEntrySendMessage, self).__init__(MessageType.ROOM_MESSAGE_SEND)
+        super(RoomEntrySendMessage, self).__init__()
         self.room_id = room_id
         self.text = text
         self.timestamp = timestamp
@@ -362,8 +852,21 @@ class RoomEntrySendMessage(Message):
     def to_bytes(self):
         return self.__str__().encode()
 
+    @staticmethod
+    def from_bytes(byte_data):
+        tokens = str(byte_data, "utf-8").split(SEPERATOR_TOKEN)
+        room_id = int(tokens[0])
+        text = tokens[1]
+        timestamp = datetime.datetime.fromisoformat(tokens[2])
+        resource_id = int(tokens[3])
+        return RoomEntrySendMessage(room_id, text, timestamp, resource_id)
+
 
 class RoomEntryBroadcastMessage(Message):
+    message_type = MessageType.ROOM_MESSAGE_BROADCAST
+    layout = [("room_id", FIELD_INT), ("text", FIELD_STR), ("timestamp", FIELD_TIME), ("user_id", FIELD_INT),
+              ("resource_id", FIELD_INT)]
+
     text = None
     timestamp = None
     user_id = None
@@ -371,7 +874,7 @@ class RoomEntryBroadcastMessage(Message):
     resource_id = None
 
     def __init__(self, room_id, text, timestamp, user_id, resource_id):
-        super(RoomEntryBroadcastMessage, self).__init__(MessageType.ROOM_MESSAGE_BROADCAST)
+        super(RoomEntryBroadcastMessage, self).__init__()
         self.text = text
         self.timestamp = timestamp
         self.user_id = user_id
@@ -387,23 +890,44 @@ class RoomEntryBroadcastMessage(Message):
     def to_bytes(self):
         return self.__str__().encode()
 
+    @staticmethod
+    def from_bytes(byte_data):
+        tokens = str(byte_data, "utf-8").split(SEPERATOR_TOKEN)
+        room_id = int(tokens[0])
+        text = tokens[1]
+        timestamp = datetime.datetime.fromisoformat(tokens[2])
+        user_id = int(tokens[3])
+        resource_id = int(tokens[4])
+        return RoomEntryBroadcastMessage(room_id, text, timestamp, user_id, resource_id)
+
 
 class ResourceCreateMessage(Message):
+    message_type = MessageType.RESOURCE_CREATE
+    layout = [("data", FIELD_DATA)]
+    compressible = False
+
     data = None
 
     def __init__(self, data):
-        super(ResourceCreateMessage, self).__init__(MessageType.RESOURCE_CREATE)
+        super(ResourceCreateMessage, self).__init__()
         self.data = data
 
     def to_bytes(self):
         return self.data
 
+    @staticmethod
+    def from_bytes(byte_data):
+        return ResourceCreateMessage(owned_data(byte_data))
+
 
 class AcknowledgeResourceMessage(Message):
+    message_type = MessageType.ACKNOWLEDGE_RESOURCE
+    layout = [("resource_id", FIELD_INT)]
+
     resource_id = None
 
     def __init__(self, resource_id):
-        super(AcknowledgeResourceMessage, self).__init__(MessageType.ACKNOWLEDGE_RESOURCE)
+        super(AcknowledgeResourceMessage, self).__init__()
         self.resource_id = resource_id
 
     def __str__(self):
@@ -412,12 +936,20 @@ class AcknowledgeResourceMessage(Message):
     def to_bytes(self):
         return self.__str__().encode()
 
+    @staticmethod
+    def from_bytes(byte_data):
+        resource_id = int(str(byte_data, "utf-8"))
+        return AcknowledgeResourceMessage(resource_id)
+
 
 class ResourceFetchMessage(Message):
+    message_type = MessageType.RESOURCE_FETCH
+    layout = [("resource_id", FIELD_INT)]
+
     resource_id = None
 
     def __init__(self, resource_id):
-        super(ResourceFetchMessage, self).__init__(MessageType.RESOURCE_FETCH)
+        super(ResourceFetchMessage, self).__init__()
         self.resource_id = resource_id
 
     def __str__(self):
@@ -426,24 +958,40 @@ class ResourceFetchMessage(Message):
     def to_bytes(self):
         return self.__str__().encode()
 
+    @staticmethod
+    def from_bytes(byte_data):
+        resource_id = int(str(byte_data, "utf-8"))
+        return ResourceFetchMessage(resource_id)
+
 
 class ResourceTransferMessage(Message):
+    message_type = MessageType.RESOURCE_TRANSFER
+    layout = [("data", FIELD_DATA)]
+    compressible = False
+
     data = None
 
     def __init__(self, data):
-        super(ResourceTransferMessage, self).__init__(MessageType.RESOURCE_TRANSFER)
+        super(ResourceTransferMessage, self).__init__()
         self.data = data
 
     def to_bytes(self):
         return self.data
 
+    @staticmethod
+    def from_bytes(byte_data):
+        return ResourceTransferMessage(owned_data(byte_data))
+
 
 class RoomMembershipDiscoveryMessage(Message):
+    message_type = MessageType.ROOM_MEMBERSHIP_DISCOVERY
+    layout = [("host_id", FIELD_INT), ("members", FIELD_INTS)]
+
     host_id = None
     members = None
 
     def __init__(self, host_id, members):
-        super(RoomMembershipDiscoveryMessage, self).__init__(MessageType.ROOM_MEMBERSHIP_DISCOVERY)
+        super(RoomMembershipDiscoveryMessage, self).__init__()
         self.host_id = host_id
         self.members = members
 
@@ -455,12 +1003,23 @@ class RoomMembershipDiscoveryMessage(Message):
     def to_bytes(self):
         return self.__str__().encode()
 
+    @staticmethod
+    def from_bytes(byte_data):
+        members = str(byte_data, "utf-8").split(SEPERATOR_TOKEN)
+        members = [int(client_id) for client_id in members]
+        host_id = members[0]
+        members = members[1:]
+        return RoomMembershipDiscoveryMessage(host_id, members)
+
 
 class ListRoomMembersMessage(Message):
+    message_type = MessageType.LIST_ROOM_MEMBERS
+    layout = [("room_id", FIELD_INT)]
+
     room_id = None
 
     def __init__(self, room_id):
-        super(ListRoomMembersMessage, self).__init__(MessageType.LIST_ROOM_MEMBERS)
+        super(ListRoomMembersMessage, self).__init__()
         self.room_id = room_id
 
     def __str__(self):
@@ -468,3 +1027,282 @@ class ListRoomMembersMessage(Message):
 
     def to_bytes(self):
         return self.__str__().encode()
+
+    @staticmethod
+    def from_bytes(byte_data):
+        room_id = int(str(byte_data, "utf-8"))
+        return ListRoomMembersMessage(room_id)
+
+
+class ClientDepartureMessage(Message):
+    message_type = MessageType.CLIENT_DEPARTURE
+    layout = [("client_id", FIELD_INT)]
+
+    client_id = None
+
+    def __init__(self, client_id):
+        super(ClientDepartureMessage, self).__init__()
+        self.client_id = client_id
+
+    def __str__(self):
+        return str(self.client_id)
+
+    def to_bytes(self):
+        return self.__str__().encode()
+
+    @staticmethod
+    def from_bytes(byte_data):
+        client_id = int(str(byte_data, "utf-8"))
+        return ClientDepartureMessage(client_id)
+
+
+class HistoryFetchMessage(Message):
+    message_type = MessageType.HISTORY_FETCH
+    layout = [("room_id", FIELD_INT), ("cursor", FIELD_INT), ("count", FIELD_INT), ("direction", FIELD_INT)]
+
+    room_id = None
+    cursor = None
+    count = None
+    direction = None
+
+    def __init__(self, room_id, cursor, count, direction=HISTORY_BEFORE):
+        super(HistoryFetchMessage, self).__init__()
+        self.room_id = room_id
+        self.cursor = cursor  # INVALID_ID fetches the latest messages
+        self.count = count
+        self.direction = direction
+
+    def __str__(self):
+        return SEPERATOR_TOKEN.join([str(self.room_id), str(self.cursor),
+                                     str(self.count), str(self.direction)])
+
+    def to_bytes(self):
+        return self.__str__().encode()
+
+    @staticmethod
+    def from_bytes(byte_data):
+        tokens = str(byte_data, "utf-8").split(SEPERATOR_TOKEN)
+        room_id = int(tokens[0])
+        cursor = int(tokens[1])
+        count = int(tokens[2])
+        direction = int(tokens[3])
+        return HistoryFetchMessage(room_id, cursor, count, direction)
+
+
+class HistoryBatchMessage(Message):
+    message_type = MessageType.HISTORY_BATCH
+    layout = [("room_id", FIELD_INT), ("first_offset", FIELD_INT), ("records", FIELD_RECORDS)]
+
+    room_id = None
+    first_offset = None
+    records = None
+
+    def __init__(self, room_id, first_offset, records):
+        super(HistoryBatchMessage, self).__init__()
+        self.room_id = room_id
+        self.first_offset = first_offset  # Offset of the first record, the cursor for older messages
+        self.records = records  # Wire encoded RoomEntryBroadcastMessages, oldest first
+
+    def __str__(self):
+        return SEPERATOR_TOKEN.join([str(self.room_id), str(self.first_offset), f"{len(self.records)} records"])
+
+    def to_bytes(self):
+        fields = SEPERATOR_TOKEN.join([str(self.room_id), str(self.first_offset), ""]).encode()
+        return b"".join([fields] + self.records)
+
+    def messages(self, version=PROTOCOL_V1):
+        # Records are in the encoding of the batch they arrived in
+        messages = []
+
+        for record in self.records:
+            try:
+                messages.append(parse_message(record, version))
+            except (ValueError, IndexError) as e:
+                # Skip a bad record rather than losing the whole batch
+                print(f"WARN: Skipping unreadable history record in room {self.room_id}: {e}")
+
+        return messages
+
+    @staticmethod
+    def from_bytes(byte_data):
+        # The fixed fields are followed by the records, which are complete wire messages
+        tokens = bytes(byte_data).split(SEPERATOR_BYTES, 2)
+        room_id = int(tokens[0])
+        first_offset = int(tokens[1])
+        return HistoryBatchMessage(room_id, first_offset, split_records(tokens[2]))
+
+
+class ResourceUploadBeginMessage(Message):
+    message_type = MessageType.RESOURCE_UPLOAD_BEGIN
+    layout = [("digest", FIELD_STR), ("size", FIELD_INT)]
+
+    digest = None
+    size = None
+
+    def __init__(self, digest, size):
+        super(ResourceUploadBeginMessage, self).__init__()
+        self.digest = digest  # SHA-256 (hex) of the whole resource, identifies the upload
+        self.size = size
+
+    def __str__(self):
+        return SEPERATOR_TOKEN.join([self.digest, str(self.size)])
+
+    def to_bytes(self):
+        return self.__str__().encode()
+
+    @staticmethod
+    def from_bytes(byte_data):
+        tokens = str(byte_data, "utf-8").split(SEPERATOR_TOKEN)
+        digest = tokens[0]
+        size = int(tokens[1])
+        return ResourceUploadBeginMessage(digest, size)
+
+
+class ResourceUploadAckMessage(Message):
+    message_type = MessageType.RESOURCE_UPLOAD_ACK
+    layout = [("digest", FIELD_STR), ("offset", FIELD_INT)]
+
+    digest = None
+    offset = None
+
+    def __init__(self, digest, offset):
+        super(ResourceUploadAckMessage, self).__init__()
+        self.digest = digest
+        self.offset = offset  # Bytes received so far, where the next chunk starts
+
+    def __str__(self):
+        return SEPERATOR_TOKEN.join([self.digest, str(self.offset)])
+
+    def to_bytes(self):
+        return self.__str__().encode()
+
+    @staticmethod
+    def from_bytes(byte_data):
+        tokens = str(byte_data, "utf-8").split(SEPERATOR_TOKEN)
+        digest = tokens[0]
+        offset = int(tokens[1])
+        return ResourceUploadAckMessage(digest, offset)
+
+
+class ResourceUploadChunkMessage(Message):
+    message_type = MessageType.RESOURCE_UPLOAD_CHUNK
+    layout = [("digest", FIELD_STR), ("offset", FIELD_INT), ("data", FIELD_DATA)]
+    compressible = False
+
+    digest = None
+    offset = None
+    data = None
+
+    def __init__(self, digest, offset, data):
+        super(ResourceUploadChunkMessage, self).__init__()
+        self.digest = digest
+        self.offset = offset
+        self.data = data
+
+    def __str__(self):
+        return SEPERATOR_TOKEN.join([self.digest, str(self.offset), f"{len(self.data)} bytes"])
+
+    def to_bytes(self):
+        fields = SEPERATOR_TOKEN.join([self.digest, str(self.offset), ""]).encode()
+        return fields + self.data
+
+    @staticmethod
+    def from_bytes(byte_data):
+        # The fixed fields are followed by the raw chunk
+        tokens = bytes(byte_data).split(SEPERATOR_BYTES, 2)
+        digest = tokens[0].decode()
+        offset = int(tokens[1])
+        return ResourceUploadChunkMessage(digest, offset, tokens[2])
+
+
+class ResourceUploadEndMessage(Message):
+    message_type = MessageType.RESOURCE_UPLOAD_END
+    layout = [("digest", FIELD_STR)]
+
+    digest = None
+
+    def __init__(self, digest):
+        super(ResourceUploadEndMessage, self).__init__()
+        self.digest = digest
+
+    def __str__(self):
+        return self.digest
+
+    def to_bytes(self):
+        return self.__str__().encode()
+
+    @staticmethod
+    def from_bytes(byte_data):
+        return ResourceUploadEndMessage(str(byte_data, "utf-8"))
+
+
+class ResourceDownloadMessage(Message):
+    message_type = MessageType.RESOURCE_DOWNLOAD
+    layout = [("resource_id", FIELD_INT), ("offset", FIELD_INT), ("variant", FIELD_INT)]
+
+    resource_id = None
+    offset = None
+    variant = None
+
+    def __init__(self, resource_id, offset=0, variant=RESOURCE_ORIGINAL):
+        super(ResourceDownloadMessage, self).__init__()
+        self.resource_id = resource_id
+        self.offset = offset
+        self.variant = variant
+
+    def __str__(self):
+        return SEPERATOR_TOKEN.join([str(self.resource_id), str(self.offset), str(self.variant)])
+
+    def to_bytes(self):
+        return self.__str__().encode()
+
+    @staticmethod
+    def from_bytes(byte_data):
+        tokens = str(byte_data, "utf-8").split(SEPERATOR_TOKEN)
+        resource_id = int(tokens[0])
+        offset = int(tokens[1])
+        variant = int(tokens[2])
+        return ResourceDownloadMessage(resource_id, offset, variant)
+
+
+class ResourceChunkMessage(Message):
+    message_type = MessageType.RESOURCE_CHUNK
+    layout = [("resource_id", FIELD_INT), ("offset", FIELD_INT), ("total", FIELD_INT), ("variant", FIELD_INT),
+              ("data", FIELD_DATA)]
+    compressible = False
+
+    resource_id = None
+    offset = None
+    total = None
+    variant = None
+    data = None
+
+    def __init__(self, resource_id, offset, total, variant, data):
+        super(ResourceChunkMessage, self).__init__()
+        self.resource_id = resource_id
+        self.offset = offset
+        self.total = total  # Size of the whole variant
+        self.variant = variant
+        self.data = data
+
+    def __str__(self):
+        return SEPERATOR_TOKEN.join([str(self.resource_id), str(self.offset), str(self.total), str(self.variant),
+                                     f"{len(self.data)} bytes"])
+
+    def to_bytes(self):
+        fields = SEPERATOR_TOKEN.join([str(self.resource_id), str(self.offset), str(self.total), str(self.variant),
+                                       ""]).encode()
+        return fields + self.data
+
+    @staticmethod
+    def from_bytes(byte_data):
+        tokens = bytes(byte_data).split(SEPERATOR_BYTES, 4)
+        resource_id = int(tokens[0])
+        offset = int(tokens[1])
+        total = int(tokens[2])
+        variant = int(tokens[3])
+        return ResourceChunkMessage(resource_id, offset, total, variant, tokens[4])
+
+
+# MessageType -> Message subclass, so decoding is a single lookup
+MESSAGE_CLASSES = {message_class.message_type: message_class for message_class in Message.__subclasses__()}
@@ -2,310 +2,854 @@
 # Name: Matthew Jakeman
 # UPI: mjak923
 
-import os
+import argparse
 import socket
 import ssl
+import time
 import traceback
 
 from socket import *
-from threading import Thread
+from threading import Thread, BoundedSemaphore, Lock
 from traceback import print_exception
 
 from message import *
+from server_cache import ResourceCache
 from server_client import ClientData
+from server_connection import ClientConnection, OutboundQueue
+from server_log import MessageStore
+from server_metrics import ServerMetrics, start_metrics_server
+from server_previews import variant_makers
+from server_resources import ResourceStore, is_valid_hash
+from server_registry import ClientRegistry
 from server_room import RoomMessage, Room
-from socket_utils import recv_message, send_message
+from socket_utils import FrameReader
 
-from config import INVALID_ID, SERVER_PORT, SERVER_HOST, DIRECT_CHAT_ROOM_ID, RESOURCE_LOCATION, CERTFILE, KEYFILE
+from config import INVALID_ID, SERVER_PORT, SERVER_HOST, DIRECT_CHAT_ROOM_ID, RESOURCE_LOCATION, HISTORY_LOCATION, \
+    HISTORY_PAGE_LIMIT, RESOURCE_CACHE_SIZE, RESOURCE_CHUNK_SIZE, CERTFILE, KEYFILE, SERVER_ENGINE, SERVER_ENGINES, \
+    HANDSHAKE_TIMEOUT, LOGIN_TIMEOUT, MAX_PENDING_LOGINS, SERVER_WORKERS, BUS_SOCKET_PATH, DIRECTORY_PAGE_SIZE, \
+    METRICS_HOST, METRICS_PORT, MAX_UPLOAD_SIZE, PARTIAL_UPLOAD_EXPIRY, PARTIAL_UPLOAD_CHECK_INTERVAL, MAX_FRAME_SIZE, \
+    MAX_LOGIN_FRAME_SIZE, SLOW_CONSUMER_POLICY, SLOW_CONSUMER_POLICIES
+
+
+def create_server_context():
+    # Create SSL Context
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+
+    # Setup certificate and shared ciphers
+    context.load_cert_chain(certfile=CERTFILE, keyfile=KEYFILE)
+    context.load_verify_locations(CERTFILE)
+
+    return context
 
 
 class Server:
-    connected_clients = {}
+    host = None
+    port = None
+    context = None
+
+    connected_clients = None
     server_socket = None
+    pending_logins = None
 
-    server_rooms = []
-    images = []
+    server_rooms = None
+    message_store = None
+    resource_store = None
+    resource_cache = None
 
     next_user_id = 0
     next_room_id = 0
     next_resource_id = 0
+    id_lock = None
+
+    # Set when running as one of several worker processes
+    worker_index = 0
+    worker_count = 1
+    bus = None
+
+    # MessageType -> handler, for messages from clients and from other workers
+    handlers = None
+    blocking_handlers = None
+    bus_handlers = None
+
+    # Metrics are served on metrics_port (plus the worker index), or not at all if it is 0
+    metrics = None
+    metrics_port = None
+
+    # What each client's outbound queue does once full (see OutboundQueue)
+    slow_consumer_policy = None
+
+    def __init__(self, host, port, worker_index=0, worker_count=1, bus=None, metrics_port=METRICS_PORT,
+                 slow_consumer_policy=SLOW_CONSUMER_POLICY):
+        self.host = host
+        self.port = port
+        self.slow_consumer_policy = slow_consumer_policy
+        self.context = create_server_context()
+
+        self.metrics = ServerMetrics()
+        self.metrics.registry.add_collector(self.collect_metrics)
+        self.metrics_port = metrics_port
+
+        self.connected_clients = ClientRegistry()
+        self.server_rooms = {}
+        self.message_store = MessageStore(HISTORY_LOCATION)
+        self.resource_store = ResourceStore(RESOURCE_LOCATION, variant_makers())
+        self.resource_cache = ResourceCache(RESOURCE_CACHE_SIZE)
+
+        # Each worker allocates ids from its own interleaved sequence so
+        # that ids are unique across every worker
+        self.worker_index = worker_index
+        self.worker_count = worker_count
+        self.restore_rooms()
+        self.next_user_id = self.first_unused_id([room.last_client_id for room in self.server_rooms.values()])
+        self.next_room_id = self.first_unused_id(self.message_store.room_ids())
+        self.next_resource_id = self.first_unused_id(self.resource_store.resource_ids())
+        self.id_lock = Lock()
+        self.bus = bus
+
+        # Bounds the number of connections still in the handshake or login stages
+        self.pending_logins = BoundedSemaphore(MAX_PENDING_LOGINS)
+
+        self.handlers = {
+            MessageType.LIST_CLIENTS: self.handle_list_clients,
+            MessageType.LIST_ROOMS: self.handle_list_rooms,
+            MessageType.LIST_ROOM_MEMBERS: self.handle_list_room_members,
+            MessageType.ROOM_CREATE: self.handle_room_create,
+            MessageType.ROOM_INVITE: self.handle_room_invite,
+            MessageType.INITIATE_USER_CHAT: self.handle_initiate_user_chat,
+            MessageType.ROOM_MESSAGE_SEND: self.handle_room_message_send,
+        }
+
+        # Handlers which read or write files (or make previews) return their
+        # reply rather than sending it, so the asyncio engine can run them
+        # off its event loop
+        self.blocking_handlers = {
+            MessageType.HISTORY_FETCH: self.history_fetch_reply,
+            MessageType.RESOURCE_CREATE: self.resource_create_reply,
+            MessageType.RESOURCE_FETCH: self.resource_fetch_reply,
+            MessageType.RESOURCE_UPLOAD_BEGIN: self.upload_begin_reply,
+            MessageType.RESOURCE_UPLOAD_CHUNK: self.upload_chunk_reply,
+            MessageType.RESOURCE_UPLOAD_END: self.upload_end_reply,
+            MessageType.RESOURCE_DOWNLOAD: self.resource_download_reply,
+        }
+
+        for message_type in self.blocking_handlers:
+            self.handlers[message_type] = self.handle_blocking
+
+        self.bus_handlers = {
+            MessageType.CLIENT_DISCOVERY: self.handle_bus_client_discovery,
+            MessageType.CLIENT_DEPARTURE: self.handle_bus_client_departure,
+            MessageType.ROOM_DISCOVERY: self.handle_bus_room_discovery,
+            MessageType.ROOM_INVITE: self.handle_bus_room_invite,
+            MessageType.ROOM_MESSAGE_BROADCAST: self.handle_bus_room_message_broadcast,
+        }
+
+    def listen(self):
+        # The listening socket is left unwrapped so that accept() never
+        # performs a TLS handshake. Each connection is wrapped on its own
+        # thread in register_client instead.
+        self.server_socket = socket(AF_INET, SOCK_STREAM)
+        self.server_socket.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+
+        # Workers share the port, and the kernel balances connections between them
+        if self.worker_count > 1:
+            self.server_socket.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
 
-    def __init__(self, host, port):
-        # Create SSL Context
-        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        # Start up src and listen
+        self.server_socket.bind((self.host, self.port))
+        self.server_socket.listen()
 
-        # Setup certificate and shared ciphers
-        context.load_cert_chain(certfile=CERTFILE, keyfile=KEYFILE)
-        context.load_verify_locations(CERTFILE)
+        print("Server started listening localhost: {}".format(self.port))
 
-        # Wrap regular socket
-        raw_socket = socket(AF_INET, SOCK_STREAM)
-        raw_socket.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
-        self.server_socket = context.wrap_socket(raw_socket, server_side=True)
+    def first_unused_id(self, used_ids):
+        # The first id in this worker's sequence after all the used ones
+        if not used_ids:
+            return self.worker_index
 
-        # Start up src and listen
-        self.server_socket.bind((host, port))
-        self.server_socket.listen()
+        next_id = max(used_ids) + 1
+        return next_id + (self.worker_index - next_id) % self.worker_count
+
+    def restore_rooms(self):
+        # Rooms saved alongside their history by earlier runs
+        for room_id in sorted(self.message_store.room_ids()):
+            manifest = self.message_store.read_manifest(room_id)
+            if manifest is None:
+                print(f"WARN: Room {room_id} has no manifest - its history cannot be fetched")
+                continue
+
+            room = self.add_room(room_id, manifest["title"], manifest["host_id"], manifest["host"])
+            room.restore(manifest)
+
+        print(f"STATUS: Restored {len(self.server_rooms)} rooms")
 
-        print("Server started listening localhost: {}".format(port))
+    def owns_room(self, room_id):
+        # Room ids are allocated per worker, so the creating worker owns the room's log
+        return room_id % self.worker_count == self.worker_index
+
+    def start_bus(self):
+        if self.bus is not None:
+            self.bus.start(self.dispatch_bus_message)
+
+    def start_metrics(self):
+        if not self.metrics_port:
+            return
+
+        try:
+            start_metrics_server(self.metrics.registry, METRICS_HOST, self.metrics_port + self.worker_index)
+        except OSError as e:
+            # Metrics are optional, so a taken port shouldn't stop the server
+            print(f"WARN: Could not serve metrics on port {self.metrics_port + self.worker_index}: {e}")
+
+    def collect_metrics(self):
+        # Called for each export of the metrics
+        metrics = self.metrics
+        clients = self.connected_clients.clients()
+
+        metrics.connected_clients.set(len(clients))
+        metrics.known_clients.set(len(self.connected_clients.all_client_data()))
+
+        rooms = list(self.server_rooms.values())
+        metrics.rooms.set(len(rooms))
+        metrics.room_members.clear()
+        for room in rooms:
+            metrics.room_members.observe(len(room.authorized_clients))
+
+        metrics.queue_frames.clear()
+        for client in clients:
+            metrics.queue_frames.observe(len(client.queue))
+        metrics.queued_bytes.set(sum(client.queue.queued_bytes for client in clients))
+
+        cache = self.resource_cache
+        metrics.cache_hits.set(cache.hits)
+        metrics.cache_misses.set(cache.misses)
+        metrics.cache_bytes.set(cache.size)
+        metrics.cache_entries.set(len(cache))
+
+    def publish(self, message):
+        # Share a state change with the other worker processes
+        if self.bus is not None:
+            self.bus.publish(message)
 
     def run(self):
+        self.listen()
+        self.start_bus()
+        self.start_metrics()
+        self.start_upload_expiry()
+
         try:
             while True:
                 try:
                     # Wait for connection
                     incoming_client, _ = self.server_socket.accept()
-                    self.register_client(incoming_client)
+                    self.accept_client(incoming_client)
                 except Exception as e:
                     traceback.print_exception(e)
         except KeyboardInterrupt:
             print("Shutting down...")
         finally:
             self.server_socket.close()
-
-    def ensure_resource_dir(self):
-        if not os.path.exists(RESOURCE_LOCATION):
-            os.mkdir(RESOURCE_LOCATION)
+            self.message_store.close()
 
     def get_resource(self, resource_id):
-        self.ensure_resource_dir()
-        resource_name = os.path.join(RESOURCE_LOCATION, f"{resource_id}.png")
-
-        with open(resource_name, "rb") as image:
-            file = image.read()
-            return bytearray(file)
+        # Cached by content, so every id sharing a blob shares the cache entry
+        blob_hash = self.resource_store.get_hash(resource_id)
+        if blob_hash is None:
+            return self.resource_store.get(resource_id)
+
+        return self.resource_cache.get_or_load(("body", blob_hash),
+                                               lambda: self.resource_store.get(resource_id))
+
+    def get_resource_frame(self, resource_id):
+        # The body of a ResourceTransferMessage is the resource itself (in
+        # every version), so the cached copy is sent as is
+        return body_to_frame(MessageType.RESOURCE_TRANSFER, self.get_resource(resource_id))
+
+    def get_resource_chunk_frame(self, resource_id, offset, variant, version):
+        # An encoded ResourceChunkMessage of up to RESOURCE_CHUNK_SIZE bytes
+        # of a variant of a resource from offset
+        def load():
+            (data, total) = self.resource_store.read_chunk(resource_id, offset, RESOURCE_CHUNK_SIZE, variant)
+            return message_body(ResourceChunkMessage(resource_id, offset, total, variant, data), version)
+
+        blob_hash = self.resource_store.get_hash(resource_id)
+        if blob_hash is None:
+            return body_to_frame(MessageType.RESOURCE_CHUNK, load())
+
+        # The resource id is part of the body, so it is part of the key
+        body = self.resource_cache.get_or_load(("chunk", version, blob_hash, resource_id, variant, offset), load)
+        return body_to_frame(MessageType.RESOURCE_CHUNK, body)
+
+    def allocate_resource_id(self):
+        # Called from every client thread, or the asyncio engine's executor
+        with self.id_lock:
+            resource_id = self.next_resource_id
+            self.next_resource_id += self.worker_count
+            return resource_id
 
     def create_resource(self, data):
-        resource_id = self.next_resource_id
-        self.next_resource_id += 1
+        resource_id = self.allocate_resource_id()
 
-        self.ensure_resource_dir()
-        resource_name = os.path.join(RESOURCE_LOCATION, f"{resource_id}.png")
+        self.resource_store.create(resource_id, data)
+        return resource_id
 
-        with open(resource_name, "wb") as image:
-            image.write(data)
-            return resource_id
+    def upload_offset(self, digest, size):
+        # Where an upload should continue from, which is the end if the
+        # content is already stored
+        offset = self.resource_store.begin_partial(digest, size)
+        if offset is None:
+            return size
 
-    def broadcast(self, message):
+        return offset
+
+    def start_upload_expiry(self):
+        # Only file operations, so a thread suits either engine
+        thread = Thread(target=self.expire_uploads, daemon=True)
+        thread.start()
+
+    def expire_uploads(self):
+        while True:
+            time.sleep(PARTIAL_UPLOAD_CHECK_INTERVAL)
+
+            try:
+                expired = self.resource_store.expire_partials(PARTIAL_UPLOAD_EXPIRY)
+                if expired > 0:
+                    print(f"STATUS: Deleted {expired} abandoned uploads")
+            except OSError as e:
+                print(f"WARN: Could not delete abandoned uploads: {e}")
+
+    def send(self, client, message):
+        if message is None:
+            print("WARN: Attempted to send null message")
+            traceback.print_stack()
+            return
+
+        if client is None:
+            print("WARN: Attempted to send message to invalid socket")
+            traceback.print_stack()
+            return
+
+        # Queued on the client's connection, so this never blocks on a slow reader
+        client.send(message)
+
+    def send_shared(self, clients, message):
+        # Sends the same message to many clients. It is encoded once per
+        # protocol version and every client queues the same frame, which
+        # is immutable so it is safe to share between connections.
+        frames = {}
+        coalesce_key = message.coalesce_key()
+
+        for client in clients:
+            frame = frames.get(client.version)
+            if frame is None:
+                frame = message_to_frame(message, client.version)
+                frames[client.version] = frame
+
+            client.send_frame(frame, message.message_type, coalesce_key)
+
+    def broadcast(self, message, clients=None):
         print(f"BROADCAST: {message.message_type.name}: {message.__str__()}")
-        for client in self.connected_clients:
-            send_message(client, message)
+
+        if clients is None:
+            clients = self.connected_clients.clients()
+
+        self.send_shared(clients, message)
 
     def get_client_data(self, client_socket):
-        return self.connected_clients[client_socket]
+        return self.connected_clients.get_data(client_socket)
 
     def get_client_data_for_id(self, client_id):
-        for client in self.connected_clients:
-            if self.connected_clients[client].client_id is client_id:
-                return self.connected_clients[client]
-
-        return None
+        return self.connected_clients.get_data_for_id(client_id)
 
     def get_client_socket_for_id(self, client_id):
-        for client in self.connected_clients:
-            if self.connected_clients[client].client_id is client_id:
-                return client
+        return self.connected_clients.get_client_for_id(client_id)
 
-        return None
+    def get_nick_for_id(self, client_id):
+        client_data = self.get_client_data_for_id(client_id)
+        if client_data is None:
+            return None
 
-    def create_room(self, title, host_id):
-        new_room = Room(self.next_room_id, title, host_id)
-        self.server_rooms.append(new_room)
+        return client_data.client_nick
 
-        self.next_room_id += 1
+    def create_room(self, title, host_id, host_nick):
+        new_room = self.add_room(self.next_room_id, title, host_id, host_nick)
+        self.next_room_id += self.worker_count
+        new_room.save()
 
         return new_room
 
+    def add_room(self, room_id, title, host_id, host_nick):
+        log = self.message_store.open_log(room_id, self.owns_room(room_id))
+        new_room = Room(room_id, title, host_id, host_nick, log)
+        self.server_rooms[room_id] = new_room
+
+        return new_room
+
+    def send_to_members(self, room, message):
+        # Only members connected to this worker are sent to, the others
+        # are reached by their own worker
+        member_sockets = [self.get_client_socket_for_id(member_id) for member_id in list(room.authorized_clients)]
+        self.send_shared([member_socket for member_socket in member_sockets if member_socket is not None], message)
+
+    def invite_to_room(self, room, client_id):
+        room.invite(client_id, self.get_nick_for_id(client_id))
+
+        invited_socket = self.get_client_socket_for_id(client_id)
+        if invited_socket is not None:
+            new_msg = RoomDiscoveryMessage(room.room_id, room.title, room.host_id, room.host_nick)
+            self.send(invited_socket, new_msg)
+
+        new_msg = RoomMembershipDiscoveryMessage(room.host_id, room.authorized_clients)
+        self.send_to_members(room, new_msg)
+
+    def join_direct_chat(self, room, client_id):
+        # Direct chats are not announced, but the pair must be linked
+        room.invite(client_id, self.get_nick_for_id(client_id))
+        if len(room.authorized_clients) == 2:
+            (first_id, second_id) = room.authorized_clients
+            self.link_direct_chat(room.room_id, first_id, second_id)
+
+    def rejoin_rooms(self, client_data):
+        # Members are saved by nickname, so a client logging in again (even
+        # after a restart) is given back its rooms under its new id. It
+        # finds them by listing its rooms, so only the other members are told.
+        for room in list(self.server_rooms.values()):
+            if client_data.client_nick not in room.members:
+                continue
+
+            if room.host_id == DIRECT_CHAT_ROOM_ID:
+                self.join_direct_chat(room, client_data.client_id)
+            else:
+                room.invite(client_data.client_id, client_data.client_nick)
+                self.send_to_members(room, RoomMembershipDiscoveryMessage(room.host_id, room.authorized_clients))
+
+            self.publish(RoomInviteMessage(room.room_id, client_data.client_id))
+
+    def link_direct_chat(self, room_id, first_id, second_id):
+        first_data = self.get_client_data_for_id(first_id)
+        second_data = self.get_client_data_for_id(second_id)
+
+        # Set room in user room maps
+        if first_data is not None:
+            first_data.user_room_map[second_id] = room_id
+
+        if second_data is not None:
+            second_data.user_room_map[first_id] = room_id
+
+    def fetch_history(self, room, cursor, count, direction):
+        # Served from the log's index, and the records are sent exactly as stored
+        room.log.refresh()
+        count = max(0, min(count, HISTORY_PAGE_LIMIT))
+
+        if direction == HISTORY_AFTER:
+            start = cursor + 1
+        else:
+            end = room.log.next_offset if cursor == INVALID_ID else cursor
+            start = max(0, end - count)
+            count = max(0, end - start)
+
+        records = room.log.read(start, count)
+        first_offset = records[0][0] if records else start
+
+        return HistoryBatchMessage(room.room_id, first_offset, [record for (_, record) in records])
+
     def dispatch_message(self, client_socket, message):
+        handler = self.handlers.get(message.message_type)
+        if handler is None:
+            print(f"Unsupported message: {message.message_type.name}")
+            return
+
+        start = time.perf_counter()
+        try:
+            handler(client_socket, message)
+        finally:
+            self.metrics.dispatched(message.message_type, time.perf_counter() - start)
+
+    def send_directory(self, client_socket, entries, discovery_class, directory_class):
+        # v2 clients receive the directory in pages, older clients one
+        # discovery message per entry
+        if client_socket.version == PROTOCOL_V1:
+            for entry in entries:
+                self.send(client_socket, discovery_class(*entry))
+            return
+
+        for start in range(0, len(entries), DIRECTORY_PAGE_SIZE):
+            self.send(client_socket, directory_class(entries[start:start + DIRECTORY_PAGE_SIZE]))
+
+    def handle_list_clients(self, client_socket, message):
+        clients = [(other_client_data.client_id, other_client_data.client_nick)
+                   for other_client_data in self.connected_clients.all_client_data()]
+
+        self.send_directory(client_socket, clients, ClientDiscoveryMessage, ClientDirectoryMessage)
+
+    def handle_list_rooms(self, client_socket, message):
         client_data = self.get_client_data(client_socket)
+        rooms = []
 
-        if message.message_type is MessageType.LIST_CLIENTS:
-            for client in self.connected_clients:
-                other_client_data = self.get_client_data(client)
+        for room in list(self.server_rooms.values()):
+            if room.host_id == DIRECT_CHAT_ROOM_ID:
+                continue
 
-                new_msg = ClientDiscoveryMessage(other_client_data.client_id, other_client_data.client_nick)
-                send_message(client_socket, new_msg)
-            return
+            if client_data.client_id in room.authorized_clients:
+                rooms.append((room.room_id, room.title, room.host_id, room.host_nick))
+
+        self.send_directory(client_socket, rooms, RoomDiscoveryMessage, RoomDirectoryMessage)
+
+    def handle_list_room_members(self, client_socket, message):
+        room = self.server_rooms[message.room_id]
+
+        new_msg = RoomMembershipDiscoveryMessage(room.host_id, room.authorized_clients)
+        self.send(client_socket, new_msg)
 
-        if message.message_type is MessageType.LIST_ROOMS:
-            for room in self.server_rooms:
-                if room.host_id is DIRECT_CHAT_ROOM_ID:
-                    continue
+    def handle_room_create(self, client_socket, message):
+        client_data = self.get_client_data(client_socket)
 
-                if client_data.client_id in room.authorized_clients:
-                    owner_name = self.get_client_data_for_id(room.host_id).client_nick
-                    new_msg = RoomDiscoveryMessage(room.room_id, room.title, room.host_id, owner_name)
-                    send_message(client_socket, new_msg)
+        if message.host_id != client_data.client_id:
+            print("Not authorised to create room")
             return
 
-        if message.message_type is MessageType.LIST_ROOM_MEMBERS:
-            room = self.server_rooms[message.room_id]
+        new_room = self.create_room(message.title, message.host_id, client_data.client_nick)
+        new_msg = AcknowledgeRoomCreateMessage(new_room.room_id)
+        self.send(client_socket, new_msg)
 
-            new_msg = RoomMembershipDiscoveryMessage(room.host_id, room.authorized_clients)
-            send_message(client_socket, new_msg)
+        self.publish(RoomDiscoveryMessage(new_room.room_id, new_room.title, new_room.host_id,
+                                          client_data.client_nick))
 
-        if message.message_type is MessageType.ROOM_CREATE:
-            if message.host_id is not client_data.client_id:
-                print("Not authorised to create room")
-                return
+    def handle_room_invite(self, client_socket, message):
+        client_data = self.get_client_data(client_socket)
+
+        room = self.server_rooms.get(message.room_id)
 
-            new_room = self.create_room(message.title, message.host_id)
-            new_msg = AcknowledgeRoomCreateMessage(new_room.room_id)
-            send_message(client_socket, new_msg)
+        # Only host can invite people
+        if room is None or room.host_id != client_data.client_id:
             return
 
-        if message.message_type is MessageType.ROOM_INVITE:
+        self.invite_to_room(room, message.client_id)
+        self.publish(message)
 
-            for room in self.server_rooms:
-                if room.room_id is message.room_id:
+    def handle_initiate_user_chat(self, client_socket, message):
+        client_data = self.get_client_data(client_socket)
 
-                    # Only host can invite people
-                    if room.host_id is not client_data.client_id:
-                        return
+        other_user_data = self.get_client_data_for_id(message.user_id)
 
-                    room.invite(message.client_id)
+        if client_data.user_room_map.get(message.user_id) is None:
+            new_room = self.create_room("Direct Chat", DIRECT_CHAT_ROOM_ID, "")
+            room_id = new_room.room_id
 
-                    owner_name = self.get_client_data_for_id(room.host_id).client_nick
-                    new_msg = RoomDiscoveryMessage(room.room_id, room.title, room.host_id, owner_name)
-                    send_message(self.get_client_socket_for_id(message.client_id), new_msg)
+            # Invite both users
+            new_room.invite(client_data.client_id, client_data.client_nick)
+            new_room.invite(message.user_id, self.get_nick_for_id(message.user_id))
 
-                    for client_id in room.authorized_clients:
-                        dest_socket = self.get_client_socket_for_id(client_id)
-                        new_msg = RoomMembershipDiscoveryMessage(room.host_id, room.authorized_clients)
-                        send_message(dest_socket, new_msg)
-            return
+            self.link_direct_chat(room_id, client_data.client_id, message.user_id)
 
-        if message.message_type is MessageType.INITIATE_USER_CHAT:
-            other_user_data = self.get_client_data_for_id(message.user_id)
+            self.publish(RoomDiscoveryMessage(room_id, new_room.title, DIRECT_CHAT_ROOM_ID, ""))
+            self.publish(RoomInviteMessage(room_id, client_data.client_id))
+            self.publish(RoomInviteMessage(room_id, message.user_id))
+        else:
+            room_id = client_data.user_room_map[message.user_id]
 
-            if client_data.user_room_map.get(message.user_id) is None:
-                new_room = self.create_room("Direct Chat", DIRECT_CHAT_ROOM_ID)
-                room_id = new_room.room_id
+        new_msg = AcknowledgeUserChatMessage(room_id, other_user_data.client_id, other_user_data.client_nick)
+        self.send(client_socket, new_msg)
 
-                # Invite both users
-                new_room.invite(client_data.client_id)
-                new_room.invite(message.user_id)
+    def handle_room_message_send(self, client_socket, message):
+        client_data = self.get_client_data(client_socket)
 
-                # Set room in user room maps
-                client_data.user_room_map[message.user_id] = room_id
-                other_user_data.user_room_map[client_data.client_id] = room_id
-            else:
-                room_id = client_data.user_room_map[message.user_id]
+        text = message.text
+        timestamp = message.timestamp
+        room_id = message.room_id
+
+        room = self.server_rooms[room_id]
+        msg = RoomMessage(text, timestamp, client_data.client_id)
+
+        # Add resource if relevant
+        if message.resource_id != INVALID_ID:
+            msg.add_resource(message.resource_id)
+
+        room.send_message(msg)
+
+        new_msg = RoomEntryBroadcastMessage(room_id, text, timestamp, client_data.client_id, message.resource_id)
 
-            new_msg = AcknowledgeUserChatMessage(room_id, other_user_data.client_id, other_user_data.client_nick)
-            send_message(client_socket, new_msg)
+        # Send a message to all authorised clients
+        self.send_to_members(room, new_msg)
+        self.publish(new_msg)
+
+    def handle_blocking(self, client_socket, message):
+        reply = self.blocking_handlers[message.message_type](client_socket, message)
+        self.send_reply(client_socket, reply)
+
+    def send_reply(self, client_socket, reply):
+        # A blocking handler's reply is a message, an encoded frame and its
+        # type, or None if there is nothing to send
+        if reply is None:
             return
 
-        if message.message_type is MessageType.ROOM_MESSAGE_SEND:
-            text = message.text
-            timestamp = message.timestamp
-            room_id = message.room_id
+        if isinstance(reply, Message):
+            self.send(client_socket, reply)
+        else:
+            (frame, message_type) = reply
+            client_socket.send_frame(frame, message_type)
 
-            room = self.server_rooms[room_id]
-            msg = RoomMessage(text, timestamp)
+    def history_fetch_reply(self, client_socket, message):
+        client_data = self.get_client_data(client_socket)
 
-            # Add resource if relevant
-            if message.resource_id is not INVALID_ID:
-                msg.add_resource(message.resource_id)
+        room = self.server_rooms.get(message.room_id)
 
-            room.send_message(msg)
+        # Only members can read a room's history
+        if room is None or client_data.client_id not in room.authorized_clients:
+            return None
 
-            new_msg = RoomEntryBroadcastMessage(room_id, text, timestamp, client_data.client_id, message.resource_id)
+        return self.fetch_history(room, message.cursor, message.count, message.direction)
 
-            # Send a message to all authorised clients
-            for member_id in room.authorized_clients:
-                member_socket = self.get_client_socket_for_id(member_id)
-                send_message(member_socket, new_msg)
+    def resource_create_reply(self, client_socket, message):
+        resource_id = self.create_resource(message.data)
+        return AcknowledgeResourceMessage(resource_id)
 
-            return
+    def resource_fetch_reply(self, client_socket, message):
+        return self.get_resource_frame(message.resource_id), MessageType.RESOURCE_TRANSFER
 
-        if message.message_type == MessageType.RESOURCE_CREATE:
-            resource_id = self.create_resource(message.data)
+    def upload_begin_reply(self, client_socket, message):
+        if not is_valid_hash(message.digest):
+            print(f"WARN: Rejected upload with invalid hash {message.digest}")
+            return None
 
-            new_msg = AcknowledgeResourceMessage(resource_id)
-            send_message(client_socket, new_msg)
-            return
+        if not 0 <= message.size <= MAX_UPLOAD_SIZE:
+            print(f"WARN: Rejected upload of {message.size} bytes")
+            return None
 
-        if message.message_type == MessageType.RESOURCE_FETCH:
-            data = self.get_resource(message.resource_id)
+        return ResourceUploadAckMessage(message.digest, self.upload_offset(message.digest, message.size))
 
-            new_msg = ResourceTransferMessage(data)
-            send_message(client_socket, new_msg)
-            return
+    def upload_chunk_reply(self, client_socket, message):
+        if not is_valid_hash(message.digest) or len(message.data) > RESOURCE_CHUNK_SIZE:
+            print(f"WARN: Rejected invalid upload chunk {message}")
+            return None
+
+        offset = self.resource_store.write_partial(message.digest, message.offset, message.data)
+        if offset is None:
+            print(f"WARN: Rejected upload chunk past the declared size {message}")
+            return None
+
+        return ResourceUploadAckMessage(message.digest, offset)
 
-        print(f"Unsupported message: {message.message_type.name}")
+    def upload_end_reply(self, client_socket, message):
+        if not is_valid_hash(message.digest):
+            return None
 
-    def terminate_client(self, client_socket):
+        resource_id = self.resource_store.complete_partial(message.digest, self.allocate_resource_id)
+        if resource_id is None:
+            # Corrupt or missing, so the client must upload it again
+            print(f"WARN: Upload {message.digest} does not match its hash")
+            return ResourceUploadAckMessage(message.digest, 0)
+
+        return AcknowledgeResourceMessage(resource_id)
+
+    def resource_download_reply(self, client_socket, message):
+        if message.variant not in RESOURCE_VARIANTS:
+            print(f"WARN: Rejected download of unknown variant {message.variant}")
+            return None
+
+        frame = self.get_resource_chunk_frame(message.resource_id, message.offset, message.variant,
+                                              client_socket.version)
+        return frame, MessageType.RESOURCE_CHUNK
+
+    def terminate_client(self, client):
         try:
             # Remove from connected clients
-            client_data = self.connected_clients[client_socket]
-            self.connected_clients.pop(client_socket)
+            client_data = self.connected_clients.remove(client)
 
             # Broadcast disconnection message
-            print(f"STATUS: Client at {client_data.client_id} with nickname '{client_data.client_nick}' disconnected")
+            if client_data is not None:
+                print(f"STATUS: Client at {client_data.client_id} with nickname '{client_data.client_nick}' disconnected")
+                self.publish(ClientDepartureMessage(client_data.client_id))
         finally:
-            client_socket.close()
+            client.close()
 
-    def client_listener(self, client_socket):
+    def client_listener(self, client, reader):
         while True:
             # Continually receive from client until termination
             try:
-                msg = recv_message(client_socket)
+                msg = reader.read_message(client.version)
                 if msg is None:
-                    self.terminate_client(client_socket)
+                    self.terminate_client(client)
                     return
 
-                self.dispatch_message(client_socket, msg)
+                self.dispatch_message(client, msg)
             except Exception as e:
                 print_exception(e)
-                self.terminate_client(client_socket)
+                self.terminate_client(client)
                 return
 
-    def register_client(self, client_socket):
-        # Get unique id (server, port) for socket
-        socket_id = client_socket.getpeername()
-        print(f"STATUS: Incoming connection from {socket_id}")
-
-        # Get nickname from client
-        nick_message = recv_message(client_socket)
-
+    def login_client(self, client, nick_message):
         if not isinstance(nick_message, NicknameMessage):
-            error("ERROR: Client socket did not provide nickname - quitting")
-            client_socket.close()
-            return
+            print("ERROR: Client socket did not provide nickname - quitting")
+            return None
 
-        for cmp in self.connected_clients:
-            test_nick = self.connected_clients[cmp].client_nick
-            if nick_message.nickname == test_nick:
+        # Logins run concurrently, so the nickname check, id allocation and
+        # registration must happen atomically
+        with self.connected_clients.lock:
+            if self.connected_clients.has_nick(nick_message.nickname):
                 ack_message = AcknowledgeClientMessage(INVALID_ID)
-                send_message(client_socket, ack_message)
-                return
+                self.send(client, ack_message)
+                return None
 
-        # Create new client id
-        client_data = ClientData(self.next_user_id)
-        self.next_user_id += 1
+            # Create new client id
+            client_data = ClientData(self.next_user_id)
+            self.next_user_id += self.worker_count
 
-        client_data.client_nick = nick_message.nickname
+            client_data.client_nick = nick_message.nickname
 
-        # Acknowledge client and assign id
-        ack_message = AcknowledgeClientMessage(client_data.client_id)
-        send_message(client_socket, ack_message)
+            # Use the newest protocol version both sides support
+            client.version = negotiate_version(nick_message.version)
 
-        # Broadcast client discovery message
-        # This must be done before adding the current client to the connection list
-        self.broadcast(ClientDiscoveryMessage(client_data.client_id, client_data.client_nick))
+            # Acknowledge client and assign id
+            # This must be sent before any other thread can see the client
+            ack_message = AcknowledgeClientMessage(client_data.client_id, client.version)
+            self.send(client, ack_message)
 
-        # Add client connection to list
-        self.connected_clients[client_socket] = client_data
+            # Snapshot the existing clients for the discovery broadcast
+            # This must be done before adding the current client to the connection list
+            existing_clients = self.connected_clients.clients()
+
+            # Add client connection to list
+            self.connected_clients.add(client, client_data)
+
+        # Broadcast client discovery message
+        discovery_message = ClientDiscoveryMessage(client_data.client_id, client_data.client_nick)
+        self.broadcast(discovery_message, existing_clients)
+        self.publish(discovery_message)
         print(f"STATUS: {client_data.client_nick} connected to the server")
 
-        # Dispatch new thread with listener function
-        thread = Thread(target=self.client_listener, args=(client_socket,))
+        self.rejoin_rooms(client_data)
+
+        return client_data
+
+    def dispatch_bus_message(self, message):
+        # Handles state changes published by other worker processes. Each
+        # worker only notifies its own clients.
+        handler = self.bus_handlers.get(message.message_type)
+        if handler is None:
+            print(f"Unsupported bus message: {message.message_type.name}")
+            return
+
+        handler(message)
+
+    def handle_bus_client_discovery(self, message):
+        client_data = ClientData(message.client_id)
+        client_data.client_nick = message.nickname
+
+        self.connected_clients.add_remote(client_data)
+        self.broadcast(message)
+
+    def handle_bus_client_departure(self, message):
+        self.connected_clients.remove_remote(message.client_id)
+
+    def handle_bus_room_discovery(self, message):
+        self.add_room(message.room_id, message.title, message.host_id, message.host_name)
+
+    def handle_bus_room_invite(self, message):
+        room = self.server_rooms[message.room_id]
+
+        if room.host_id == DIRECT_CHAT_ROOM_ID:
+            self.join_direct_chat(room, message.client_id)
+        else:
+            self.invite_to_room(room, message.client_id)
+
+    def handle_bus_room_message_broadcast(self, message):
+        room = self.server_rooms[message.room_id]
+        msg = RoomMessage(message.text, message.timestamp, message.user_id)
+
+        # Add resource if relevant
+        if message.resource_id != INVALID_ID:
+            msg.add_resource(message.resource_id)
+
+        room.send_message(msg)
+        self.send_to_members(room, message)
+
+    def accept_client(self, raw_socket):
+        # Refuse new connections outright if too many are still logging in,
+        # rather than letting them queue up behind each other
+        if not self.pending_logins.acquire(blocking=False):
+            print("WARN: Too many pending logins - dropping connection")
+            raw_socket.close()
+            return
+
+        # Dispatch new thread which performs the handshake, login and then listens
+        thread = Thread(target=self.register_client, args=(raw_socket,))
         thread.daemon = True
         thread.start()
 
+    def register_client(self, raw_socket):
+        # Wrapping takes over the raw socket, so the wrapped one is closed on failure
+        client_socket = raw_socket
+
+        try:
+            # Get unique id (server, port) for socket
+            socket_id = raw_socket.getpeername()
+            print(f"STATUS: Incoming connection from {socket_id}")
+
+            # Stage 1: TLS handshake
+            raw_socket.settimeout(HANDSHAKE_TIMEOUT)
+            client_socket = self.context.wrap_socket(raw_socket, server_side=True)
+
+            # Stage 2: Get nickname from client, which must all arrive by the deadline
+            reader = FrameReader(client_socket, on_frame=self.metrics.frame_received)
+            reader.deadline = time.monotonic() + LOGIN_TIMEOUT
+            reader.max_frame_size = MAX_LOGIN_FRAME_SIZE
+            nick_message = reader.read_message()
+            reader.deadline = None
+            reader.max_frame_size = MAX_FRAME_SIZE
+            client_socket.settimeout(None)
+
+            client = ClientConnection(client_socket, OutboundQueue(self.slow_consumer_policy))
+            client.metrics = self.metrics
+
+            if self.login_client(client, nick_message) is None:
+                # Still deliver the rejection before closing
+                client.close(flush=True)
+                return
+        except (OSError, ValueError) as e:
+            # Covers handshake failures, timeouts in either stage and frames
+            # over the login limit
+            print(f"WARN: Login failed: {e}")
+            client_socket.close()
+            return
+        finally:
+            self.pending_logins.release()
+
+        # Logged in, so this thread becomes the listener for the client
+        self.client_listener(client, reader)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Encrypted chat server")
+    parser.add_argument("--host", default=SERVER_HOST)
+    parser.add_argument("--port", type=int, default=SERVER_PORT)
+    parser.add_argument("--engine", choices=SERVER_ENGINES, default=SERVER_ENGINE,
+                        help="'threaded' uses one thread per client, 'asyncio' uses a single event loop")
+    parser.add_argument("--workers", type=int, default=SERVER_WORKERS,
+                        help="number of worker processes sharing the port")
+    parser.add_argument("--metrics-port", type=int, default=METRICS_PORT,
+                        help="port to serve metrics on (each worker adds its index), or 0 to disable")
+    parser.add_argument("--slow-consumer-policy", choices=SLOW_CONSUMER_POLICIES, default=SLOW_CONSUMER_POLICY,
+                        help="what to do with messages for a client whose outbound queue is full")
+    args = parser.parse_args()
+
+    if args.engine == "asyncio":
+        from server_async import AsyncServer
+        server_type = AsyncServer
+    else:
+        server_type = Server
+
+    if args.workers > 1:
+        from server_cluster import run_cluster
+
+        def create_worker(worker_index, bus):
+            return server_type(args.host, args.port, worker_index, args.workers, bus, args.metrics_port,
+                               args.slow_consumer_policy)
+
+        run_cluster(create_worker, args.workers, BUS_SOCKET_PATH)
+    else:
+        server = server_type(args.host, args.port, metrics_port=args.metrics_port,
+                             slow_consumer_policy=args.slow_consumer_policy)
+        server.run()
+
 
 if __name__ == '__main__':
-    # Server properties
-    server = Server(SERVER_HOST, SERVER_PORT)
-    server.run()
+    main()
@@ -0,0 +1,188 @@
+# SE364 A2 Server (asyncio engine)
+# Name: Matthew Jakeman
+# UPI: mjak923
+
+import asyncio
+import time
+import traceback
+
+from config import HANDSHAKE_TIMEOUT, LOGIN_TIMEOUT, MAX_FRAME_SIZE, MAX_LOGIN_FRAME_SIZE
+from message import *
+from server import Server
+from server_connection import Connection, OutboundQueue
+from socket_utils import recv_message_async
+
+
+class AsyncClientConnection(Connection):
+    # A client stream for the asyncio server. Queued frames are written by a
+    # per-connection task which waits for the transport to drain, so a slow
+    # reader only ever fills its own queue.
+
+    writer = None
+    peer = None
+    ready = None
+    task = None
+
+    def __init__(self, writer, queue=None):
+        self.writer = writer
+        self.peer = writer.get_extra_info("peername")
+        self.queue = queue if queue is not None else OutboundQueue()
+        self.ready = asyncio.Event()
+        self.task = asyncio.get_running_loop().create_task(self.drain())
+
+    def __str__(self):
+        return str(self.peer)
+
+    def send_frame(self, frame, message_type, coalesce_key=None):
+        if self.closing:
+            return
+
+        if self.enqueue(frame, message_type, coalesce_key):
+            self.ready.set()
+
+    async def drain(self):
+        try:
+            while not self.closed:
+                await self.ready.wait()
+                self.ready.clear()
+
+                # Hand everything queued to the transport, then wait for it to flush
+                while len(self.queue) > 0:
+                    (frame, message_type) = self.queue.pop()
+                    self.writer.writelines(frame)
+                    self.sent(frame, message_type)
+
+                await self.writer.drain()
+
+                if self.closing:
+                    break
+        except ConnectionError:
+            # The reader notices the broken connection and terminates the client
+            pass
+
+        self.abort()
+
+    def abort(self):
+        self.closing = True
+        self.closed = True
+        self.ready.set()
+        self.writer.close()
+
+    def close(self, flush=False):
+        if flush and not self.closing:
+            # Let the drain task send what is queued, it closes the stream after
+            self.closing = True
+            self.ready.set()
+            return
+
+        self.abort()
+
+
+class AsyncServer(Server):
+    # Runs the same dispatch logic as the threaded server, but every
+    # connection is served by a coroutine on a single event loop.
+
+    async def serve(self):
+        # Connections are accepted unencrypted, and handle_connection does the
+        # handshake once it has a pending login slot, so handshakes in progress
+        # count towards MAX_PENDING_LOGINS as they do in the threaded engine
+        server = await asyncio.start_server(self.handle_connection, self.host, self.port,
+                                            reuse_address=True, reuse_port=self.worker_count > 1)
+
+        print("Server started listening localhost: {} (asyncio)".format(self.port))
+        self.start_bus()
+        self.start_metrics()
+        self.start_upload_expiry()
+
+        async with server:
+            await server.serve_forever()
+
+    def start_bus(self):
+        if self.bus is not None:
+            # Bus messages arrive on the bus listener thread, so hand them to the event loop
+            loop = asyncio.get_running_loop()
+            self.bus.start(lambda message: loop.call_soon_threadsafe(self.dispatch_bus_message, message))
+
+    async def dispatch_message_async(self, client, message):
+        # Blocking handlers read and write files (and make previews), which
+        # would hold up every connection, so they run on the default
+        # executor. The client's next message waits for them, keeping its
+        # replies in order, and the reply is sent from the event loop.
+        reply_handler = self.blocking_handlers.get(message.message_type)
+        if reply_handler is None:
+            self.dispatch_message(client, message)
+            return
+
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        try:
+            reply = await loop.run_in_executor(None, reply_handler, client, message)
+            self.send_reply(client, reply)
+        finally:
+            self.metrics.dispatched(message.message_type, time.perf_counter() - start)
+
+    def run(self):
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            print("Shutting down...")
+        finally:
+            self.message_store.close()
+
+    async def handle_connection(self, reader, writer):
+        socket_id = writer.get_extra_info("peername")
+        print(f"STATUS: Incoming connection from {socket_id}")
+
+        # Refuse new connections outright if too many are still logging in
+        if not self.pending_logins.acquire(blocking=False):
+            print("WARN: Too many pending logins - dropping connection")
+            writer.close()
+            return
+
+        try:
+            # Stage 1: TLS handshake
+            try:
+                await writer.start_tls(self.context, ssl_handshake_timeout=HANDSHAKE_TIMEOUT)
+            except (OSError, asyncio.TimeoutError) as e:
+                print(f"WARN: Handshake with {socket_id} failed: {e}")
+                writer.close()
+                return
+
+            # Stage 2: Get nickname from client
+            try:
+                nick_message = await asyncio.wait_for(recv_message_async(reader, on_frame=self.metrics.frame_received,
+                                                                         max_frame_size=MAX_LOGIN_FRAME_SIZE),
+                                                      LOGIN_TIMEOUT)
+            except asyncio.TimeoutError:
+                print(f"WARN: Login from {socket_id} timed out")
+                writer.close()
+                return
+            except ValueError as e:
+                # A malformed frame, such as an unknown type, invalid text or
+                # a frame over the login limit
+                print(f"WARN: Login from {socket_id} failed: {e}")
+                writer.close()
+                return
+
+            client = AsyncClientConnection(writer, OutboundQueue(self.slow_consumer_policy))
+            client.metrics = self.metrics
+
+            if self.login_client(client, nick_message) is None:
+                # Still deliver the rejection before closing
+                client.close(flush=True)
+                return
+        finally:
+            self.pending_logins.release()
+
+        try:
+            while True:
+                # Continually receive from client until termination
+                msg = await recv_message_async(reader, client.version, self.metrics.frame_received, MAX_FRAME_SIZE)
+                if msg is None:
+                    break
+
+                await self.dispatch_message_async(client, msg)
+        except Exception as e:
+            traceback.print_exception(e)
+        finally:
+            self.terminate_client(client)
@@ -0,0 +1,66 @@
+# Server Resource Cache
+# Name: Matthew Jakeman
+# UPI: mjak923
+
+from collections import OrderedDict
+from threading import Lock
+
+
+class ResourceCache:
+    # Least recently used cache limited by the total size (in bytes) of
+    # its values rather than their number. Values larger than the whole
+    # budget are never cached.
+
+    budget = None
+    size = 0
+
+    hits = 0
+    misses = 0
+
+    entries = None
+    lock = None
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+
+            if value is None:
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        if len(value) > self.budget:
+            return
+
+        with self.lock:
+            old_value = self.entries.pop(key, None)
+            if old_value is not None:
+                self.size -= len(old_value)
+
+            self.entries[key] = value
+            self.size += len(value)
+
+            # Evict least recently used values until back under budget
+            while self.size > self.budget:
+                (_, evicted) = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def get_or_load(self, key, load_func):
+        value = self.get(key)
+        if value is None:
+            value = load_func()
+            self.put(key, value)
+
+        return value
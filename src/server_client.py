@@ -9,3 +9,6 @@ class ClientData:
 
     def __init__(self, client_id):
         self.client_id = client_id
+
+        # Maps other client ids to the direct chat room shared with them
+        self.user_room_map = {}
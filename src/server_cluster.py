@@ -0,0 +1,160 @@
+# SE364 A2 Server (worker processes)
+# Name: Matthew Jakeman
+# UPI: mjak923
+
+import os
+import signal
+import sys
+import traceback
+
+from socket import *
+from threading import Thread, Lock
+
+from message import body_to_frame, PROTOCOL_V2, COMPRESSED_FLAG
+from socket_utils import send_message, send_buffers, FrameReader
+
+
+class BusHub:
+    # Runs in the parent process and relays every message published by one
+    # worker to all the other workers over a Unix socket. Workers use the
+    # regular message framing (and the v2 encoding, as compression is not
+    # worth it locally) on the bus, and the hub relays each frame as is
+    # without decoding it.
+
+    path = None
+    server_socket = None
+
+    workers = None
+    workers_lock = None
+
+    def __init__(self, path):
+        self.path = path
+        self.workers = {}
+        self.workers_lock = Lock()
+
+        if os.path.exists(path):
+            os.unlink(path)
+
+        self.server_socket = socket(AF_UNIX, SOCK_STREAM)
+        self.server_socket.bind(path)
+        self.server_socket.listen()
+
+    def run(self):
+        try:
+            while True:
+                worker_socket, _ = self.server_socket.accept()
+
+                with self.workers_lock:
+                    # Each worker socket has its own lock so relayed messages never interleave
+                    self.workers[worker_socket] = Lock()
+
+                thread = Thread(target=self.relay, args=(worker_socket,))
+                thread.daemon = True
+                thread.start()
+        finally:
+            self.server_socket.close()
+            os.unlink(self.path)
+
+    def relay(self, worker_socket):
+        reader = FrameReader(worker_socket)
+
+        try:
+            while True:
+                frame = reader.read_raw_frame()
+                if frame is None:
+                    break
+
+                (msg_type, body, compressed) = frame
+                frame = body_to_frame(msg_type | COMPRESSED_FLAG if compressed else msg_type, body)
+
+                with self.workers_lock:
+                    others = [(sock, lock) for (sock, lock) in self.workers.items() if sock is not worker_socket]
+
+                for (sock, lock) in others:
+                    with lock:
+                        send_buffers(sock, frame)
+        except OSError as e:
+            traceback.print_exception(e)
+        finally:
+            with self.workers_lock:
+                self.workers.pop(worker_socket, None)
+
+            worker_socket.close()
+
+
+class BusClient:
+    # A worker's connection to the hub. Incoming messages are handed to
+    # the server on a dedicated listener thread.
+
+    bus_socket = None
+    lock = None
+
+    def __init__(self, path):
+        self.bus_socket = socket(AF_UNIX, SOCK_STREAM)
+        self.bus_socket.connect(path)
+        self.lock = Lock()
+
+    def start(self, dispatch_func):
+        thread = Thread(target=self.listener, args=(dispatch_func,))
+        thread.daemon = True
+        thread.start()
+
+    def publish(self, message):
+        with self.lock:
+            send_message(self.bus_socket, message, PROTOCOL_V2)
+
+    def listener(self, dispatch_func):
+        reader = FrameReader(self.bus_socket)
+
+        while True:
+            msg = reader.read_message(PROTOCOL_V2)
+            if msg is None:
+                print("ERROR: Lost connection to the worker bus")
+                return
+
+            try:
+                dispatch_func(msg)
+            except Exception as e:
+                traceback.print_exception(e)
+
+
+def run_cluster(create_server, worker_count, bus_path):
+    # The hub must be listening before any worker tries to connect to it
+    hub = BusHub(bus_path)
+
+    # Fork before starting any threads in the parent
+    worker_pids = []
+    for worker_index in range(worker_count):
+        pid = os.fork()
+
+        if pid == 0:
+            hub.server_socket.close()
+
+            try:
+                server = create_server(worker_index, BusClient(bus_path))
+                server.run()
+            except Exception as e:
+                traceback.print_exception(e)
+            finally:
+                os._exit(0)
+
+        worker_pids.append(pid)
+
+    print(f"STATUS: Started {worker_count} workers")
+
+    # Make sure the workers are stopped along with the parent
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    try:
+        hub.run()
+    except KeyboardInterrupt:
+        print("Shutting down...")
+    finally:
+        for pid in worker_pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+        for pid in worker_pids:
+            os.waitpid(pid, 0)
@@ -0,0 +1,222 @@
+# Server Client Connection
+# Name: Matthew Jakeman
+# UPI: mjak923
+
+from collections import deque
+from socket import SHUT_RDWR
+from threading import Thread, Condition
+
+from config import SLOW_CONSUMER_POLICY, OUTBOUND_QUEUE_LIMIT, OUTBOUND_HIGH_WATER
+from message import message_to_frame, frame_size, MESSAGE_HEADER_SIZE, PROTOCOL_V1
+from socket_utils import send_buffers
+
+# Results of OutboundQueue.push
+QUEUED = 0
+DROPPED = 1
+OVERFLOW = 2
+
+# Frames are taken off the queue in batches of up to this many bytes, so
+# that several small frames are written at once
+WRITE_BATCH_SIZE = 64 * 1024
+
+
+class OutboundQueue:
+    # Bounded queue of encoded frames (tuples of buffers, see
+    # message_to_frame) waiting to be written to a client.
+    #
+    # Once the queue reaches its high-water mark (in frames or bytes) the
+    # slow consumer policy decides what happens to new frames:
+    #  - 'drop': the new frame is discarded
+    #  - 'coalesce': the new frame replaces a queued frame with the same
+    #    coalesce key (i.e. a newer copy of the same state), otherwise it
+    #    is discarded
+    #  - 'disconnect': the client is disconnected
+
+    frames = None
+    queued_bytes = 0
+    dropped = 0
+
+    policy = None
+    limit = None
+    high_water = None
+
+    def __init__(self, policy=SLOW_CONSUMER_POLICY, limit=OUTBOUND_QUEUE_LIMIT, high_water=OUTBOUND_HIGH_WATER):
+        self.frames = deque()
+        self.policy = policy
+        self.limit = limit
+        self.high_water = high_water
+
+    def __len__(self):
+        return len(self.frames)
+
+    def is_full(self):
+        return len(self.frames) >= self.limit or self.queued_bytes >= self.high_water
+
+    def push(self, frame, message_type, coalesce_key=None):
+        if not self.is_full():
+            self.frames.append((frame, message_type, coalesce_key))
+            self.queued_bytes += frame_size(frame)
+            return QUEUED
+
+        if self.policy == 'disconnect':
+            return OVERFLOW
+
+        if self.policy == 'coalesce' and coalesce_key is not None:
+            key = (message_type, coalesce_key)
+            for index, (old_frame, old_type, old_key) in enumerate(self.frames):
+                if (old_type, old_key) == key:
+                    self.frames[index] = (frame, message_type, coalesce_key)
+                    self.queued_bytes += frame_size(frame) - frame_size(old_frame)
+                    return QUEUED
+
+        self.dropped += 1
+        return DROPPED
+
+    def pop(self):
+        (frame, message_type, _) = self.frames.popleft()
+        self.queued_bytes -= frame_size(frame)
+        return frame, message_type
+
+    def pop_batch(self, batch_size=WRITE_BATCH_SIZE):
+        # Pops at least one frame, and more while they fit in batch_size
+        batch = [self.pop()]
+        size = frame_size(batch[0][0])
+
+        while self.frames and size + frame_size(self.frames[0][0]) <= batch_size:
+            batch.append(self.pop())
+            size += frame_size(batch[-1][0])
+
+        return batch
+
+
+class Connection:
+    # Common behaviour for a client connection with an outbound queue.
+    # Subclasses provide the writer that drains the queue.
+
+    queue = None
+
+    # Protocol version negotiated at login
+    version = PROTOCOL_V1
+
+    # ServerMetrics to record sent and dropped frames in, if any
+    metrics = None
+
+    # Set once the connection should stop accepting messages
+    closing = False
+    closed = False
+
+    def send(self, message):
+        frame = message_to_frame(message, self.version)
+        self.send_frame(frame, message.message_type, message.coalesce_key())
+
+    def send_frame(self, frame, message_type, coalesce_key=None):
+        raise Exception("Cannot send on the base Connection type")
+
+    def enqueue(self, frame, message_type, coalesce_key):
+        # Returns whether the writer needs to be woken
+        result = self.queue.push(frame, message_type, coalesce_key)
+
+        if result == OVERFLOW:
+            print(f"WARN: Disconnecting slow client {self}")
+            self.abort()
+            return False
+
+        if result == DROPPED:
+            print(f"WARN: Dropped message of type {message_type.name} for slow client {self}")
+            if self.metrics is not None:
+                self.metrics.frame_dropped(message_type)
+            return False
+
+        return True
+
+    def sent(self, frame, message_type):
+        # Called by the writer for each frame written
+        length = frame_size(frame)
+        if self.metrics is not None:
+            self.metrics.frame_sent(message_type, length)
+
+        extra_length = length - MESSAGE_HEADER_SIZE
+        if extra_length > 0:
+            print(f"DEBUG: Sent message of type {message_type.name} (length: {extra_length})")
+        else:
+            print(f"DEBUG: Sent message of type {message_type.name}")
+
+    def abort(self):
+        raise Exception("Cannot abort the base Connection type")
+
+
+class ClientConnection(Connection):
+    # A client socket for the threaded server. Messages are encoded on the
+    # sending thread and queued; a dedicated writer thread performs the
+    # (potentially blocking) socket writes, so one stalled reader never
+    # holds up the thread that is sending to it.
+
+    socket = None
+    peer = None
+    condition = None
+
+    def __init__(self, client_socket, queue=None):
+        self.socket = client_socket
+        self.peer = client_socket.getpeername()
+        self.queue = queue if queue is not None else OutboundQueue()
+        self.condition = Condition()
+
+        thread = Thread(target=self.writer, daemon=True)
+        thread.start()
+
+    def __str__(self):
+        return str(self.peer)
+
+    def send_frame(self, frame, message_type, coalesce_key=None):
+        with self.condition:
+            if self.closing:
+                return
+
+            if self.enqueue(frame, message_type, coalesce_key):
+                self.condition.notify()
+
+    def writer(self):
+        while True:
+            with self.condition:
+                while not self.closing and len(self.queue) == 0:
+                    self.condition.wait()
+
+                if self.closed or len(self.queue) == 0:
+                    break
+
+                batch = self.queue.pop_batch()
+
+            try:
+                send_buffers(self.socket, [buffer for (frame, _) in batch for buffer in frame])
+            except OSError:
+                # The listener notices the broken connection and terminates the client
+                break
+
+            for (frame, message_type) in batch:
+                self.sent(frame, message_type)
+
+        self.close()
+
+    def abort(self):
+        # Called with the condition held. Shutting down the socket wakes the
+        # listener (blocked in recv) so that it terminates the client.
+        self.closing = True
+        self.closed = True
+        self.condition.notify_all()
+
+        try:
+            self.socket.shutdown(SHUT_RDWR)
+        except OSError:
+            pass
+
+    def close(self, flush=False):
+        with self.condition:
+            if flush and not self.closing:
+                # Let the writer send what is queued, it closes the socket after
+                self.closing = True
+                self.condition.notify_all()
+                return
+
+            self.abort()
+
+        self.socket.close()
@@ -0,0 +1,479 @@
+# Server Message Log
+# Name: Matthew Jakeman
+# UPI: mjak923
+
+import json
+import os
+import struct
+import tempfile
+from bisect import bisect_right
+from collections import OrderedDict
+from threading import Event, Lock, Thread
+
+from config import LOG_SEGMENT_SIZE, LOG_INDEX_INTERVAL, LOG_SYNC_BATCH, LOG_SYNC_INTERVAL, MAX_OPEN_LOGS
+from message import message_to_frame, frame_size, parse_message, parse_message_header, MESSAGE_HEADER_SIZE
+
+# Log Format:
+#
+# Each room has a directory holding its log, split into segments. A
+# segment is named after the offset (message number) of its first record:
+#  - {base}.log: records, each one a complete wire message (header + content)
+#  - {base}.index: sparse index of (offset, file position) pairs, one for
+#    every LOG_INDEX_INTERVAL'th record
+#
+# Alongside the segments, room.json holds the room itself (its title, host
+# and members), so the server can restore its rooms after a restart.
+#
+# Records are only ever appended, so an append costs the same no matter how
+# long the history is, and a read seeks to the nearest indexed record
+# before scanning forward.
+#
+# A writable log only holds its active segment open while it is in use.
+# The store closes the least recently used logs beyond MAX_OPEN_LOGS, and
+# they are reopened by their next append.
+#
+# Appends never wait for the disk. The store's flusher thread syncs each
+# log within LOG_SYNC_INTERVAL, or as soon as it has LOG_SYNC_BATCH
+# unsynced records. Files closed with unsynced records (a sealed segment,
+# or an idle log) are left open for the flusher to sync and close. The
+# manifest is written by the flusher too.
+
+INDEX_ENTRY = struct.Struct(">QQ")
+SEGMENT_NAME_LENGTH = 20
+MANIFEST_NAME = "room.json"
+
+
+def segment_name(base_offset, extension):
+    return f"{base_offset:0{SEGMENT_NAME_LENGTH}d}.{extension}"
+
+
+class Segment:
+    base_offset = None
+    log_path = None
+    index_path = None
+
+    # Sparse index as two parallel lists for bisecting
+    index_offsets = None
+    index_positions = None
+
+    def __init__(self, directory, base_offset):
+        self.base_offset = base_offset
+        self.log_path = os.path.join(directory, segment_name(base_offset, "log"))
+        self.index_path = os.path.join(directory, segment_name(base_offset, "index"))
+
+        self.index_offsets = []
+        self.index_positions = []
+
+    def load_index(self):
+        self.index_offsets = []
+        self.index_positions = []
+
+        if not os.path.exists(self.index_path):
+            return
+
+        with open(self.index_path, "rb") as index_file:
+            data = index_file.read()
+
+        # Ignore a partially written trailing entry
+        usable = len(data) - len(data) % INDEX_ENTRY.size
+        for (offset, position) in INDEX_ENTRY.iter_unpack(data[:usable]):
+            self.index_offsets.append(offset)
+            self.index_positions.append(position)
+
+    def add_index_entry(self, offset, position):
+        self.index_offsets.append(offset)
+        self.index_positions.append(position)
+
+    def seek_position(self, offset):
+        # Returns the closest indexed (offset, position) at or before offset
+        index = bisect_right(self.index_offsets, offset) - 1
+        if index < 0:
+            return self.base_offset, 0
+
+        return self.index_offsets[index], self.index_positions[index]
+
+
+def scan_records(fd, position):
+    # Yields (position, record length) for each complete record from position
+    size = os.fstat(fd).st_size
+
+    while position + MESSAGE_HEADER_SIZE <= size:
+        header = os.pread(fd, MESSAGE_HEADER_SIZE, position)
+        (length, _) = parse_message_header(header)
+        record_length = MESSAGE_HEADER_SIZE + length
+
+        # A record cut short by a crash is not part of the log
+        if position + record_length > size:
+            return
+
+        yield position, record_length
+        position += record_length
+
+
+def read_manifest(directory):
+    path = os.path.join(directory, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return None
+
+    try:
+        with open(path, "r", encoding="utf-8") as manifest_file:
+            return json.load(manifest_file)
+    except ValueError as e:
+        print(f"WARN: Could not read room manifest {path}: {e}")
+        return None
+
+
+def write_manifest(directory, manifest):
+    # Write then rename, so the manifest is never seen half written
+    (fd, temp_path) = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as temp_file:
+            json.dump(manifest, temp_file)
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, os.path.join(directory, MANIFEST_NAME))
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+
+class RoomLog:
+    directory = None
+    writable = None
+
+    segments = None
+    next_offset = 0
+
+    # Active (last) segment, only opened when writable and in use
+    active_fd = None
+    active_size = 0
+    index_fd = None
+
+    # Called after every append, so the store knows which logs are in use
+    # and which need syncing
+    on_append = None
+
+    # Room manifest waiting to be written, and called when one is set
+    manifest = None
+    on_manifest = None
+
+    unsynced = 0
+    retired_fds = None  # Closed files still to be synced
+
+    lock = None
+    sync_lock = None  # Keeps syncs (and so manifest writes) in order
+
+    def __init__(self, directory, writable=True):
+        self.directory = directory
+        self.writable = writable
+        self.lock = Lock()
+        self.sync_lock = Lock()
+        self.retired_fds = []
+
+        os.makedirs(directory, exist_ok=True)
+        self.load()
+
+    def load(self):
+        bases = sorted(int(name[:SEGMENT_NAME_LENGTH]) for name in os.listdir(self.directory)
+                       if name.endswith(".log"))
+
+        if not bases:
+            bases = [0]
+
+        self.segments = [Segment(self.directory, base) for base in bases]
+        for segment in self.segments:
+            segment.load_index()
+
+        self.recover_active_segment()
+
+    def recover_active_segment(self):
+        # Finds the end of the last segment, repairing its tail and index
+        # after an unclean shutdown
+        active = self.segments[-1]
+        (offset, position) = active.seek_position(0xFFFFFFFFFFFFFFFF)
+
+        flags = os.O_RDWR | os.O_CREAT if self.writable else os.O_RDONLY
+        if not self.writable and not os.path.exists(active.log_path):
+            self.next_offset = active.base_offset
+            return
+
+        fd = os.open(active.log_path, flags, 0o644)
+        missing_entries = []
+
+        for (record_position, record_length) in scan_records(fd, position):
+            if offset % LOG_INDEX_INTERVAL == 0 and (not active.index_offsets or offset > active.index_offsets[-1]):
+                missing_entries.append((offset, record_position))
+
+            position = record_position + record_length
+            offset += 1
+
+        self.next_offset = offset
+
+        if self.writable:
+            # Drop any partially written record
+            os.ftruncate(fd, position)
+            self.active_size = position
+
+        os.close(fd)
+
+        if self.writable and missing_entries:
+            self.open_active()
+            for (entry_offset, entry_position) in missing_entries:
+                self.write_index_entry(active, entry_offset, entry_position)
+            self.close_active()
+
+    def open_active(self):
+        active = self.segments[-1]
+        self.active_fd = os.open(active.log_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        self.index_fd = os.open(active.index_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+
+    def close_active(self):
+        # Unsynced files are left for the next sync to close
+        if self.unsynced > 0:
+            self.retired_fds += [self.active_fd, self.index_fd]
+            self.unsynced = 0
+        else:
+            os.close(self.active_fd)
+            os.close(self.index_fd)
+
+        self.active_fd = None
+        self.index_fd = None
+
+    def write_index_entry(self, segment, offset, position):
+        os.write(self.index_fd, INDEX_ENTRY.pack(offset, position))
+        segment.add_index_entry(offset, position)
+
+    def append(self, message):
+        frame = message_to_frame(message)
+        record_length = frame_size(frame)
+
+        with self.lock:
+            if self.active_fd is None:
+                self.open_active()
+
+            if self.active_size >= LOG_SEGMENT_SIZE:
+                self.roll_segment()
+
+            active = self.segments[-1]
+            offset = self.next_offset
+
+            if offset % LOG_INDEX_INTERVAL == 0:
+                self.write_index_entry(active, offset, self.active_size)
+
+            # Unbuffered, so the record is visible to readers (and other
+            # processes) straight away even before it is synced
+            os.writev(self.active_fd, frame)
+            self.active_size += record_length
+            self.next_offset += 1
+            self.unsynced += 1
+
+        # Outside the lock, as the store may close other logs
+        if self.on_append is not None:
+            self.on_append(self)
+
+        return offset
+
+    def roll_segment(self):
+        # Seal the active segment and start a new one at the next offset
+        self.close_active()
+
+        self.segments.append(Segment(self.directory, self.next_offset))
+        self.open_active()
+        self.active_size = 0
+
+    def update_manifest(self, manifest):
+        # Written on the next sync, rather than by whoever changed the room
+        with self.lock:
+            self.manifest = manifest
+
+        if self.on_manifest is not None:
+            self.on_manifest()
+
+    def sync(self):
+        # Syncs duplicates of the files outside the lock, so appends carry
+        # on while the disk catches up
+        with self.sync_lock:
+            with self.lock:
+                fds = self.retired_fds
+                self.retired_fds = []
+
+                if self.active_fd is not None and self.unsynced > 0:
+                    fds += [os.dup(self.active_fd), os.dup(self.index_fd)]
+                    self.unsynced = 0
+
+                manifest = self.manifest
+                self.manifest = None
+
+            for fd in fds:
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+
+            if manifest is not None:
+                write_manifest(self.directory, manifest)
+
+    def needs_sync(self):
+        return self.unsynced > 0 or len(self.retired_fds) > 0 or self.manifest is not None
+
+    def close_idle(self):
+        # Safe to call on a log still in use, its next append reopens it.
+        # Leaves any unsynced records to the next sync.
+        with self.lock:
+            if self.active_fd is not None:
+                self.close_active()
+
+    def close(self):
+        self.close_idle()
+        self.sync()
+
+    def refresh(self):
+        # Read-only logs are written by another process, so pick up new
+        # records. Sealed segments never change, so only the last known
+        # segment and any new ones need to be reloaded.
+        if self.writable:
+            return
+
+        with self.lock:
+            known = self.segments[-1].base_offset
+            bases = sorted(int(name[:SEGMENT_NAME_LENGTH]) for name in os.listdir(self.directory)
+                           if name.endswith(".log"))
+
+            for base in bases:
+                if base > known:
+                    self.segments.append(Segment(self.directory, base))
+
+            for segment in self.segments:
+                if segment.base_offset >= known:
+                    segment.load_index()
+
+            self.recover_active_segment()
+
+    def read(self, start_offset, count):
+        # Returns up to count (offset, record) pairs starting at start_offset,
+        # where each record is the raw wire message
+        with self.lock:
+            end_offset = min(self.next_offset, start_offset + count)
+            segments = list(self.segments)
+
+        records = []
+        if start_offset >= end_offset or start_offset < 0:
+            return records
+
+        index = bisect_right([segment.base_offset for segment in segments], start_offset) - 1
+        offset = start_offset
+
+        while offset < end_offset and index < len(segments):
+            segment = segments[index]
+            (scan_offset, position) = segment.seek_position(offset)
+
+            fd = os.open(segment.log_path, os.O_RDONLY)
+            try:
+                for (record_position, record_length) in scan_records(fd, position):
+                    if scan_offset >= end_offset:
+                        break
+
+                    if scan_offset >= offset:
+                        records.append((scan_offset, os.pread(fd, record_length, record_position)))
+
+                    scan_offset += 1
+            finally:
+                os.close(fd)
+
+            offset = scan_offset
+            index += 1
+
+        return records
+
+    def read_messages(self, start_offset, count):
+        return [(offset, parse_message(record)) for (offset, record) in self.read(start_offset, count)]
+
+
+class MessageStore:
+    # Opens the log of each room and syncs the logs which have unsynced
+    # records on its own thread, so no record stays unsynced for much longer
+    # than LOG_SYNC_INTERVAL. At most max_open logs hold files open.
+
+    location = None
+    logs = None
+    lock = None
+
+    sync_needed = None  # Wakes the flusher before LOG_SYNC_INTERVAL is up
+
+    max_open = None
+    open_logs = None  # Logs holding files open, least recently appended first
+
+    def __init__(self, location, max_open=MAX_OPEN_LOGS):
+        self.location = location
+        self.logs = {}
+        self.lock = Lock()
+
+        self.max_open = max_open
+        self.open_logs = OrderedDict()
+        self.sync_needed = Event()
+
+        os.makedirs(location, exist_ok=True)
+
+        thread = Thread(target=self.flusher, daemon=True)
+        thread.start()
+
+    def room_ids(self):
+        # Rooms with a history on disk
+        return [int(name) for name in os.listdir(self.location) if name.isdigit()]
+
+    def read_manifest(self, room_id):
+        return read_manifest(os.path.join(self.location, str(room_id)))
+
+    def open_log(self, room_id, writable=True):
+        with self.lock:
+            log = self.logs.get(room_id)
+            if log is None:
+                log = RoomLog(os.path.join(self.location, str(room_id)), writable)
+                log.on_append = self.appended
+                log.on_manifest = self.sync_needed.set
+                self.logs[room_id] = log
+
+            return log
+
+    def appended(self, log):
+        if log.unsynced >= LOG_SYNC_BATCH:
+            self.sync_needed.set()
+
+        with self.lock:
+            self.open_logs[log.directory] = log
+            self.open_logs.move_to_end(log.directory)
+
+            idle = []
+            while len(self.open_logs) > self.max_open:
+                (_, idle_log) = self.open_logs.popitem(last=False)
+                idle.append(idle_log)
+
+        # Closed outside the store's lock, as closing waits for the log's own lock
+        for idle_log in idle:
+            idle_log.close_idle()
+
+        # Their files stay open until synced
+        if idle:
+            self.sync_needed.set()
+
+    def flusher(self):
+        while True:
+            self.sync_needed.wait(LOG_SYNC_INTERVAL)
+            self.sync_needed.clear()
+
+            with self.lock:
+                logs = list(self.logs.values())
+
+            for log in logs:
+                if log.needs_sync():
+                    try:
+                        log.sync()
+                    except OSError as e:
+                        print(f"ERROR: Could not sync room log {log.directory}: {e}")
+
+    def close(self):
+        with self.lock:
+            for log in self.logs.values():
+                log.close()
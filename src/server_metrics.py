@@ -0,0 +1,299 @@
+# Server Metrics
+# Name: Matthew Jakeman
+# UPI: mjak923
+
+import math
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from threading import Lock, Thread
+
+# Metrics:
+#
+# Counters, gauges and histograms, optionally with labels, kept in a
+# registry and exported in the Prometheus text format. Each metric holds
+# one value (or histogram) per combination of label values.
+#
+# Values which are cheaper to read when asked for (such as the number of
+# connected clients) are set by collectors, which the registry calls
+# before every export.
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Seconds, for latencies from tens of microseconds up to a few seconds
+LATENCY_BUCKETS = [0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1.0, 2.5]
+
+# Counts, for sizes of rooms and queues
+SIZE_BUCKETS = [0, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+
+
+def format_value(value):
+    if value == math.inf:
+        return "+Inf"
+
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+
+    return str(value)
+
+
+def format_labels(label_names, label_values, extra=""):
+    pairs = [f'{name}="{escape_label(str(value))}"' for (name, value) in zip(label_names, label_values)]
+    if extra:
+        pairs.append(extra)
+
+    if not pairs:
+        return ""
+
+    return "{" + ",".join(pairs) + "}"
+
+
+def escape_label(value):
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+class Metric:
+    metric_type = None
+
+    name = None
+    help = None
+    label_names = None
+
+    values = None
+    lock = None
+
+    def __init__(self, name, help, label_names=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+
+        self.values = {}  # label values -> value
+        self.lock = Lock()
+
+    def clear(self):
+        with self.lock:
+            self.values = {}
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.metric_type}"]
+
+        with self.lock:
+            values = list(self.values.items())
+
+        for (labels, value) in sorted(values):
+            lines.extend(self.render_value(labels, value))
+
+        return lines
+
+    def render_value(self, labels, value):
+        return [f"{self.name}{format_labels(self.label_names, labels)} {format_value(value)}"]
+
+
+class Counter(Metric):
+    metric_type = "counter"
+
+    def inc(self, amount=1, labels=()):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def set(self, value, labels=()):
+        # For counts kept elsewhere, which must still only ever go up
+        with self.lock:
+            self.values[labels] = value
+
+
+class Gauge(Metric):
+    metric_type = "gauge"
+
+    def set(self, value, labels=()):
+        with self.lock:
+            self.values[labels] = value
+
+    def inc(self, amount=1, labels=()):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def dec(self, amount=1, labels=()):
+        self.inc(-amount, labels)
+
+
+class Histogram(Metric):
+    # Each value is a list of the count in each bucket (not cumulative,
+    # the last bucket being +Inf), followed by the sum of the observations
+    metric_type = "histogram"
+
+    buckets = None
+
+    def __init__(self, name, help, buckets, label_names=()):
+        super(Histogram, self).__init__(name, help, label_names)
+        self.buckets = list(buckets) + [math.inf]
+
+    def observe(self, value, labels=()):
+        index = 0
+        while value > self.buckets[index]:
+            index += 1
+
+        with self.lock:
+            counts = self.values.get(labels)
+            if counts is None:
+                counts = [0] * len(self.buckets) + [0]
+                self.values[labels] = counts
+
+            counts[index] += 1
+            counts[-1] += value
+
+    def render_value(self, labels, value):
+        lines = []
+        total = 0
+
+        for (bound, count) in zip(self.buckets, value):
+            total += count
+            bucket_labels = format_labels(self.label_names, labels, f'le="{format_value(float(bound))}"')
+            lines.append(f"{self.name}_bucket{bucket_labels} {total}")
+
+        labels = format_labels(self.label_names, labels)
+        lines.append(f"{self.name}_sum{labels} {format_value(value[-1])}")
+        lines.append(f"{self.name}_count{labels} {total}")
+        return lines
+
+
+class MetricsRegistry:
+    metrics = None
+    collectors = None
+    lock = None
+
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+        self.lock = Lock()
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def add_collector(self, collect_func):
+        self.collectors.append(collect_func)
+
+    def render(self):
+        # Collectors update shared metrics, so only one export runs at a time
+        with self.lock:
+            for collect_func in self.collectors:
+                collect_func()
+
+            lines = []
+            for metric in self.metrics:
+                lines.extend(metric.render())
+
+        return "\n".join(lines) + "\n"
+
+
+class ServerMetrics:
+    # The metrics every server engine records
+
+    registry = None
+
+    frames_received = None
+    bytes_received = None
+    frames_sent = None
+    bytes_sent = None
+    frames_dropped = None
+    dispatch_latency = None
+
+    connected_clients = None
+    known_clients = None
+    rooms = None
+    room_members = None
+    queue_frames = None
+    queued_bytes = None
+
+    cache_hits = None
+    cache_misses = None
+    cache_bytes = None
+    cache_entries = None
+
+    def __init__(self):
+        registry = MetricsRegistry()
+        self.registry = registry
+
+        self.frames_received = registry.register(
+            Counter("chat_frames_received_total", "Frames received from clients", ["type"]))
+        self.bytes_received = registry.register(
+            Counter("chat_bytes_received_total", "Bytes received from clients, including headers", ["type"]))
+        self.frames_sent = registry.register(
+            Counter("chat_frames_sent_total", "Frames written to clients", ["type"]))
+        self.bytes_sent = registry.register(
+            Counter("chat_bytes_sent_total", "Bytes written to clients, including headers", ["type"]))
+        self.frames_dropped = registry.register(
+            Counter("chat_frames_dropped_total", "Frames dropped for slow clients", ["type"]))
+        self.dispatch_latency = registry.register(
+            Histogram("chat_dispatch_seconds", "Time taken to handle a message from a client",
+                      LATENCY_BUCKETS, ["type"]))
+
+        self.connected_clients = registry.register(
+            Gauge("chat_connected_clients", "Clients connected to this server"))
+        self.known_clients = registry.register(
+            Gauge("chat_known_clients", "Clients connected to any worker"))
+        self.rooms = registry.register(
+            Gauge("chat_rooms", "Rooms, including direct chats"))
+        self.room_members = registry.register(
+            Histogram("chat_room_members", "Members in each room", SIZE_BUCKETS))
+        self.queue_frames = registry.register(
+            Histogram("chat_outbound_queue_frames", "Frames queued for each connected client", SIZE_BUCKETS))
+        self.queued_bytes = registry.register(
+            Gauge("chat_outbound_queue_bytes", "Bytes queued for all connected clients"))
+
+        self.cache_hits = registry.register(
+            Counter("chat_resource_cache_hits_total", "Resource cache hits"))
+        self.cache_misses = registry.register(
+            Counter("chat_resource_cache_misses_total", "Resource cache misses"))
+        self.cache_bytes = registry.register(
+            Gauge("chat_resource_cache_bytes", "Bytes held in the resource cache"))
+        self.cache_entries = registry.register(
+            Gauge("chat_resource_cache_entries", "Entries held in the resource cache"))
+
+    def frame_received(self, msg_type, length):
+        labels = (msg_type.name,)
+        self.frames_received.inc(labels=labels)
+        self.bytes_received.inc(length, labels)
+
+    def frame_sent(self, msg_type, length):
+        labels = (msg_type.name,)
+        self.frames_sent.inc(labels=labels)
+        self.bytes_sent.inc(length, labels)
+
+    def frame_dropped(self, msg_type):
+        self.frames_dropped.inc(labels=(msg_type.name,))
+
+    def dispatched(self, msg_type, seconds):
+        self.dispatch_latency.observe(seconds, (msg_type.name,))
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+
+        body = self.server.registry.render().encode()
+
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes are too frequent to be worth logging
+        pass
+
+
+def start_metrics_server(registry, host, port):
+    # Serves the registry at http://host:port/metrics on a background thread
+    http_server = ThreadingHTTPServer((host, port), MetricsRequestHandler)
+    http_server.daemon_threads = True
+    http_server.registry = registry
+
+    thread = Thread(target=http_server.serve_forever, daemon=True)
+    thread.start()
+
+    print(f"STATUS: Serving metrics on http://{host}:{http_server.server_address[1]}/metrics")
+    return http_server
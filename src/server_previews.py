@@ -0,0 +1,66 @@
+# Server Resource Previews
+# Name: Matthew Jakeman
+# UPI: mjak923
+
+import io
+
+from config import RESOURCE_PREVIEW_SIZE, RESOURCE_PREVIEW_QUALITY
+from message import RESOURCE_PREVIEW
+
+# Pillow is optional. Without it every variant is the original.
+try:
+    from PIL import Image, ImageOps, UnidentifiedImageError
+except ImportError:
+    Image = None
+
+# Resource Previews:
+#
+# Previews are scaled down copies of images, small enough to show in a
+# chat without downloading the original. They are saved as JPEG, unless
+# the image has transparency (PNG).
+#
+# Each function takes the original's bytes and returns the variant's, or
+# None if the original should be used as is (not an image, already small
+# enough, or the smaller copy turned out larger).
+
+
+def make_preview(data):
+    try:
+        image = Image.open(io.BytesIO(data))
+
+        if image.width <= RESOURCE_PREVIEW_SIZE[0] and image.height <= RESOURCE_PREVIEW_SIZE[1]:
+            return None
+
+        # Let JPEGs decode at a reduced scale, which is much faster for photos
+        image.draft("RGB", RESOURCE_PREVIEW_SIZE)
+
+        # Photos are often stored sideways with an orientation tag
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail(RESOURCE_PREVIEW_SIZE)
+
+        output = io.BytesIO()
+        if image.mode in ("RGBA", "LA") or "transparency" in image.info:
+            image.save(output, "PNG", optimize=True)
+        else:
+            image.convert("RGB").save(output, "JPEG", quality=RESOURCE_PREVIEW_QUALITY, optimize=True)
+    except UnidentifiedImageError:
+        # Not an image
+        return None
+    except Exception as e:
+        print(f"WARN: Could not make a preview: {e}")
+        return None
+
+    preview = output.getvalue()
+    if len(preview) >= len(data):
+        return None
+
+    return preview
+
+
+def variant_makers():
+    # Variant -> function making it, for the variants this server can make
+    if Image is None:
+        print("WARN: Pillow is not installed, so images will not have previews")
+        return {}
+
+    return {RESOURCE_PREVIEW: make_preview}
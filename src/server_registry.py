@@ -0,0 +1,103 @@
+# Server Client Registry
+# Name: Matthew Jakeman
+# UPI: mjak923
+
+from threading import RLock
+
+
+class ClientRegistry:
+    # Indexes connected clients by connection, id and nickname. All three
+    # indexes are only ever updated together (under the lock) so that a
+    # lookup never sees a half-registered client.
+    #
+    # A 'client' is the connection object the server engine uses to talk to
+    # a locally connected client.
+    #
+    # When running with several worker processes, clients connected to other
+    # workers are also tracked (without a connection) so that they can be
+    # looked up by id and nickname.
+
+    lock = None
+
+    client_data = None
+    client_ids = None
+    client_nicks = None
+    remote_data = None
+
+    def __init__(self):
+        self.lock = RLock()
+
+        self.client_data = {}   # client -> ClientData
+        self.client_ids = {}    # client_id -> client
+        self.client_nicks = {}  # nickname -> client_id
+        self.remote_data = {}   # client_id -> ClientData
+
+    def __len__(self):
+        return len(self.client_data)
+
+    def __contains__(self, client):
+        return client in self.client_data
+
+    def add(self, client, client_data):
+        with self.lock:
+            if client_data.client_nick in self.client_nicks:
+                return False
+
+            self.client_data[client] = client_data
+            self.client_ids[client_data.client_id] = client
+            self.client_nicks[client_data.client_nick] = client_data.client_id
+            return True
+
+    def remove(self, client):
+        with self.lock:
+            client_data = self.client_data.pop(client, None)
+            if client_data is None:
+                return None
+
+            self.client_ids.pop(client_data.client_id, None)
+            self.client_nicks.pop(client_data.client_nick, None)
+            return client_data
+
+    def add_remote(self, client_data):
+        with self.lock:
+            if client_data.client_nick in self.client_nicks:
+                return False
+
+            self.remote_data[client_data.client_id] = client_data
+            self.client_nicks[client_data.client_nick] = client_data.client_id
+            return True
+
+    def remove_remote(self, client_id):
+        with self.lock:
+            client_data = self.remote_data.pop(client_id, None)
+            if client_data is None:
+                return None
+
+            self.client_nicks.pop(client_data.client_nick, None)
+            return client_data
+
+    def has_nick(self, nickname):
+        return nickname in self.client_nicks
+
+    def get_data(self, client):
+        return self.client_data.get(client)
+
+    def get_client_for_id(self, client_id):
+        return self.client_ids.get(client_id)
+
+    def get_data_for_id(self, client_id):
+        client = self.client_ids.get(client_id)
+        if client is None:
+            return self.remote_data.get(client_id)
+
+        return self.client_data.get(client)
+
+    def clients(self):
+        # Snapshot, so callers may send without holding the lock
+        with self.lock:
+            return list(self.client_data)
+
+    def all_client_data(self):
+        # Includes clients connected to other workers
+        with self.lock:
+            return list(self.client_data.values()) + list(self.remote_data.values())
@@ -0,0 +1,358 @@
+# Server Resource Store
+# Name: Matthew Jakeman
+# UPI: mjak923
+
+import hashlib
+import os
+import tempfile
+import time
+from threading import Lock
+
+from message import RESOURCE_ORIGINAL
+
+# Resource Store:
+#
+# Resource bodies are stored once per unique content, named after the
+# SHA-256 of their bytes and sharded into two levels of subdirectories
+# (blobs/ab/cd/abcd...) so no single directory grows too large.
+#
+# Resource ids map to blobs through an append-only index file, with one
+# "{resource_id} {hash}" line per resource. Resources are never removed,
+# as chat history refers to them for as long as it is kept, so blobs are
+# never deleted either.
+#
+# Chunked uploads are written to partial/{hash}, named after the hash the
+# uploader declared, so an interrupted upload resumes from the partial
+# file's size (on any worker). Once complete and verified the partial file
+# is moved into place as the blob. The size declared when the upload began
+# is kept in partial/{hash}.size, and chunks past it are refused. Uploads
+# left untouched for long enough are deleted.
+#
+# Other variants of a blob (such as image previews) are made as the blob is
+# added, by the functions given to the store, and kept alongside it in
+# variants/ab/cd/abcd....{variant}. Where a variant would be no different,
+# the original is linked in its place, so each is only ever made once.
+# Blobs added before a variant could be made get theirs on first use.
+
+BLOB_DIRECTORY = "blobs"
+VARIANT_DIRECTORY = "variants"
+PARTIAL_DIRECTORY = "partial"
+SIZE_SUFFIX = ".size"
+INDEX_NAME = "index"
+
+
+HASH_LENGTH = 64
+HASH_DIGITS = "0123456789abcdef"
+HASH_READ_SIZE = 1024 * 1024
+
+
+def content_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def file_hash(path):
+    # Hashes a file without reading it all into memory
+    sha = hashlib.sha256()
+
+    with open(path, "rb") as file:
+        while chunk := file.read(HASH_READ_SIZE):
+            sha.update(chunk)
+
+    return sha.hexdigest()
+
+
+def write_file(path, data):
+    # Write then rename, with a temporary name unique to this call, so the
+    # file is never seen half written
+    (fd, temp_path) = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as temp_file:
+            temp_file.write(data)
+
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+
+def is_valid_hash(blob_hash):
+    # Hashes are used in file names, so never trust one from a client
+    return len(blob_hash) == HASH_LENGTH and all(digit in HASH_DIGITS for digit in blob_hash)
+
+
+class ResourceStore:
+    location = None
+    index_path = None
+
+    resource_hashes = None
+
+    # How much of the index has been read, as other workers may append to it
+    index_position = 0
+
+    # Variant -> function making it from the original's bytes
+    variant_makers = None
+
+    lock = None
+
+    def __init__(self, location, variant_makers=None):
+        self.location = location
+        self.index_path = os.path.join(location, INDEX_NAME)
+        self.variant_makers = variant_makers or {}
+
+        self.resource_hashes = {}
+        self.lock = Lock()
+
+        os.makedirs(os.path.join(location, BLOB_DIRECTORY), exist_ok=True)
+        os.makedirs(os.path.join(location, PARTIAL_DIRECTORY), exist_ok=True)
+        self.load_index()
+
+    def load_index(self):
+        # Reads any index lines appended since the last call
+        if not os.path.exists(self.index_path):
+            return
+
+        with open(self.index_path, "rb") as index_file:
+            index_file.seek(self.index_position)
+            data = index_file.read()
+
+        # Leave a partially written last line for next time
+        usable = data.rfind(b"\n") + 1
+        self.index_position += usable
+
+        for line in data[:usable].decode().splitlines():
+            (resource_id, blob_hash) = line.split(" ")
+            self.resource_hashes[int(resource_id)] = blob_hash
+
+    def write_index_entry(self, resource_id, blob_hash):
+        # Single small appends, so lines from several processes never interleave
+        line = f"{resource_id} {blob_hash}\n".encode()
+
+        fd = os.open(self.index_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+
+        # Reading back also picks up any lines other workers appended first
+        self.load_index()
+
+    def blob_path(self, blob_hash):
+        return os.path.join(self.location, BLOB_DIRECTORY, blob_hash[0:2], blob_hash[2:4], blob_hash)
+
+    def legacy_path(self, resource_id):
+        # Resources stored before the content-addressed store was introduced
+        return os.path.join(self.location, f"{resource_id}.png")
+
+    def resource_ids(self):
+        legacy_ids = [int(name[:-len(".png")]) for name in os.listdir(self.location)
+                      if name.endswith(".png") and name[:-len(".png")].isdigit()]
+
+        with self.lock:
+            self.load_index()
+            return list(self.resource_hashes) + legacy_ids
+
+    def get_hash(self, resource_id):
+        with self.lock:
+            blob_hash = self.resource_hashes.get(resource_id)
+            if blob_hash is None:
+                # Possibly created by another worker
+                self.load_index()
+                blob_hash = self.resource_hashes.get(resource_id)
+
+            return blob_hash
+
+    def get_path(self, resource_id):
+        blob_hash = self.get_hash(resource_id)
+        if blob_hash is None:
+            return self.legacy_path(resource_id)
+
+        return self.blob_path(blob_hash)
+
+    def variant_path(self, blob_hash, variant):
+        return os.path.join(self.location, VARIANT_DIRECTORY, blob_hash[0:2], blob_hash[2:4],
+                            f"{blob_hash}.{variant}")
+
+    def get_variant_path(self, resource_id, variant):
+        # Variants which cannot be made here are the original
+        blob_hash = self.get_hash(resource_id)
+        if variant == RESOURCE_ORIGINAL or variant not in self.variant_makers or blob_hash is None:
+            return self.get_path(resource_id)
+
+        path = self.variant_path(blob_hash, variant)
+        if not os.path.exists(path):
+            self.make_variants(blob_hash)
+
+        return path
+
+    def make_variants(self, blob_hash):
+        # Makes any missing variants of a blob, so never while holding the
+        # lock. Several threads or workers may make the same variant at
+        # once, which is harmless as they all make the same file.
+        path = self.blob_path(blob_hash)
+        data = None
+
+        for (variant, make_variant) in self.variant_makers.items():
+            variant_path = self.variant_path(blob_hash, variant)
+            if os.path.exists(variant_path):
+                continue
+
+            if data is None:
+                with open(path, "rb") as blob:
+                    data = blob.read()
+
+            os.makedirs(os.path.dirname(variant_path), exist_ok=True)
+
+            variant_data = make_variant(data)
+            if variant_data is not None:
+                write_file(variant_path, variant_data)
+                continue
+
+            try:
+                os.link(path, variant_path)
+            except FileExistsError:
+                # Made by someone else in the meantime
+                pass
+            except OSError:
+                # The file system has no hard links
+                write_file(variant_path, data)
+
+    def get(self, resource_id):
+        with open(self.get_path(resource_id), "rb") as blob:
+            return blob.read()
+
+    def read_chunk(self, resource_id, offset, length, variant=RESOURCE_ORIGINAL):
+        # Returns up to length bytes from offset, and the total size
+        fd = os.open(self.get_variant_path(resource_id, variant), os.O_RDONLY)
+        try:
+            total = os.fstat(fd).st_size
+            return os.pread(fd, length, offset), total
+        finally:
+            os.close(fd)
+
+    def create(self, resource_id, data):
+        blob_hash = content_hash(data)
+        path = self.blob_path(blob_hash)
+
+        with self.lock:
+            self.load_index()
+
+            # Duplicate content only costs an index entry
+            if not os.path.exists(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                write_file(path, data)
+
+            self.write_index_entry(resource_id, blob_hash)
+
+        self.make_variants(blob_hash)
+        return blob_hash
+
+    def partial_path(self, blob_hash):
+        return os.path.join(self.location, PARTIAL_DIRECTORY, blob_hash)
+
+    def size_path(self, blob_hash):
+        return self.partial_path(blob_hash) + SIZE_SUFFIX
+
+    def begin_partial(self, blob_hash, size):
+        # Records the declared size of an upload, and returns how much of it
+        # has been received (None if the content is already stored)
+        offset = self.partial_size(blob_hash)
+        if offset is None:
+            return None
+
+        write_file(self.size_path(blob_hash), str(size).encode())
+        return offset
+
+    def declared_size(self, blob_hash):
+        try:
+            with open(self.size_path(blob_hash), "rb") as size_file:
+                return int(size_file.read())
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def partial_size(self, blob_hash):
+        # How much of an upload has been received
+        if os.path.exists(self.blob_path(blob_hash)):
+            return None
+
+        try:
+            return os.path.getsize(self.partial_path(blob_hash))
+        except FileNotFoundError:
+            return 0
+
+    def write_partial(self, blob_hash, offset, data):
+        # Chunks may be repeated but never leave a gap. Every upload of the
+        # same hash has the same content, so concurrent uploads are harmless.
+        # Returns None for chunks of uploads which were never begun, or
+        # which go past the declared size.
+        size = self.declared_size(blob_hash)
+        if size is None or offset + len(data) > size:
+            return None
+
+        fd = os.open(self.partial_path(blob_hash), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            size = os.fstat(fd).st_size
+            if offset <= size:
+                os.pwrite(fd, data, offset)
+                size = max(size, offset + len(data))
+
+            return size
+        finally:
+            os.close(fd)
+
+    def complete_partial(self, blob_hash, allocate_id):
+        # Adds a finished upload under an id from allocate_id, and returns
+        # the id, or None if its content does not match the declared hash
+        # (in which case the upload starts over). The id is only allocated
+        # once the content is verified, so failed uploads never use one.
+        path = self.blob_path(blob_hash)
+        partial_path = self.partial_path(blob_hash)
+
+        with self.lock:
+            self.load_index()
+
+            if not os.path.exists(path):
+                if not os.path.exists(partial_path):
+                    return None
+
+                if file_hash(partial_path) != blob_hash:
+                    os.unlink(partial_path)
+                    return None
+
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(partial_path, path)
+
+            resource_id = allocate_id()
+            self.write_index_entry(resource_id, blob_hash)
+
+            try:
+                os.unlink(self.size_path(blob_hash))
+            except FileNotFoundError:
+                pass
+
+        self.make_variants(blob_hash)
+        return resource_id
+
+    def expire_partials(self, max_age):
+        # Deletes uploads (and their sizes) not written to for max_age seconds
+        directory = os.path.join(self.location, PARTIAL_DIRECTORY)
+        last_used = {}
+
+        for name in os.listdir(directory):
+            try:
+                modified = os.path.getmtime(os.path.join(directory, name))
+            except FileNotFoundError:
+                continue
+
+            blob_hash = name[:HASH_LENGTH]
+            last_used[blob_hash] = max(last_used.get(blob_hash, 0), modified)
+
+        expired = [blob_hash for (blob_hash, modified) in last_used.items() if modified < time.time() - max_age]
+        for name in os.listdir(directory):
+            if name[:HASH_LENGTH] in expired:
+                try:
+                    os.unlink(os.path.join(directory, name))
+                except FileNotFoundError:
+                    pass
+
+        return len(expired)
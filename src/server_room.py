@@ -3,44 +3,102 @@
 # UPI: mjak923
 
 from config import INVALID_ID, DIRECT_CHAT_ROOM_ID
+from message import RoomEntryBroadcastMessage
 
 
 class RoomMessage:
     text = None
     timestamp = None
+    user_id = INVALID_ID
     resource_id = INVALID_ID
 
-    def __init__(self, text, timestamp):
+    def __init__(self, text, timestamp, user_id=INVALID_ID):
         self.text = text
         self.timestamp = timestamp
+        self.user_id = user_id
 
     def add_resource(self, resource_id):
         self.resource_id = resource_id
 
+    def to_broadcast(self, room_id):
+        return RoomEntryBroadcastMessage(room_id, self.text, self.timestamp, self.user_id, self.resource_id)
+
 
 class Room:
     authorized_clients = None
     title = None
     host_id = None
+    host_nick = None
     room_id = None
 
-    messages = []
+    # Nickname -> current client id of each member. Client ids only last
+    # for a session, so members are saved (and rejoin) by nickname.
+    members = None
+
+    # Largest client id that has been a member, so that after a restart no
+    # client is given the id of an old member (or of an old message's sender)
+    last_client_id = INVALID_ID
+
+    # Persistent message history and manifest (see server_log.py)
+    log = None
 
-    def __init__(self, room_id, title, host_id):
+    def __init__(self, room_id, title, host_id, host_nick, log=None):
         self.room_id = room_id
         self.title = title
         self.host_id = host_id
+        self.host_nick = host_nick
+        self.log = log
 
         self.authorized_clients = set()
+        self.members = {}
 
         # Direct chats do not have a host (host_id = DIRECT_CHAT_ROOM_ID)
         if host_id != DIRECT_CHAT_ROOM_ID:
             self.authorized_clients.add(host_id)
+            self.members[host_nick] = host_id
+            self.last_client_id = host_id
+
+    def restore(self, manifest):
+        # Members keep their old ids until they log in again
+        self.members = dict(manifest["members"])
+        self.authorized_clients = set(self.members.values())
+        self.last_client_id = manifest["last_client_id"]
+
+    def to_manifest(self):
+        return {
+            "title": self.title,
+            "host_id": self.host_id,
+            "host": self.host_nick,
+            "members": dict(self.members),
+            "last_client_id": self.last_client_id,
+        }
 
-    def invite(self, client_id):
+    def save(self):
+        # Only the process which writes the room's log saves the room
+        if self.log is not None and self.log.writable:
+            self.log.update_manifest(self.to_manifest())
+
+    def invite(self, client_id, nick=None):
         # Reject invalid client IDs
-        if client_id >= 0:
-            self.authorized_clients.add(client_id)
+        if client_id < 0:
+            return
+
+        self.authorized_clients.add(client_id)
+        self.last_client_id = max(self.last_client_id, client_id)
+
+        if nick is not None:
+            # A member logging in again replaces their old id
+            old_id = self.members.get(nick)
+            if old_id is not None and old_id != client_id:
+                self.authorized_clients.discard(old_id)
+
+            self.members[nick] = client_id
+            if nick == self.host_nick and self.host_id != DIRECT_CHAT_ROOM_ID:
+                self.host_id = client_id
+
+        self.save()
 
     def send_message(self, room_message):
-        self.messages.append(room_message)
+        # Only one process appends to each log, other workers read it
+        if self.log is not None and self.log.writable:
+            self.log.append(room_message.to_broadcast(self.room_id))
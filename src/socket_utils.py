@@ -1,14 +1,69 @@
 # Socket Utils
 # Name: Matthew Jakeman
 # UPI: mjak923
+import asyncio
+import socket
+import ssl
+import time
 import traceback
 
 from message import *
 
-MAX_SOCKET_TRANSFER = 1024
+# Frames up to this size are read into a connection's reusable buffer
+RECEIVE_BUFFER_SIZE = 64 * 1024
 
+# Buffers smaller than this are joined into a single TLS write
+TLS_JOIN_SIZE = 16 * 1024
 
-def send_message(sender_socket, msg):
+# Most buffers passed to a single sendmsg
+MAX_SEND_BUFFERS = 64
+
+
+def send_buffers(sender_socket, buffers):
+    # Writes the buffers in order. Plain sockets take them all in vectored
+    # sendmsg calls. TLS sockets cannot, so runs of small buffers (headers
+    # and small bodies) are joined into one write, while large buffers are
+    # written as they are rather than being copied.
+    if isinstance(sender_socket, ssl.SSLSocket):
+        pending = []
+        pending_size = 0
+
+        for buffer in buffers:
+            if len(buffer) < TLS_JOIN_SIZE:
+                pending.append(buffer)
+                pending_size += len(buffer)
+
+                if pending_size < TLS_JOIN_SIZE:
+                    continue
+
+            if pending:
+                sender_socket.sendall(b"".join(pending))
+                pending = []
+                pending_size = 0
+
+            if len(buffer) >= TLS_JOIN_SIZE:
+                sender_socket.sendall(buffer)
+
+        if pending:
+            sender_socket.sendall(b"".join(pending))
+        return
+
+    views = [memoryview(buffer) for buffer in buffers if len(buffer) > 0]
+    index = 0
+
+    while index < len(views):
+        sent = sender_socket.sendmsg(views[index:index + MAX_SEND_BUFFERS])
+
+        # Skip what was written, which may end part way through a buffer
+        while index < len(views) and sent >= len(views[index]):
+            sent -= len(views[index])
+            index += 1
+
+        if sent > 0:
+            views[index] = views[index][sent:]
+
+
+def send_message(sender_socket, msg, version=PROTOCOL_V1):
     if msg is None:
         print("WARN: Attempted to send null message")
         traceback.print_stack()
@@ -19,52 +74,248 @@ def send_message(sender_socket, msg):
         traceback.print_stack()
         return
 
-    byte_data = message_to_wire(msg)
-    sender_socket.sendall(byte_data)
+    frame = message_to_frame(msg, version)
+    send_buffers(sender_socket, frame)
 
-    extra_length = len(byte_data) - MESSAGE_HEADER_SIZE
+    extra_length = frame_size(frame) - MESSAGE_HEADER_SIZE
     if extra_length > 0:
         print(f"DEBUG: Sent message of type {msg.message_type.name} (length: {extra_length})")
     else:
         print(f"DEBUG: Sent message of type {msg.message_type.name}")
 
 
-def recv_message(listener_socket):
-    header = listener_socket.recv(MESSAGE_HEADER_SIZE)
+def recv_exactly(listener_socket, length):
+    # Receives exactly length bytes straight into a new buffer, or None if
+    # the peer disconnects first
+    buffer = bytearray(length)
+    view = memoryview(buffer)
+    position = 0
+
+    while position < length:
+        received = listener_socket.recv_into(view[position:])
+        if received == 0:
+            return None
+
+        position += received
+
+    return buffer
+
+
+def recv_message(listener_socket, version=PROTOCOL_V1):
+    header = recv_exactly(listener_socket, MESSAGE_HEADER_SIZE)
 
-    if not header:
+    if header is None:
         print("WARN: Peer disconnected - things will probably crash")
         return None
 
-    (length, msg_type) = parse_message_header(header)
+    (length, msg_type, compressed) = parse_frame_header(header)
     print(f"DEBUG: Received message of type {msg_type.name}")
 
     if length > 0:
-        # Create empty contents
-        contents = bytearray()
+        contents = recv_exactly(listener_socket, length)
 
-        # Do not exceed max socket transfer size
-        bytes_remaining = length
-        while bytes_remaining > MAX_SOCKET_TRANSFER:
-            # Receive bytes and add to array
-            add = listener_socket.recv(MAX_SOCKET_TRANSFER)
-            contents += bytearray(add)
+        # Ensure message transferred in full
+        if contents is None:
+            print("ERROR: Message was corrupted")
+            print(f"Expected length: {length}")
+            return None
+
+        if compressed:
+            contents = decompress_body(contents)
 
-            # Decrease length by amount transferred
-            bytes_remaining -= len(add)
+        # Parse contents
+        return parse_message_contents(msg_type, contents, version)
+    else:
+        return parse_message_contents(msg_type, None, version)
 
-        # Append the remaining amount
-        add = listener_socket.recv(bytes_remaining)
-        contents += bytearray(add)
 
-        # Ensure message transferred in full
-        if len(contents) != length:
+def check_frame_size(length, max_frame_size):
+    if max_frame_size is not None and length > max_frame_size:
+        raise ValueError(f"Frame of {length} bytes is larger than the limit of {max_frame_size}")
+
+
+class FrameReader:
+    # Reads frames from a socket into one reusable buffer.
+    #
+    # Each recv_into() fills as much of the buffer as the socket has ready,
+    # which may be several frames, and frames are handed out as memoryview
+    # slices of the buffer without copying. A view is only valid until the
+    # next read, so decoders copy (see owned_data) anything they keep.
+    #
+    # Frames too large for the buffer are received directly into a buffer
+    # of their own, which the message may keep without a further copy.
+
+    socket = None
+    buffer = None
+    view = None
+
+    # Called with the type and wire length of every frame read
+    on_frame = None
+
+    # time.monotonic() by which reads must finish (e.g. a login), or None
+    deadline = None
+
+    # Largest frame body to accept, or None for no limit. The length comes
+    # from the peer, so it is checked before allocating anything for it.
+    max_frame_size = None
+
+    # Unread data is buffer[start:end]
+    start = 0
+    end = 0
+
+    def __init__(self, reader_socket, size=RECEIVE_BUFFER_SIZE, on_frame=None):
+        self.socket = reader_socket
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.on_frame = on_frame
+
+    def buffered(self):
+        # Whether a frame can be read without waiting for the socket to
+        # become readable. TLS sockets may hold decrypted data which
+        # select/poll cannot see.
+        available = self.end - self.start
+        if available >= MESSAGE_HEADER_SIZE:
+            (length, _) = parse_message_header(self.view[self.start:self.start + MESSAGE_HEADER_SIZE])
+            if available >= MESSAGE_HEADER_SIZE + length:
+                return True
+
+        pending = getattr(self.socket, "pending", None)
+        return pending is not None and pending() > 0
+
+    def recv_into(self, view):
+        # A socket timeout restarts with every recv, so a peer sending a
+        # byte at a time could hold a read open forever. Each recv is
+        # instead only given the time left before the deadline.
+        if self.deadline is not None:
+            remaining = self.deadline - time.monotonic()
+            if remaining <= 0:
+                raise socket.timeout("Deadline passed")
+
+            self.socket.settimeout(remaining)
+
+        return self.socket.recv_into(view)
+
+    def fill(self, needed):
+        # Reads until at least needed bytes are buffered, or returns False
+        # if the peer disconnects first
+        if self.start + needed > len(self.buffer):
+            # Move the unread data to the front to make room
+            available = self.end - self.start
+            self.view[0:available] = self.view[self.start:self.end]
+            self.start = 0
+            self.end = available
+
+        while self.end - self.start < needed:
+            received = self.recv_into(self.view[self.end:])
+            if received == 0:
+                return False
+
+            self.end += received
+
+        return True
+
+    def read_frame(self):
+        # Returns (message type, body) for the next frame, where the body is
+        # None if the frame is empty, or None if the peer disconnected.
+        # Compressed bodies are returned decompressed.
+        frame = self.read_raw_frame()
+        if frame is None:
+            return None
+
+        (msg_type, body, compressed) = frame
+        if compressed:
+            body = decompress_body(body)
+
+        return msg_type, body
+
+    def read_raw_frame(self):
+        # As read_frame, but leaves the body compressed and also returns
+        # whether it is compressed
+        if not self.fill(MESSAGE_HEADER_SIZE):
+            return None
+
+        (length, msg_type, compressed) = parse_frame_header(self.view[self.start:self.start + MESSAGE_HEADER_SIZE])
+        frame_length = MESSAGE_HEADER_SIZE + length
+
+        check_frame_size(length, self.max_frame_size)
+
+        if self.on_frame is not None:
+            self.on_frame(msg_type, frame_length)
+
+        if length == 0:
+            self.start += frame_length
+            return msg_type, None, compressed
+
+        if frame_length > len(self.buffer):
+            # Take what has already arrived, then receive the rest in place
+            body = bytearray(length)
+            body_start = self.start + MESSAGE_HEADER_SIZE
+            available = self.end - body_start
+            body[0:available] = self.view[body_start:self.end]
+            self.start = self.end = 0
+
+            body_view = memoryview(body)
+            while available < length:
+                received = self.recv_into(body_view[available:])
+                if received == 0:
+                    return None
+
+                available += received
+
+            return msg_type, body, compressed
+
+        if not self.fill(frame_length):
+            return None
+
+        body = self.view[self.start + MESSAGE_HEADER_SIZE:self.start + frame_length]
+        self.start += frame_length
+
+        if self.start == self.end:
+            self.start = self.end = 0
+
+        return msg_type, body, compressed
+
+    def read_message(self, version=PROTOCOL_V1):
+        frame = self.read_frame()
+
+        if frame is None:
+            print("WARN: Peer disconnected")
+            return None
+
+        (msg_type, body) = frame
+        print(f"DEBUG: Received message of type {msg_type.name}")
+
+        return parse_message_contents(msg_type, body, version)
+
+
+async def recv_message_async(reader, version=PROTOCOL_V1, on_frame=None, max_frame_size=None):
+    try:
+        header = await reader.readexactly(MESSAGE_HEADER_SIZE)
+    except (asyncio.IncompleteReadError, ConnectionError):
+        print("WARN: Peer disconnected")
+        return None
+
+    (length, msg_type, compressed) = parse_frame_header(header)
+    print(f"DEBUG: Received message of type {msg_type.name}")
+
+    check_frame_size(length, max_frame_size)
+
+    if on_frame is not None:
+        on_frame(msg_type, MESSAGE_HEADER_SIZE + length)
+
+    if length > 0:
+        # The stream reader buffers internally so the body can be read in one go
+        try:
+            contents = await reader.readexactly(length)
+        except asyncio.IncompleteReadError as e:
             print("ERROR: Message was corrupted")
             print(f"Expected length: {length}")
-            print(f"Actual length: {len(contents)}")
+            print(f"Actual length: {len(e.partial)}")
             return None
 
-        # Parse contents
-        return parse_message_contents(msg_type, contents)
+        if compressed:
+            contents = decompress_body(contents)
+
+        return parse_message_contents(msg_type, contents, version)
     else:
-        return parse_message_contents(msg_type, None)
+        return parse_message_contents(msg_type, None, version)
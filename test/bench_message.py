@@ -0,0 +1,167 @@
+# Benchmark: Message Codec
+# Name: Matthew Jakeman
+# UPI: mjak923
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from config import HISTORY_PAGE_LIMIT, RESOURCE_CHUNK_SIZE
+from message import *
+
+# Times encoding (message_to_wire) and decoding (parse_message) of a sample
+# of every message type in every protocol version, plus the header
+# functions, and saves the results as JSON. Passing an earlier result file
+# with --compare prints how much each case has changed.
+#
+# Run from the test directory:
+#   python bench_message.py --output before.json
+#   python bench_message.py --compare before.json
+
+VERSIONS = [PROTOCOL_V1, PROTOCOL_V2, PROTOCOL_V3]
+
+SHORT_TEXT = "Hello, are we still on for tonight?"
+LONG_TEXT = "All work and no play makes Jack a dull boy. " * 100
+TIMESTAMP = datetime.datetime(2022, 10, 15, 12, 30, 45, 123456)
+DIGEST = "ab" * 32
+
+
+def sample_messages():
+    # (name, message) pairs at realistic sizes, with several sizes for the
+    # types whose size varies the most
+    records = [message_to_wire(RoomEntryBroadcastMessage(4, f"{SHORT_TEXT} {i}", TIMESTAMP, i, INVALID_ID))
+               for i in range(HISTORY_PAGE_LIMIT)]
+
+    return [
+        ("nickname", NicknameMessage("nickname", PROTOCOL_VERSION)),
+        ("ack_client", AcknowledgeClientMessage(1234, PROTOCOL_VERSION)),
+        ("list_clients", ListClientsMessage()),
+        ("client_discovery", ClientDiscoveryMessage(1234, "nickname")),
+        ("client_directory_1000", ClientDirectoryMessage([(i, f"user{i}") for i in range(1000)])),
+        ("list_rooms", ListRoomsMessage()),
+        ("room_discovery", RoomDiscoveryMessage(56, "Room title", 1234, "nickname")),
+        ("room_directory_1000", RoomDirectoryMessage([(i, f"Room {i}", i, f"user{i}") for i in range(1000)])),
+        ("room_create", RoomCreateMessage(1234, "Room title")),
+        ("ack_room_create", AcknowledgeRoomCreateMessage(56)),
+        ("room_invite", RoomInviteMessage(56, 1234)),
+        ("initiate_user_chat", InitiateUserChatMessage(1234)),
+        ("ack_user_chat", AcknowledgeUserChatMessage(56, 1234, "nickname")),
+        ("room_message_send_short", RoomEntrySendMessage(56, SHORT_TEXT, TIMESTAMP, INVALID_ID)),
+        ("room_message_send_long", RoomEntrySendMessage(56, LONG_TEXT, TIMESTAMP, INVALID_ID)),
+        ("room_message_broadcast_short", RoomEntryBroadcastMessage(56, SHORT_TEXT, TIMESTAMP, 1234, INVALID_ID)),
+        ("room_message_broadcast_long", RoomEntryBroadcastMessage(56, LONG_TEXT, TIMESTAMP, 1234, INVALID_ID)),
+        ("resource_create_4mb", ResourceCreateMessage(os.urandom(4 * 1024 * 1024))),
+        ("ack_resource", AcknowledgeResourceMessage(78)),
+        ("resource_fetch", ResourceFetchMessage(78)),
+        ("resource_transfer_4mb", ResourceTransferMessage(os.urandom(4 * 1024 * 1024))),
+        ("room_membership_10", RoomMembershipDiscoveryMessage(1234, list(range(10)))),
+        ("room_membership_5000", RoomMembershipDiscoveryMessage(1234, list(range(5000)))),
+        ("list_room_members", ListRoomMembersMessage(56)),
+        ("client_departure", ClientDepartureMessage(1234)),
+        ("history_fetch", HistoryFetchMessage(56, INVALID_ID, HISTORY_PAGE_LIMIT)),
+        ("history_batch", HistoryBatchMessage(56, 0, records)),
+        ("resource_upload_begin", ResourceUploadBeginMessage(DIGEST, 4 * 1024 * 1024)),
+        ("resource_upload_ack", ResourceUploadAckMessage(DIGEST, 256 * 1024)),
+        ("resource_upload_chunk", ResourceUploadChunkMessage(DIGEST, 256 * 1024, os.urandom(RESOURCE_CHUNK_SIZE))),
+        ("resource_upload_end", ResourceUploadEndMessage(DIGEST)),
+        ("resource_download", ResourceDownloadMessage(78, 256 * 1024)),
+        ("resource_chunk", ResourceChunkMessage(78, 256 * 1024, 4 * 1024 * 1024, RESOURCE_ORIGINAL,
+                                                   os.urandom(RESOURCE_CHUNK_SIZE))),
+    ]
+
+
+def time_call(func, repeat):
+    # Best time of several runs in nanoseconds per call, with each run
+    # lasting at least 0.2 seconds
+    timer = timeit.Timer(func)
+    (number, _) = timer.autorange()
+    return min(timer.repeat(repeat, number)) / number * 1e9
+
+
+def run_benchmarks(repeat, name_filter=None):
+    results = []
+
+    header = build_message_header(1024, MessageType.ROOM_MESSAGE_BROADCAST)
+    results.append({"name": "build_message_header", "version": None, "size": MESSAGE_HEADER_SIZE,
+                    "encode_ns": time_call(lambda: build_message_header(1024, MessageType.ROOM_MESSAGE_BROADCAST),
+                                           repeat),
+                    "decode_ns": time_call(lambda: parse_message_header(header), repeat)})
+    print_result(results[-1])
+
+    samples = sample_messages()
+    for message_type in set(MESSAGE_CLASSES) - {message.message_type for (_, message) in samples}:
+        print(f"WARN: No sample of {message_type.name}")
+
+    for (name, message) in samples:
+        if name_filter is not None and name_filter not in name:
+            continue
+
+        for version in VERSIONS:
+            wire = message_to_wire(message, version)
+
+            results.append({
+                "name": name,
+                "version": version,
+                "size": len(wire),
+                "encode_ns": time_call(lambda: message_to_wire(message, version), repeat),
+                "decode_ns": time_call(lambda: parse_message(wire, version), repeat),
+            })
+
+            print_result(results[-1])
+
+    return results
+
+
+def result_key(result):
+    return result["name"], result["version"]
+
+
+def print_result(result, baseline=None):
+    line = (f"{result['name']:<30} v{result['version'] or '-'} {result['size']:>10} bytes "
+            f"encode {result['encode_ns']:>14,.0f} ns  decode {result['decode_ns']:>14,.0f} ns")
+
+    if baseline is not None:
+        line += (f"  ({result['encode_ns'] / baseline['encode_ns']:.2f}x, "
+                 f"{result['decode_ns'] / baseline['decode_ns']:.2f}x)")
+
+    print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks encoding and decoding of every message type")
+    parser.add_argument("--output", help="file to save the results to as JSON")
+    parser.add_argument("--compare", help="earlier results to compare against")
+    parser.add_argument("--repeat", type=int, default=5, help="runs of each case, the best is kept")
+    parser.add_argument("--filter", help="only run cases whose name contains this")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.repeat, args.filter)
+
+    if args.compare is not None:
+        with open(args.compare) as compare_file:
+            baseline = {result_key(result): result for result in json.load(compare_file)["results"]}
+
+        print(f"\nCompared with {args.compare} (times relative to before, lower is faster):")
+        for result in results:
+            print_result(result, baseline.get(result_key(result)))
+
+    if args.output is not None:
+        report = {
+            "time": datetime.datetime.now().isoformat(),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "results": results,
+        }
+
+        with open(args.output, "w") as output_file:
+            json.dump(report, output_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+# Testing: Client Resource Cache
+# Name: Matthew Jakeman
+# UPI: mjak923
+
+import os
+import tempfile
+from unittest import TestCase
+
+from app_cache import ResourceDiskCache
+from message import RESOURCE_ORIGINAL, RESOURCE_PREVIEW
+
+
+class ResourceDiskCacheTest(TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.location = self.temp_dir.name
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_hits_and_misses(self):
+        cache = ResourceDiskCache(self.location, 100)
+
+        self.assertIsNone(cache.get(1))
+        cache.put(1, b"1234")
+        self.assertEqual(cache.get(1), b"1234")
+
+        self.assertEqual(cache.hits, 1)
+        self.assertEqual(cache.misses, 1)
+
+    def test_evicts_least_recently_used(self):
+        cache = ResourceDiskCache(self.location, 10)
+        cache.put(1, b"aaaa")
+        cache.put(2, b"bbbb")
+
+        # Touch 1 so that 2 is the least recently used
+        cache.get(1)
+        cache.put(3, b"cccc")
+
+        self.assertIsNone(cache.get(2))
+        self.assertFalse(os.path.exists(cache.path((2, RESOURCE_ORIGINAL))))
+        self.assertEqual(cache.get(1), b"aaaa")
+        self.assertEqual(cache.size, 8)
+
+    def test_survives_restart(self):
+        cache = ResourceDiskCache(self.location, 100)
+        cache.put(1, b"aaaa")
+        cache.put(2, b"bbbb")
+
+        # Make 1 the most recently used on disk
+        os.utime(cache.path((1, RESOURCE_ORIGINAL)), (2000000000, 2000000000))
+        os.utime(cache.path((2, RESOURCE_ORIGINAL)), (1000000000, 1000000000))
+
+        # Reopening with a smaller budget evicts the least recently used
+        cache = ResourceDiskCache(self.location, 4)
+
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.get(1), b"aaaa")
+        self.assertIsNone(cache.get(2))
+
+    def test_ignores_unfinished_writes(self):
+        with open(os.path.join(self.location, "1.0.tmp"), "wb") as file:
+            file.write(b"partial")
+
+        cache = ResourceDiskCache(self.location, 100)
+
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(os.listdir(self.location), [])
+
+    def test_value_larger_than_budget(self):
+        cache = ResourceDiskCache(self.location, 4)
+        cache.put(1, b"too large")
+
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.size, 0)
+
+    def test_variants_are_separate(self):
+        cache = ResourceDiskCache(self.location, 100)
+        cache.put(1, b"original")
+        cache.put(1, b"preview", RESOURCE_PREVIEW)
+
+        self.assertEqual(cache.get(1), b"original")
+        self.assertEqual(cache.get(1, RESOURCE_PREVIEW), b"preview")
+        self.assertIsNone(cache.get(2, RESOURCE_PREVIEW))
+
+    def test_partial_downloads_resume(self):
+        cache = ResourceDiskCache(self.location, 100)
+        with cache.open_partial(1) as file:
+            file.write(b"first ")
+
+        # Kept across a restart, and not part of the cache until finished
+        cache = ResourceDiskCache(self.location, 100)
+        self.assertIsNone(cache.get(1))
+
+        with cache.open_partial(1) as file:
+            self.assertEqual(file.tell(), 6)
+            file.write(b"second")
+
+        self.assertEqual(cache.finish_partial(1), b"first second")
+        self.assertEqual(cache.get(1), b"first second")
+        self.assertEqual(cache.size, 12)
+        self.assertEqual(os.listdir(self.location), ["1.0"])
+
+    def test_abandoned_partial_downloads_are_deleted(self):
+        cache = ResourceDiskCache(self.location, 100)
+        with cache.open_partial(1) as file:
+            file.write(b"partial")
+
+        os.utime(cache.partial_path((1, RESOURCE_ORIGINAL)), (1000000000, 1000000000))
+        ResourceDiskCache(self.location, 100)
+
+        self.assertEqual(os.listdir(self.location), [])
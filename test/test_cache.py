@@ -0,0 +1,52 @@
+# Testing: Resource Cache
+# Name: Matthew Jakeman
+# UPI: mjak923
+
+from unittest import TestCase
+
+from server_cache import ResourceCache
+
+
+class ResourceCacheTest(TestCase):
+    def test_hits_and_misses(self):
+        cache = ResourceCache(100)
+
+        self.assertIsNone(cache.get("a"))
+        cache.put("a", b"1234")
+        self.assertEqual(cache.get("a"), b"1234")
+
+        self.assertEqual(cache.hits, 1)
+        self.assertEqual(cache.misses, 1)
+
+    def test_evicts_least_recently_used(self):
+        cache = ResourceCache(10)
+        cache.put("a", b"aaaa")
+        cache.put("b", b"bbbb")
+
+        # Touch 'a' so that 'b' is the least recently used
+        cache.get("a")
+        cache.put("c", b"cccc")
+
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), b"aaaa")
+        self.assertEqual(cache.get("c"), b"cccc")
+        self.assertEqual(cache.size, 8)
+
+    def test_value_larger_than_budget(self):
+        cache = ResourceCache(4)
+        cache.put("a", b"too large")
+
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.size, 0)
+
+    def test_get_or_load(self):
+        cache = ResourceCache(100)
+        loads = []
+
+        def load():
+            loads.append(1)
+            return b"data"
+
+        self.assertEqual(cache.get_or_load("a", load), b"data")
+        self.assertEqual(cache.get_or_load("a", load), b"data")
+        self.assertEqual(len(loads), 1)
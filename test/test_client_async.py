@@ -0,0 +1,142 @@
+# Testing: Asyncio Client
+# Name: Matthew Jakeman
+# UPI: mjak923
+
+import asyncio
+import os
+import tempfile
+from unittest import IsolatedAsyncioTestCase
+
+from client_async import AsyncClient
+from config import RESOURCE_CHUNK_SIZE, DOWNLOAD_WINDOW, PARTIAL_DOWNLOAD_SUFFIX
+from message import *
+
+
+class NullWriter:
+    # Stands in for a connection's stream writer, discarding what is sent
+    def writelines(self, buffers):
+        pass
+
+    async def drain(self):
+        pass
+
+
+class ResourceServer:
+    # Stands in for a connection's stream writer, answering each chunk
+    # request with a chunk of data once control returns to the event loop
+    def __init__(self, client, data):
+        self.client = client
+        self.data = data
+        self.offsets = []
+        self.in_flight = 0
+        self.most_in_flight = 0
+
+    def writelines(self, buffers):
+        message = parse_message(b"".join(buffers), self.client.version)
+        self.offsets.append(message.offset)
+        self.in_flight += 1
+        self.most_in_flight = max(self.most_in_flight, self.in_flight)
+
+        chunk = self.data[message.offset:message.offset + RESOURCE_CHUNK_SIZE]
+        reply = ResourceChunkMessage(message.resource_id, message.offset, len(self.data), message.variant, chunk)
+        asyncio.get_running_loop().call_soon(self.reply, reply)
+
+    def reply(self, message):
+        self.in_flight -= 1
+        self.client.dispatch(message)
+
+    async def drain(self):
+        pass
+
+
+class AsyncClientTest(IsolatedAsyncioTestCase):
+    def add_request(self, client, *reply_types, match=None):
+        # As request, without sending anything
+        future = asyncio.get_running_loop().create_future()
+        client.waiting.append((reply_types, match, future))
+        return future
+
+    async def test_replies_go_to_oldest_request(self):
+        client = AsyncClient("nick")
+        first = self.add_request(client, MessageType.ACKNOWLEDGE_ROOM_CREATE)
+        second = self.add_request(client, MessageType.ACKNOWLEDGE_ROOM_CREATE)
+
+        client.dispatch(AcknowledgeRoomCreateMessage(1))
+        client.dispatch(AcknowledgeRoomCreateMessage(2))
+
+        self.assertEqual((await first).room_id, 1)
+        self.assertEqual((await second).room_id, 2)
+
+    async def test_request_with_several_reply_types(self):
+        client = AsyncClient("nick")
+        end = self.add_request(client, MessageType.ACKNOWLEDGE_RESOURCE, MessageType.RESOURCE_UPLOAD_ACK)
+
+        client.dispatch(ResourceUploadAckMessage("ab" * 32, 0))
+        self.assertEqual((await end).offset, 0)
+
+    async def test_replies_are_matched(self):
+        client = AsyncClient("nick")
+        first = self.add_request(client, MessageType.HISTORY_BATCH, match=lambda reply: reply.room_id == 1)
+        second = self.add_request(client, MessageType.HISTORY_BATCH, match=lambda reply: reply.room_id == 2)
+
+        # Replies out of order still reach their own requests
+        client.dispatch(HistoryBatchMessage(2, 0, []))
+        client.dispatch(HistoryBatchMessage(1, 0, []))
+
+        self.assertEqual((await first).room_id, 1)
+        self.assertEqual((await second).room_id, 2)
+
+    async def test_request_times_out(self):
+        client = AsyncClient("nick", request_timeout=0.01)
+        client.writer = NullWriter()
+
+        with self.assertRaises(asyncio.TimeoutError):
+            await client.request(ResourceUploadBeginMessage("ab" * 32, 10), MessageType.RESOURCE_UPLOAD_ACK)
+
+        # A later reply isn't taken by the abandoned request
+        self.assertEqual(client.waiting, [])
+
+    async def test_other_messages_are_iterated(self):
+        client = AsyncClient("nick")
+        self.add_request(client, MessageType.ACKNOWLEDGE_ROOM_CREATE)
+
+        client.dispatch(ClientDiscoveryMessage(3, "other"))
+        client.incoming.put_nowait(None)
+
+        messages = [message async for message in client]
+        self.assertEqual([message.client_id for message in messages], [3])
+        self.assertEqual(len(client.waiting), 1)
+
+    async def test_on_message(self):
+        received = []
+        client = AsyncClient("nick", on_message=received.append)
+
+        client.dispatch(ClientDepartureMessage(3))
+        self.assertEqual([message.client_id for message in received], [3])
+        self.assertTrue(client.incoming.empty())
+
+    async def test_chunks_are_pipelined(self):
+        client = AsyncClient("nick")
+        data = bytes(range(256)) * (RESOURCE_CHUNK_SIZE * 5 // 256 + 3)
+        client.writer = ResourceServer(client, data)
+
+        self.assertEqual(await client.fetch_resource(4), data)
+        self.assertEqual(client.writer.offsets, list(range(0, len(data), RESOURCE_CHUNK_SIZE)))
+        self.assertEqual(client.writer.most_in_flight, DOWNLOAD_WINDOW)
+
+    async def test_download_resumes(self):
+        client = AsyncClient("nick")
+        data = bytes(range(256)) * (RESOURCE_CHUNK_SIZE * 2 // 256 + 3)
+        client.writer = ResourceServer(client, data)
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "resource")
+            with open(path + PARTIAL_DOWNLOAD_SUFFIX, "wb") as partial_file:
+                partial_file.write(data[:RESOURCE_CHUNK_SIZE])
+
+            self.assertEqual(await client.download_resource(4, path), len(data))
+            self.assertEqual(client.writer.offsets, [RESOURCE_CHUNK_SIZE, 2 * RESOURCE_CHUNK_SIZE])
+            self.assertFalse(os.path.exists(path + PARTIAL_DOWNLOAD_SUFFIX))
+
+            with open(path, "rb") as resource_file:
+                self.assertEqual(resource_file.read(), data)
@@ -0,0 +1,67 @@
+# Testing: Outbound Queue
+# Name: Matthew Jakeman
+# UPI: mjak923
+
+from unittest import TestCase
+
+from message import MessageType
+from server_connection import OutboundQueue, QUEUED, DROPPED, OVERFLOW
+
+
+class OutboundQueueTest(TestCase):
+    def test_queue_below_limit(self):
+        queue = OutboundQueue('disconnect', limit=2, high_water=1024)
+
+        self.assertEqual(queue.push((b"abc",), MessageType.CLIENT_DISCOVERY), QUEUED)
+        self.assertEqual(queue.queued_bytes, 3)
+
+        (frame, message_type) = queue.pop()
+        self.assertEqual(frame, (b"abc",))
+        self.assertEqual(message_type, MessageType.CLIENT_DISCOVERY)
+        self.assertEqual(queue.queued_bytes, 0)
+
+    def test_disconnect_policy(self):
+        queue = OutboundQueue('disconnect', limit=1, high_water=1024)
+        queue.push((b"abc",), MessageType.CLIENT_DISCOVERY)
+
+        self.assertEqual(queue.push((b"def",), MessageType.CLIENT_DISCOVERY), OVERFLOW)
+
+    def test_drop_policy(self):
+        queue = OutboundQueue('drop', limit=1024, high_water=4)
+        queue.push((b"abcd",), MessageType.ROOM_MESSAGE_BROADCAST)
+
+        self.assertEqual(queue.push((b"efgh",), MessageType.ROOM_MESSAGE_BROADCAST), DROPPED)
+        self.assertEqual(len(queue), 1)
+        self.assertEqual(queue.dropped, 1)
+
+    def test_coalesce_policy(self):
+        queue = OutboundQueue('coalesce', limit=2, high_water=1024)
+        queue.push((b"old",), MessageType.CLIENT_DISCOVERY, 7)
+        queue.push((b"other",), MessageType.ROOM_DISCOVERY, 7)
+
+        # Same type and key replaces the queued frame in place
+        self.assertEqual(queue.push((b"newer",), MessageType.CLIENT_DISCOVERY, 7), QUEUED)
+        self.assertEqual(len(queue), 2)
+        self.assertEqual(queue.queued_bytes, 10)
+        self.assertEqual(queue.pop()[0], (b"newer",))
+
+        # Nothing to coalesce with, so the frame is dropped
+        queue.push((b"third",), MessageType.CLIENT_DISCOVERY, 8)
+        self.assertEqual(queue.push((b"fourth",), MessageType.CLIENT_DISCOVERY, 9), DROPPED)
+
+    def test_frames_of_several_buffers(self):
+        queue = OutboundQueue('disconnect', limit=8, high_water=1024)
+        queue.push((b"head", b"body"), MessageType.RESOURCE_TRANSFER)
+
+        self.assertEqual(queue.queued_bytes, 8)
+
+    def test_pop_batch(self):
+        queue = OutboundQueue('disconnect', limit=8, high_water=1024)
+        for frame in [b"aaaa", b"bbbb", b"cccc"]:
+            queue.push((frame,), MessageType.ROOM_MESSAGE_BROADCAST)
+
+        self.assertEqual([frame for (frame, _) in queue.pop_batch(8)], [(b"aaaa",), (b"bbbb",)])
+
+        # Always at least one frame, however large
+        self.assertEqual(len(queue.pop_batch(1)), 1)
+        self.assertEqual(queue.queued_bytes, 0)
@@ -0,0 +1,134 @@
+# Testing: Frame Reader
+# Name: Matthew Jakeman
+# UPI: mjak923
+
+import socket
+import threading
+import time
+from unittest import TestCase
+
+from message import *
+from socket_utils import FrameReader, send_buffers
+
+
+class FrameReaderTest(TestCase):
+    def setUp(self):
+        (self.sender, self.receiver) = socket.socketpair()
+
+    def tearDown(self):
+        self.sender.close()
+        self.receiver.close()
+
+    def test_several_frames_in_one_read(self):
+        frames = [message_to_wire(ClientDiscoveryMessage(i, f"nick{i}")) for i in range(3)]
+        self.sender.sendall(b"".join(frames))
+
+        reader = FrameReader(self.receiver)
+        for i in range(3):
+            message = reader.read_message()
+            self.assertEqual((message.client_id, message.nickname), (i, f"nick{i}"))
+
+        self.assertFalse(reader.buffered())
+
+    def test_split_header(self):
+        frame = bytes(message_to_wire(AcknowledgeRoomCreateMessage(7)))
+        reader = FrameReader(self.receiver)
+
+        self.sender.sendall(frame[:3])
+        self.assertFalse(reader.buffered())
+        self.sender.sendall(frame[3:])
+
+        self.assertEqual(reader.read_message().room_id, 7)
+
+    def test_frame_larger_than_buffer(self):
+        data = bytes(range(256)) * 64
+        self.sender.sendall(message_to_wire(ResourceTransferMessage(data)))
+        self.sender.sendall(message_to_wire(ListRoomsMessage()))
+
+        reader = FrameReader(self.receiver, size=1024)
+        self.assertEqual(reader.read_message().data, data)
+        self.assertEqual(reader.read_message().message_type, MessageType.LIST_ROOMS)
+
+    def test_kept_data_survives_next_read(self):
+        self.sender.sendall(message_to_wire(ResourceTransferMessage(b"first")))
+        self.sender.sendall(message_to_wire(ResourceTransferMessage(b"second")))
+
+        reader = FrameReader(self.receiver)
+        first = reader.read_message()
+        reader.read_message()
+
+        self.assertEqual(first.data, b"first")
+
+    def test_wraps_around_buffer(self):
+        reader = FrameReader(self.receiver, size=64)
+
+        # Frames straddle the end of the buffer and are moved to the front
+        frames = [message_to_wire(ClientDiscoveryMessage(i, "x" * i), PROTOCOL_V2) for i in range(20)]
+        self.sender.sendall(b"".join(frames))
+
+        for i in range(20):
+            self.assertEqual(reader.read_message(PROTOCOL_V2).nickname, "x" * i)
+
+    def test_compressed_frame(self):
+        clients = [(i, f"nick{i}") for i in range(200)]
+        self.sender.sendall(message_to_wire(ClientDirectoryMessage(clients), PROTOCOL_V3))
+
+        reader = FrameReader(self.receiver, size=1024)
+        (_, _, compressed) = reader.read_raw_frame()
+        self.assertTrue(compressed)
+
+        self.sender.sendall(message_to_wire(ClientDirectoryMessage(clients), PROTOCOL_V3))
+        self.assertEqual(reader.read_message(PROTOCOL_V3).clients, clients)
+
+    def test_disconnect(self):
+        self.sender.close()
+        self.assertIsNone(FrameReader(self.receiver).read_message())
+
+    def test_deadline_covers_whole_frame(self):
+        # A byte at a time, each well within a per-recv timeout
+        frame = bytes(message_to_wire(NicknameMessage("nickname")))
+
+        def trickle():
+            for i in range(len(frame)):
+                time.sleep(0.05)
+                try:
+                    self.sender.sendall(frame[i:i + 1])
+                except OSError:
+                    return
+
+        thread = threading.Thread(target=trickle)
+        thread.start()
+
+        reader = FrameReader(self.receiver)
+        reader.deadline = time.monotonic() + 0.2
+        with self.assertRaises(socket.timeout):
+            reader.read_message()
+
+        self.sender.close()
+        thread.join()
+
+    def test_frame_over_limit(self):
+        # Only the header is sent, claiming a body far too large to allocate
+        self.sender.sendall(build_message_header(2 ** 55, MessageType.NICKNAME))
+
+        reader = FrameReader(self.receiver)
+        reader.max_frame_size = 4096
+        with self.assertRaises(ValueError):
+            reader.read_message()
+
+
+class SendBuffersTest(TestCase):
+    def test_partial_writes(self):
+        buffers = [b"head", bytes(range(256)) * 16, b"", b"tail"]
+
+        # Writes a few bytes from the first buffer at a time
+        class ShortSender:
+            received = bytearray()
+
+            def sendmsg(self, views):
+                self.received += views[0][:7]
+                return len(views[0][:7])
+
+        sender = ShortSender()
+        send_buffers(sender, buffers)
+        self.assertEqual(sender.received, b"".join(buffers))
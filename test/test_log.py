@@ -0,0 +1,138 @@
+# Testing: Message Log
+# Name: Matthew Jakeman
+# UPI: mjak923
+
+import datetime
+import os
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+
+import server_log
+from message import RoomEntryBroadcastMessage
+from server_log import RoomLog, MessageStore
+
+
+def make_message(number):
+    return RoomEntryBroadcastMessage(3, f"Message {number}", datetime.datetime(2022, 5, 1, 12, 0, number % 60), 1, -1)
+
+
+class RoomLogTest(TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.directory = os.path.join(self.temp_dir.name, "3")
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_append_and_read(self):
+        log = RoomLog(self.directory)
+
+        for number in range(10):
+            self.assertEqual(log.append(make_message(number)), number)
+
+        messages = log.read_messages(4, 3)
+        self.assertEqual([offset for (offset, _) in messages], [4, 5, 6])
+        self.assertEqual(messages[0][1].text, "Message 4")
+        self.assertEqual(messages[0][1].timestamp, make_message(4).timestamp)
+
+        # Reading past the end is truncated
+        self.assertEqual(len(log.read(8, 10)), 2)
+        self.assertEqual(log.read(10, 10), [])
+        log.close()
+
+    def test_survives_reopen(self):
+        log = RoomLog(self.directory)
+        for number in range(5):
+            log.append(make_message(number))
+        log.close()
+
+        log = RoomLog(self.directory)
+        self.assertEqual(log.next_offset, 5)
+        self.assertEqual(log.append(make_message(5)), 5)
+        self.assertEqual(log.read_messages(5, 1)[0][1].text, "Message 5")
+        log.close()
+
+    def test_partial_record_is_dropped(self):
+        log = RoomLog(self.directory)
+        for number in range(3):
+            log.append(make_message(number))
+        log.close()
+
+        # Simulate a crash part way through writing a record
+        segment_path = os.path.join(self.directory, server_log.segment_name(0, "log"))
+        with open(segment_path, "ab") as segment:
+            segment.write(b"\x00\x00\x00\x00\x00\x01\x00")
+
+        log = RoomLog(self.directory)
+        self.assertEqual(log.next_offset, 3)
+        self.assertEqual(log.append(make_message(3)), 3)
+        self.assertEqual(log.read_messages(3, 1)[0][1].text, "Message 3")
+        log.close()
+
+    def test_segment_rollover(self):
+        with patch.object(server_log, "LOG_SEGMENT_SIZE", 256), patch.object(server_log, "LOG_INDEX_INTERVAL", 4):
+            log = RoomLog(self.directory)
+            for number in range(40):
+                log.append(make_message(number))
+
+            self.assertGreater(len(log.segments), 1)
+
+            # Reads can start in one segment and continue in the next
+            messages = log.read_messages(3, 30)
+            self.assertEqual([offset for (offset, _) in messages], list(range(3, 33)))
+            self.assertEqual(messages[-1][1].text, "Message 32")
+            log.close()
+
+            # A read-only view sees everything written so far
+            reader = RoomLog(self.directory, writable=False)
+            self.assertEqual(reader.next_offset, 40)
+            self.assertEqual(reader.read_messages(39, 1)[0][1].text, "Message 39")
+
+    def test_reader_refresh(self):
+        with patch.object(server_log, "LOG_SEGMENT_SIZE", 256):
+            log = RoomLog(self.directory)
+            reader = RoomLog(self.directory, writable=False)
+            self.assertEqual(reader.next_offset, 0)
+
+            for number in range(20):
+                log.append(make_message(number))
+
+            reader.refresh()
+            self.assertEqual(reader.next_offset, 20)
+            self.assertEqual(len(reader.segments), len(log.segments))
+            self.assertEqual(reader.read_messages(19, 1)[0][1].text, "Message 19")
+            log.close()
+
+    def test_idle_logs_are_closed(self):
+        store = MessageStore(self.temp_dir.name, max_open=2)
+        logs = [store.open_log(room_id) for room_id in range(3)]
+
+        for log in logs:
+            log.append(make_message(0))
+
+        # The least recently written log was closed, and reopens when written to
+        self.assertIsNone(logs[0].active_fd)
+        self.assertIsNotNone(logs[2].active_fd)
+        self.assertEqual(logs[0].append(make_message(1)), 1)
+        self.assertIsNone(logs[1].active_fd)
+
+        self.assertEqual([message.text for (_, message) in logs[0].read_messages(0, 2)], ["Message 0", "Message 1"])
+        store.close()
+
+    def test_appends_leave_syncing_to_the_flusher(self):
+        with patch.object(server_log, "LOG_SEGMENT_SIZE", 1024), patch("os.fsync") as fsync:
+            log = RoomLog(self.directory)
+
+            # Rolls over a few segments without waiting on the disk
+            for number in range(100):
+                log.append(make_message(number))
+
+            fsync.assert_not_called()
+            self.assertTrue(log.needs_sync())
+
+            # Sealed segments are synced along with the active one
+            log.sync()
+            self.assertEqual(fsync.call_count, 2 * len(log.segments))
+            self.assertFalse(log.needs_sync())
+            log.close()
@@ -196,3 +196,206 @@ class MessageTest(TestCase):
         cmp_message = parse_message(byte_data)
         self.assertEqual(message.message_type, cmp_message.message_type)
         self.assertEqual(message.room_id, cmp_message.room_id)
+
+    def test_client_departure_round_trip(self):
+        message = ClientDepartureMessage(4)
+        byte_data = message_to_wire(message)
+
+        cmp_message = parse_message(byte_data)
+        self.assertEqual(message.message_type, cmp_message.message_type)
+        self.assertEqual(message.client_id, cmp_message.client_id)
+
+    def test_history_fetch_round_trip(self):
+        message = HistoryFetchMessage(4, 120, 50, HISTORY_AFTER)
+        byte_data = message_to_wire(message)
+
+        cmp_message = parse_message(byte_data)
+        self.assertEqual(message.message_type, cmp_message.message_type)
+        self.assertEqual(message.room_id, cmp_message.room_id)
+        self.assertEqual(message.cursor, cmp_message.cursor)
+        self.assertEqual(message.count, cmp_message.count)
+        self.assertEqual(message.direction, cmp_message.direction)
+
+    def test_history_batch_round_trip(self):
+        entries = [RoomEntryBroadcastMessage(4, f"Text {i}", datetime.datetime.now(), i, -1) for i in range(3)]
+        records = [bytes(message_to_wire(entry)) for entry in entries]
+
+        message = HistoryBatchMessage(4, 17, records)
+        byte_data = message_to_wire(message)
+
+        cmp_message = parse_message(byte_data)
+        self.assertEqual(message.message_type, cmp_message.message_type)
+        self.assertEqual(message.room_id, cmp_message.room_id)
+        self.assertEqual(message.first_offset, cmp_message.first_offset)
+        self.assertEqual(message.records, cmp_message.records)
+        self.assertEqual([entry.text for entry in cmp_message.messages()], ["Text 0", "Text 1", "Text 2"])
+
+    def test_empty_history_batch_round_trip(self):
+        message = HistoryBatchMessage(4, 0, [])
+        byte_data = message_to_wire(message)
+
+        cmp_message = parse_message(byte_data)
+        self.assertEqual(cmp_message.records, [])
+
+    def test_resource_upload_chunk_round_trip(self):
+        data = bytes(range(256)) + SEPERATOR_BYTES
+        message = ResourceUploadChunkMessage("ab" * 32, 1024, data)
+        byte_data = message_to_wire(message)
+
+        cmp_message = parse_message(byte_data)
+        self.assertEqual(message.message_type, cmp_message.message_type)
+        self.assertEqual(message.digest, cmp_message.digest)
+        self.assertEqual(message.offset, cmp_message.offset)
+        self.assertEqual(message.data, cmp_message.data)
+
+    def test_resource_chunk_round_trip(self):
+        data = SEPERATOR_BYTES + bytes(range(256))
+        message = ResourceChunkMessage(4, 512, 4096, RESOURCE_PREVIEW, data)
+        byte_data = message_to_wire(message)
+
+        cmp_message = parse_message(byte_data)
+        self.assertEqual(message.message_type, cmp_message.message_type)
+        self.assertEqual(message.resource_id, cmp_message.resource_id)
+        self.assertEqual(message.offset, cmp_message.offset)
+        self.assertEqual(message.total, cmp_message.total)
+        self.assertEqual(message.variant, cmp_message.variant)
+        self.assertEqual(message.data, cmp_message.data)
+
+    def test_resource_upload_ack_round_trip(self):
+        message = ResourceUploadAckMessage("cd" * 32, 2048)
+        byte_data = message_to_wire(message)
+
+        cmp_message = parse_message(byte_data)
+        self.assertEqual(message.digest, cmp_message.digest)
+        self.assertEqual(message.offset, cmp_message.offset)
+
+    def test_directory_round_trips(self):
+        messages = [
+            ClientDirectoryMessage([(1, "one"), (2, "two")]),
+            RoomDirectoryMessage([(4, "Title", 1, "one"), (5, "Other", 2, "two")]),
+            ClientDirectoryMessage([]),
+        ]
+
+        for version in [PROTOCOL_V1, PROTOCOL_V2]:
+            for message in messages:
+                cmp_message = parse_message(message_to_wire(message, version), version)
+
+                self.assertEqual(message.message_type, cmp_message.message_type)
+                self.assertEqual(vars(message), vars(cmp_message))
+
+    def test_binary_round_trips(self):
+        timestamp = datetime.datetime(2022, 10, 15, 12, 30, 45, 123456)
+        messages = [
+            ClientDiscoveryMessage(2 ** 40, "nickname"),
+            RoomDiscoveryMessage(4, "Title", 5, "Host"),
+            RoomEntryBroadcastMessage(4, "Text", timestamp, 3, INVALID_ID),
+            RoomMembershipDiscoveryMessage(1, [1, 2, 3]),
+            RoomMembershipDiscoveryMessage(1, []),
+            ResourceChunkMessage(4, 512, 4096, RESOURCE_ORIGINAL, bytes(range(256))),
+            ListRoomsMessage(),
+        ]
+
+        for message in messages:
+            byte_data = message_to_wire(message, PROTOCOL_V2)
+            cmp_message = parse_message(byte_data, PROTOCOL_V2)
+
+            self.assertEqual(message.message_type, cmp_message.message_type)
+            self.assertEqual(vars(message), vars(cmp_message))
+
+    def test_binary_is_smaller(self):
+        messages = [
+            RoomEntryBroadcastMessage(4, "Hello", datetime.datetime.now(), 3, INVALID_ID),
+            RoomMembershipDiscoveryMessage(1234, list(range(5000))),
+            HistoryFetchMessage(56, INVALID_ID, 50),
+            ResourceDownloadMessage(78, 256 * 1024),
+        ]
+
+        for message in messages:
+            self.assertLess(len(message_to_wire(message, PROTOCOL_V2)), len(message_to_wire(message)))
+
+    def test_binary_integers(self):
+        values = [0, 1, -1, 63, -64, 64, 2 ** 40, 2 ** 63 - 1, -2 ** 63]
+        message = RoomMembershipDiscoveryMessage(INVALID_ID, values)
+        cmp_message = parse_message(message_to_wire(message, PROTOCOL_V2), PROTOCOL_V2)
+
+        self.assertEqual(cmp_message.members, values)
+        self.assertEqual(len(message_to_wire(RoomInviteMessage(4, INVALID_ID), PROTOCOL_V2)), MESSAGE_HEADER_SIZE + 2)
+
+        # Cut off part way through an integer
+        with self.assertRaises(ValueError):
+            parse_message(message_to_wire(message, PROTOCOL_V2)[:-1], PROTOCOL_V2)
+
+    def test_binary_history_batch(self):
+        entries = [RoomEntryBroadcastMessage(4, f"Text {i}", datetime.datetime.now(), i, -1) for i in range(3)]
+        records = [bytes(message_to_wire(entry)) for entry in entries]
+
+        message = HistoryBatchMessage(4, 17, records)
+        byte_data = message_to_wire(message, PROTOCOL_V2)
+        cmp_message = parse_message(byte_data, PROTOCOL_V2)
+
+        # Records are stored as v1, but sent in the binary encoding
+        self.assertLess(len(byte_data), len(message_to_wire(message)))
+        self.assertEqual(cmp_message.records, [message_to_wire(entry, PROTOCOL_V2) for entry in entries])
+        self.assertEqual([entry.text for entry in cmp_message.messages(PROTOCOL_V2)], ["Text 0", "Text 1", "Text 2"])
+
+    def test_binary_strings_are_safe_for_v1(self):
+        message = RoomEntryBroadcastMessage(4, f"a{SEPERATOR_TOKEN}b", datetime.datetime.now(), 3, INVALID_ID)
+        cmp_message = parse_message(message_to_wire(message, PROTOCOL_V2), PROTOCOL_V2)
+        self.assertEqual(cmp_message.text, f"a{SEPERATOR_REPLACEMENT}b")
+
+        # Relaying it to a v1 client keeps its fields apart
+        self.assertEqual(parse_message(message_to_wire(cmp_message)).text, cmp_message.text)
+
+    def test_history_batch_skips_bad_records(self):
+        good = RoomEntryBroadcastMessage(4, "Good", datetime.datetime.now(), 3, INVALID_ID)
+        bad = RoomEntryBroadcastMessage(4, f"a{SEPERATOR_TOKEN}b", datetime.datetime.now(), 3, INVALID_ID)
+
+        message = HistoryBatchMessage(4, 0, [bytes(message_to_wire(bad)), bytes(message_to_wire(good))])
+        self.assertEqual([entry.text for entry in message.messages()], ["Good"])
+
+    def test_compressed_round_trip(self):
+        message = RoomDirectoryMessage([(i, f"Room {i}", i, f"host{i}") for i in range(100)])
+        byte_data = message_to_wire(message, PROTOCOL_V3)
+
+        (_, msg_type, compressed) = parse_frame_header(byte_data[:MESSAGE_HEADER_SIZE])
+        self.assertEqual(msg_type, MessageType.ROOM_DIRECTORY)
+        self.assertTrue(compressed)
+        self.assertLess(len(byte_data), len(message_to_wire(message, PROTOCOL_V2)))
+
+        self.assertEqual(vars(parse_message(byte_data, PROTOCOL_V3)), vars(message))
+
+    def test_not_compressed(self):
+        # Small messages and resource data are sent as they are
+        messages = [
+            ClientDiscoveryMessage(1, "nick"),
+            ResourceTransferMessage(bytes(4096)),
+            ClientDirectoryMessage([(i, "nick") for i in range(100)]),
+        ]
+        versions = [PROTOCOL_V3, PROTOCOL_V3, PROTOCOL_V2]
+
+        for (message, version) in zip(messages, versions):
+            byte_data = message_to_wire(message, version)
+            self.assertEqual(byte_data[MESSAGE_HEADER_SIZE:], message_body(message, version))
+
+    def test_version_negotiation_messages(self):
+        # Older peers send and expect no version
+        self.assertEqual(bytes(message_to_wire(NicknameMessage("nick")))[MESSAGE_HEADER_SIZE:], b"nick")
+        self.assertEqual(parse_message(message_to_wire(NicknameMessage("nick"))).version, PROTOCOL_V1)
+
+        message = parse_message(message_to_wire(NicknameMessage("nick", PROTOCOL_V2)))
+        self.assertEqual((message.nickname, message.version), ("nick", PROTOCOL_V2))
+
+        message = parse_message(message_to_wire(AcknowledgeClientMessage(3, PROTOCOL_V2)))
+        self.assertEqual((message.client_id, message.version), (3, PROTOCOL_V2))
+
+    def test_negotiated_version(self):
+        self.assertEqual(negotiate_version(PROTOCOL_V2), PROTOCOL_V2)
+        self.assertEqual(negotiate_version(PROTOCOL_VERSION + 5), PROTOCOL_VERSION)
+
+        # Nonsense versions fall back to v1 rather than the binary encoding
+        self.assertEqual(negotiate_version(0), PROTOCOL_V1)
+        self.assertEqual(negotiate_version(-3), PROTOCOL_V1)
+
+    def test_every_type_has_a_class(self):
+        for message_type in MessageType:
+            self.assertEqual(MESSAGE_CLASSES[message_type].message_type, message_type)
@@ -0,0 +1,62 @@
+# Testing: Server Metrics
+# Name: Matthew Jakeman
+# UPI: mjak923
+
+from unittest import TestCase
+
+from message import MessageType
+from server_metrics import MetricsRegistry, Counter, Gauge, Histogram, ServerMetrics
+
+
+class MetricsTest(TestCase):
+    def test_counter_with_labels(self):
+        registry = MetricsRegistry()
+        counter = registry.register(Counter("frames_total", "Frames", ["type"]))
+
+        counter.inc(labels=("A",))
+        counter.inc(2, ("A",))
+        counter.inc(labels=("B",))
+
+        lines = registry.render().splitlines()
+        self.assertIn("# TYPE frames_total counter", lines)
+        self.assertIn('frames_total{type="A"} 3', lines)
+        self.assertIn('frames_total{type="B"} 1', lines)
+
+    def test_histogram_is_cumulative(self):
+        registry = MetricsRegistry()
+        histogram = registry.register(Histogram("latency", "Latency", [1, 5]))
+
+        for value in [0.5, 2, 3, 10]:
+            histogram.observe(value)
+
+        lines = registry.render().splitlines()
+        self.assertIn('latency_bucket{le="1"} 1', lines)
+        self.assertIn('latency_bucket{le="5"} 3', lines)
+        self.assertIn('latency_bucket{le="+Inf"} 4', lines)
+        self.assertIn("latency_sum 15.5", lines)
+        self.assertIn("latency_count 4", lines)
+
+    def test_collectors_run_on_render(self):
+        registry = MetricsRegistry()
+        gauge = registry.register(Gauge("clients", "Clients"))
+        registry.add_collector(lambda: gauge.set(7))
+
+        self.assertIn("clients 7", registry.render().splitlines())
+
+    def test_label_escaping(self):
+        registry = MetricsRegistry()
+        gauge = registry.register(Gauge("named", "Named", ["name"]))
+        gauge.set(1, ('say "hi"\n',))
+
+        self.assertIn('named{name="say \\"hi\\"\\n"} 1', registry.render().splitlines())
+
+    def test_server_metrics(self):
+        metrics = ServerMetrics()
+        metrics.frame_received(MessageType.LIST_ROOMS, 8)
+        metrics.frame_sent(MessageType.ROOM_DIRECTORY, 100)
+        metrics.dispatched(MessageType.LIST_ROOMS, 0.0002)
+
+        lines = metrics.registry.render().splitlines()
+        self.assertIn('chat_bytes_received_total{type="LIST_ROOMS"} 8', lines)
+        self.assertIn('chat_bytes_sent_total{type="ROOM_DIRECTORY"} 100', lines)
+        self.assertIn('chat_dispatch_seconds_count{type="LIST_ROOMS"} 1', lines)
@@ -0,0 +1,70 @@
+# Testing: Client Registry
+# Name: Matthew Jakeman
+# UPI: mjak923
+
+from unittest import TestCase
+
+from server_client import ClientData
+from server_registry import ClientRegistry
+
+
+def make_client_data(client_id, nickname):
+    client_data = ClientData(client_id)
+    client_data.client_nick = nickname
+    return client_data
+
+
+class ClientRegistryTest(TestCase):
+    def test_lookup_by_id_and_nick(self):
+        registry = ClientRegistry()
+        client_data = make_client_data(300, "Matthew")
+
+        self.assertTrue(registry.add("socket", client_data))
+
+        self.assertIs(registry.get_data("socket"), client_data)
+        self.assertIs(registry.get_data_for_id(300), client_data)
+        self.assertEqual(registry.get_client_for_id(300), "socket")
+        self.assertTrue(registry.has_nick("Matthew"))
+
+    def test_duplicate_nick_rejected(self):
+        registry = ClientRegistry()
+
+        self.assertTrue(registry.add("first", make_client_data(0, "Matthew")))
+        self.assertFalse(registry.add("second", make_client_data(1, "Matthew")))
+
+        self.assertEqual(len(registry), 1)
+        self.assertIsNone(registry.get_client_for_id(1))
+
+    def test_remove_clears_all_indexes(self):
+        registry = ClientRegistry()
+        registry.add("socket", make_client_data(4, "Matthew"))
+
+        removed = registry.remove("socket")
+
+        self.assertEqual(removed.client_id, 4)
+        self.assertNotIn("socket", registry)
+        self.assertIsNone(registry.get_data_for_id(4))
+        self.assertFalse(registry.has_nick("Matthew"))
+
+        # Nickname can be reused once the old client has gone
+        self.assertTrue(registry.add("other", make_client_data(5, "Matthew")))
+
+    def test_remove_unknown_client(self):
+        registry = ClientRegistry()
+        self.assertIsNone(registry.remove("socket"))
+
+    def test_remote_clients(self):
+        registry = ClientRegistry()
+        registry.add("socket", make_client_data(0, "Matthew"))
+
+        self.assertTrue(registry.add_remote(make_client_data(1, "Remote")))
+        self.assertFalse(registry.add_remote(make_client_data(2, "Matthew")))
+
+        # Remote clients can be looked up, but have no connection
+        self.assertEqual(registry.get_data_for_id(1).client_nick, "Remote")
+        self.assertIsNone(registry.get_client_for_id(1))
+        self.assertEqual(len(registry.all_client_data()), 2)
+        self.assertEqual(registry.clients(), ["socket"])
+
+        registry.remove_remote(1)
+        self.assertFalse(registry.has_nick("Remote"))
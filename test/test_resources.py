@@ -0,0 +1,187 @@
+# Testing: Resource Store
+# Name: Matthew Jakeman
+# UPI: mjak923
+
+import os
+import tempfile
+import threading
+from unittest import TestCase
+
+from message import RESOURCE_ORIGINAL, RESOURCE_PREVIEW
+from server_resources import ResourceStore, content_hash, is_valid_hash
+
+
+class ResourceStoreTest(TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.location = self.temp_dir.name
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_create_and_get(self):
+        store = ResourceStore(self.location)
+        store.create(0, b"image data")
+
+        self.assertEqual(store.get(0), b"image data")
+
+    def test_duplicates_share_a_blob(self):
+        store = ResourceStore(self.location)
+        first_hash = store.create(0, b"same image")
+        second_hash = store.create(1, b"same image")
+
+        self.assertEqual(first_hash, second_hash)
+        self.assertEqual(store.get(1), b"same image")
+
+        # Sharded by the leading characters of the hash
+        path = store.blob_path(first_hash)
+        self.assertTrue(path.endswith(os.path.join(first_hash[0:2], first_hash[2:4], first_hash)))
+        self.assertTrue(os.path.exists(path))
+
+    def test_index_survives_reopen(self):
+        store = ResourceStore(self.location)
+        store.create(4, b"first")
+        store.create(7, b"second")
+
+        store = ResourceStore(self.location)
+        self.assertEqual(sorted(store.resource_ids()), [4, 7])
+        self.assertEqual(store.get(7), b"second")
+
+    def test_sees_resources_from_other_store(self):
+        store = ResourceStore(self.location)
+        other_store = ResourceStore(self.location)
+
+        other_store.create(3, b"from another worker")
+        self.assertEqual(store.get(3), b"from another worker")
+
+    def test_legacy_resources(self):
+        with open(os.path.join(self.location, "2.png"), "wb") as legacy:
+            legacy.write(b"old image")
+
+        store = ResourceStore(self.location)
+        self.assertEqual(store.get(2), b"old image")
+        self.assertIn(2, store.resource_ids())
+
+    def test_resumed_upload(self):
+        store = ResourceStore(self.location)
+        data = b"0123456789"
+        blob_hash = content_hash(data)
+
+        self.assertEqual(store.begin_partial(blob_hash, len(data)), 0)
+        self.assertEqual(store.write_partial(blob_hash, 0, data[:4]), 4)
+
+        # A chunk past the end is ignored, a repeated one is harmless
+        self.assertEqual(store.write_partial(blob_hash, 8, data[8:]), 4)
+        self.assertEqual(store.write_partial(blob_hash, 0, data[:4]), 4)
+
+        store = ResourceStore(self.location)
+        self.assertEqual(store.partial_size(blob_hash), 4)
+        self.assertEqual(store.write_partial(blob_hash, 4, data[4:]), 10)
+
+        self.assertEqual(store.complete_partial(blob_hash, lambda: 5), 5)
+        self.assertEqual(store.get(5), data)
+        self.assertIsNone(store.partial_size(blob_hash))
+
+    def test_corrupt_upload(self):
+        store = ResourceStore(self.location)
+        blob_hash = content_hash(b"expected")
+        store.begin_partial(blob_hash, 9)
+        store.write_partial(blob_hash, 0, b"corrupted")
+
+        self.assertIsNone(store.complete_partial(blob_hash, lambda: self.fail("Allocated an id")))
+        self.assertEqual(store.partial_size(blob_hash), 0)
+        self.assertIsNone(store.get_hash(5))
+
+    def test_upload_limited_to_declared_size(self):
+        store = ResourceStore(self.location)
+        blob_hash = content_hash(b"0123456789")
+
+        # Never begun
+        self.assertIsNone(store.write_partial(blob_hash, 0, b"0123"))
+
+        store.begin_partial(blob_hash, 10)
+        self.assertEqual(store.write_partial(blob_hash, 0, b"0123"), 4)
+        self.assertIsNone(store.write_partial(blob_hash, 4, b"456789 and more"))
+        self.assertEqual(store.partial_size(blob_hash), 4)
+
+    def test_expire_partials(self):
+        store = ResourceStore(self.location)
+        old_hash = content_hash(b"old")
+        new_hash = content_hash(b"new")
+
+        for blob_hash in [old_hash, new_hash]:
+            store.begin_partial(blob_hash, 3)
+            store.write_partial(blob_hash, 0, b"ab")
+
+        # The new upload began long ago, but was written to recently
+        os.utime(store.partial_path(old_hash), (1000000000, 1000000000))
+        os.utime(store.size_path(old_hash), (1000000000, 1000000000))
+        os.utime(store.size_path(new_hash), (1000000000, 1000000000))
+
+        self.assertEqual(store.expire_partials(60), 1)
+        self.assertIsNone(store.declared_size(old_hash))
+        self.assertEqual(store.partial_size(old_hash), 0)
+        self.assertEqual(store.declared_size(new_hash), 3)
+        self.assertEqual(store.partial_size(new_hash), 2)
+
+    def test_read_chunk(self):
+        store = ResourceStore(self.location)
+        store.create(0, b"0123456789")
+
+        self.assertEqual(store.read_chunk(0, 4, 4), (b"4567", 10))
+        self.assertEqual(store.read_chunk(0, 8, 4), (b"89", 10))
+
+    def test_variants(self):
+        # Data starting with "big" gets a smaller preview
+        makers = {RESOURCE_PREVIEW: lambda data: b"small" if data.startswith(b"big") else None}
+        store = ResourceStore(self.location, makers)
+        store.create(0, b"big image")
+        store.create(1, b"tiny")
+
+        self.assertEqual(store.read_chunk(0, 0, 100, RESOURCE_PREVIEW), (b"small", 5))
+        self.assertEqual(store.read_chunk(0, 0, 100, RESOURCE_ORIGINAL), (b"big image", 9))
+
+        # Without a smaller variant, the original is used
+        self.assertEqual(store.read_chunk(1, 0, 100, RESOURCE_PREVIEW), (b"tiny", 4))
+
+    def test_variants_made_on_first_use(self):
+        blob_hash = ResourceStore(self.location).create(0, b"big image")
+
+        # Stored before previews could be made
+        store = ResourceStore(self.location, {RESOURCE_PREVIEW: lambda data: b"small"})
+        self.assertFalse(os.path.exists(store.variant_path(blob_hash, RESOURCE_PREVIEW)))
+        self.assertEqual(store.read_chunk(0, 0, 100, RESOURCE_PREVIEW), (b"small", 5))
+
+    def test_variants_made_concurrently(self):
+        # Every thread gets past the existence check before any finishes
+        barrier = threading.Barrier(4)
+
+        def make_preview(data):
+            barrier.wait(5)
+            return b"small" if data.startswith(b"big") else None
+
+        store = ResourceStore(self.location, {RESOURCE_PREVIEW: make_preview})
+        errors = []
+
+        def create(resource_id, data):
+            try:
+                store.create(resource_id, data)
+            except Exception as e:
+                errors.append(e)
+
+        # A preview of its own, and one which is linked to the original
+        for (first_id, data) in [(0, b"big image"), (4, b"tiny")]:
+            threads = [threading.Thread(target=create, args=(first_id + i, data)) for i in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(store.read_chunk(0, 0, 100, RESOURCE_PREVIEW), (b"small", 5))
+        self.assertEqual(store.read_chunk(4, 0, 100, RESOURCE_PREVIEW), (b"tiny", 4))
+
+    def test_hash_validation(self):
+        self.assertTrue(is_valid_hash(content_hash(b"data")))
+        self.assertFalse(is_valid_hash("../../index"))
+        self.assertFalse(is_valid_hash(""))
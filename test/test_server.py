@@ -0,0 +1,93 @@
+# Testing: Server Rooms
+# Name: Matthew Jakeman
+# UPI: mjak923
+
+import datetime
+import os
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+
+import server
+from config import INVALID_ID
+from message import *
+
+
+class FakeClient:
+    # Stands in for a client's connection, keeping what it is sent
+    version = PROTOCOL_V1
+
+    def __init__(self):
+        self.sent = []
+
+    def send(self, message):
+        self.sent.append(message)
+
+    def send_frame(self, frame, message_type, coalesce_key=None):
+        self.sent.append(parse_message(b"".join(frame)))
+
+    def received(self, message_type):
+        return [message for message in self.sent if message.message_type == message_type]
+
+
+class ServerRestartTest(TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.patches = [
+            patch.object(server, "HISTORY_LOCATION", os.path.join(self.temp_dir.name, "history")),
+            patch.object(server, "RESOURCE_LOCATION", os.path.join(self.temp_dir.name, "res")),
+            patch.object(server, "create_server_context", lambda: None),
+        ]
+
+        for started in self.patches:
+            started.start()
+
+    def tearDown(self):
+        for started in self.patches:
+            started.stop()
+
+        self.temp_dir.cleanup()
+
+    def start_server(self):
+        return server.Server("127.0.0.1", 0, metrics_port=0)
+
+    def login(self, chat_server, nickname):
+        client = FakeClient()
+        client_data = chat_server.login_client(client, NicknameMessage(nickname))
+        return client, client_data
+
+    def test_history_survives_restart(self):
+        chat_server = self.start_server()
+        (host, host_data) = self.login(chat_server, "Matthew")
+        (guest, guest_data) = self.login(chat_server, "Guest")
+
+        chat_server.dispatch_message(host, RoomCreateMessage(host_data.client_id, "Lounge"))
+        room_id = host.received(MessageType.ACKNOWLEDGE_ROOM_CREATE)[0].room_id
+        chat_server.dispatch_message(host, RoomInviteMessage(room_id, guest_data.client_id))
+
+        for number in range(3):
+            chat_server.dispatch_message(host, RoomEntrySendMessage(room_id, f"Message {number}",
+                                                                    datetime.datetime(2022, 5, 1), INVALID_ID))
+
+        chat_server.message_store.close()
+
+        # Members get their rooms back by nickname, under new ids
+        restarted = self.start_server()
+        (outsider, outsider_data) = self.login(restarted, "Outsider")
+        (guest, new_guest_data) = self.login(restarted, "Guest")
+        self.assertGreater(new_guest_data.client_id, guest_data.client_id)
+
+        restarted.dispatch_message(guest, ListRoomsMessage())
+        [room] = guest.received(MessageType.ROOM_DISCOVERY)
+        self.assertEqual((room.room_id, room.title, room.host_name), (room_id, "Lounge", "Matthew"))
+
+        reply = restarted.history_fetch_reply(guest, HistoryFetchMessage(room_id, INVALID_ID, 10))
+        self.assertEqual([message.text for message in reply.messages(guest.version)],
+                         ["Message 0", "Message 1", "Message 2"])
+        self.assertIsNone(restarted.history_fetch_reply(outsider, HistoryFetchMessage(room_id, INVALID_ID, 10)))
+
+        # The host can still invite once back
+        (host, _) = self.login(restarted, "Matthew")
+        restarted.dispatch_message(host, RoomInviteMessage(room_id, outsider_data.client_id))
+        self.assertEqual(len(outsider.received(MessageType.ROOM_DISCOVERY)), 1)
+        restarted.message_store.close()